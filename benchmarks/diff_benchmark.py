@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+# diff_benchmark.py - render time, report size and peak memory of the
+# emr_diff.py report for patients with long histories, as the report was
+# made before (difflib.HtmlDiff tables built into one string) vs. the
+# engines of emr_diff.py streamed through the diff.html template
+
+# Initially created in October 2026
+
+import argparse
+import itertools
+import json
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'tools'))
+import emr_diff
+
+import pages
+
+VISITS = [100, 500, 1000]
+
+def make(n, lines):
+    """Parsed notes of n visits with the given number of lines per segment, as {attending: [(medicalsn, (date, segments))]}."""
+    d = emr_diff.parse_visitlist(pages.visitlist(n))
+    notes = {pages.medicalsn(i): pages.soap(i, lines=lines) for i in range(n)}
+    return {name: [(sn, emr_diff.parse_note(notes[sn])) for sn in sorted(d[name])] for name in d}
+
+def render_head(chartno, names):
+    """Renders the start of the HTML report as emr_diff.py used to, up to and including the table of contents (one entry per attending)."""
+    # HTML output, generated as a string. Double curly braces are used for the stylesheet since single ones trigger string formatting (and hence errors). Stylesheet copied from difflib.HtmlDiff.make_file output.
+    html_out = "<html lang='en'>\n<head>\n  <meta charset='utf-8'>\n  <title>OPD Visit Diff Report for {patient}</title>\n  <style type='text/css'>\n    table.diff {{font-family:Courier; border:medium;}}\n    .diff_header {{background-color:#e0e0e0}}\n    td.diff_header {{text-align:right}}\n    .diff_next {{background-color:#c0c0c0}}\n    .diff_add {{background-color:#aaffaa}}\n    .diff_chg {{background-color:#ffff77}}\n    .diff_sub {{background-color:#ffaaaa}}\n    #toc_container {{border: 1px solid #aaa; padding: 20px; width: auto;}}\n    .toc_title {{text-align: center;}}\n  </style>\n</head>\n<body>\n".format(patient=chartno)
+
+    toc = "  <div id='toc_container'>\n    <ul>\n"
+    for name in names:
+        toc = toc + "      <li><a href='#" + name + "'>" + name + "</a></li>\n"
+    return html_out + toc + "    </ul>\n  </div>\n"
+
+def render_before(d, path):
+    # The report as emr_diff.py used to make it
+    html_out = render_head(pages.CHARTNO, d.keys())
+    tables = itertools.count()
+    for name in d:
+        html_out += "  <hr/>\n  <p><h2 id='{doctor}'>Notes for Dr. {doctor}</h2></p>\n".format(doctor=name)
+        cache = [[], [], [], []]
+        for sn, (date, segments) in d[name]:
+            if len(segments) >= 4:
+                html_out += emr_diff.render_visit(date, sn, segments, cache, 50, tables)
+    html_out += "\n</body>\n</html>"
+    with open(path, mode='w', encoding='utf-8') as fh:
+        print(html_out, file=fh)
+
+def render_streamed(engine):
+    def render(d, path):
+        def attendings():
+            render_visit = emr_diff.ENGINES[engine]
+            tables = itertools.count()
+            ids = dict()
+            for name in d:
+                cache = [[], [], [], []]
+                yield name, [render_visit(date, sn, segments, cache, 50, tables, ids) for sn, (date, segments) in d[name] if len(segments) >= 4]
+        with open(path, mode='w', encoding='utf-8') as fh:
+            emr_diff.write_report(fh, pages.CHARTNO, d.keys(), attendings(), engine=engine)
+    return render
+
+RENDERERS = {
+    'before': render_before,
+    'htmldiff': render_streamed('htmldiff'),
+    'compact': render_streamed('compact'),
+}
+
+def measure(render, d, path, repeat):
+    """Renders the report repeatedly and returns (median seconds, peak bytes, report size in bytes)."""
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(d, path)
+        times.append(time.perf_counter() - start)
+    # Peak memory is measured in a separate run, as tracing slows rendering down
+    tracemalloc.start()
+    render(d, path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(times), peak, path.stat().st_size
+
+def run(sizes, lines, renderers, repeat):
+    """Benchmarks each renderer at each number of visits and returns a list of result dicts."""
+    results = list()
+    with tempfile.TemporaryDirectory() as outputdir:
+        path = pathlib.Path(outputdir) / 'diff.html'
+        for n in sizes:
+            d = make(n, lines)
+            for name in renderers:
+                seconds, peak, size = measure(RENDERERS[name], d, path, repeat)
+                results.append({'visits': n, 'lines': lines, 'renderer': name, 'seconds': seconds, 'peak_bytes': peak, 'bytes': size})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render time, size and peak memory of the emr_diff.py report, before vs. each engine",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-v", "--visits", type=int, nargs="+", default=VISITS, help="Numbers of visits to benchmark")
+    parser.add_argument("-l", "--lines", type=int, default=40, help="Lines per note segment (subjective, objective, plan)")
+    parser.add_argument("-r", "--renderer", nargs="+", choices=list(RENDERERS), default=list(RENDERERS), help="Renderers to compare")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="Number of timed runs per size (the median is reported)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON instead of a table")
+    args = parser.parse_args()
+
+    assert args.repeat > 0, "Number of runs must be positive"
+
+    results = run(args.visits, args.lines, args.renderer, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:>7} {:<10} {:>10} {:>12} {:>12}".format("Visits", "Renderer", "ms", "Peak KiB", "KiB"))
+        for r in results:
+            print("{:>7} {:<10} {:>10.1f} {:>12.1f} {:>12.1f}".format(r['visits'], r['renderer'],
+                r['seconds'] * 1000, r['peak_bytes'] / 1024, r['bytes'] / 1024))
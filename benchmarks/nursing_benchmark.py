@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+# nursing_benchmark.py - parse time of daily nursing sheets (viewReport.aspx)
+# with many events, as emr_nursing.py used to parse them (backward searches
+# for the time, event type and assessment type of each event) vs. the single
+# pass of emr_nursing.parse_events()
+
+# Initially created in October 2026
+
+import argparse
+import datetime
+import json
+import pathlib
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'tools'))
+import emr_nursing
+from lib import parse
+
+import pages
+
+EVENTS = [24, 200, 1000]
+NOTEDATE = '2019/12/01'
+
+def parse_before(nursing_sheet, notedate):
+    # The parser as emr_nursing.py used to have it
+    out_list = list()
+    nursing_sheet_soup = parse.parse(nursing_sheet, 'nursing')
+    event_num = nursing_sheet_soup.find_all('div', string=re.compile(r'^\d+\.$'))
+    for e in event_num:
+        time = datetime.datetime.strptime(notedate, '%Y/%m/%d').strftime('%Y-%m-%d') + ' ' + e.find_parent().find_previous('td', attrs={'id':re.compile('c1$')}).text
+        event_type = e.find_parent().find_previous('td', attrs={'id':re.compile('c2$')}).text
+        assessment_type = e.find_parent().find_previous('td', attrs={'id':re.compile('c3$')}).text
+        action = e.find_parent().find_next_sibling().text
+        out_list.append([time, event_type, assessment_type, action])
+    return out_list
+
+def parse_single(nursing_sheet, notedate):
+    return list(emr_nursing.parse_events(nursing_sheet, notedate))
+
+PARSERS = {
+    'before': parse_before,
+    'single': parse_single,
+}
+
+def measure(parser, sheet, repeat):
+    """Parses the sheet repeatedly and returns (median seconds, events)."""
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = parser(sheet, NOTEDATE)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), out
+
+def run(sizes, parsers, repeat):
+    """Benchmarks each parser at each number of events per sheet and returns a list of result dicts."""
+    results = list()
+    for n in sizes:
+        sheet = pages.viewreport(NOTEDATE, events=n)
+        outputs = dict()
+        for name in parsers:
+            seconds, outputs[name] = measure(PARSERS[name], sheet, repeat)
+            results.append({'events': n, 'parser': name, 'seconds': seconds, 'rows': len(outputs[name]), 'bytes': len(sheet.encode('utf-8'))})
+        # Both parsers must give the same rows
+        assert len(set(json.dumps(x) for x in outputs.values())) <= 1, "Parsers disagree on a sheet of {} events".format(n)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parse time of daily nursing sheets with many events, before vs. the single-pass parser",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-e", "--events", type=int, nargs="+", default=EVENTS, help="Numbers of events (table rows) per sheet to benchmark")
+    parser.add_argument("-p", "--parser", nargs="+", choices=list(PARSERS), default=list(PARSERS), help="Parsers to compare")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="Number of timed runs per size (the median is reported)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON instead of a table")
+    args = parser.parse_args()
+
+    assert args.repeat > 0, "Number of runs must be positive"
+
+    results = run(args.events, args.parser, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:>7} {:<8} {:>10} {:>7} {:>10}".format("Events", "Parser", "ms", "Rows", "KiB"))
+        for r in results:
+            print("{:>7} {:<8} {:>10.1f} {:>7} {:>10.1f}".format(r['events'], r['parser'],
+                r['seconds'] * 1000, r['rows'], r['bytes'] / 1024))
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+# pages.py - EMR and iVue pages of any size built from the anonymized
+# fixtures in benchmarks/fixtures
+#
+# Each fixture is a page saved from hisweb/iVue with the patient data
+# replaced by string.Template placeholders. Repeated parts of a page (visits,
+# table rows, ...) are marked with <!-- BEGIN name --> ... <!-- END name -->
+# and are expanded once for each row given for that name. All generated data
+# is made up and only depends on the arguments, so runs are reproducible.
+
+import datetime
+import functools
+import pathlib
+import random
+import re
+import string
+
+FIXTUREDIR = pathlib.Path(__file__).resolve().parent / 'fixtures'
+CHARTNO = '00000000'
+ENCOUNTERID = 'I00000000001'
+IVUE_ID = '10001'
+ATTENDINGS = ['測試醫師甲', '測試醫師乙', '測試醫師丙']
+# Newest day of the made-up records
+LASTDAY = datetime.date(2020, 1, 10)
+
+_block_regex = re.compile(r'<!-- BEGIN (\w+) -->(.*?)<!-- END \1 -->', re.DOTALL)
+
+@functools.lru_cache(maxsize=None)
+def fixture(name):
+    """Returns the contents of a fixture (without the .html extension)."""
+    return (FIXTUREDIR / (name + '.html')).read_text(encoding='utf-8')
+
+def render(name, fields=None, blocks=None):
+    """Fills in a fixture.
+
+    Args:
+        name (str): Name of the fixture, e.g. 'list2'.
+        fields (dict) [optional]: Values of the placeholders outside of repeated blocks.
+        blocks (dict) [optional]: For each repeated block, a list of dicts with the values of its placeholders
+            (blocks not given are left out).
+
+    Returns:
+        str: The page.
+
+    """
+    fields = dict(fields or {})
+    blocks = blocks or {}
+    def expand(m):
+        template = string.Template(m.group(2))
+        return ''.join(template.substitute(fields, **row) for row in blocks.get(m.group(1), []))
+    return string.Template(_block_regex.sub(expand, fixture(name))).substitute(fields)
+
+# Hidden ASP.NET form fields of the SSO login page
+VIEWSTATE = '/wEPDwUKMTI2NzE0NjQ1MmRkAAAAAAAAAAAAAAAAAAAAAAAAAAA='
+VIEWSTATEGENERATOR = 'C2EE9ABB'
+EVENTVALIDATION = '/wEdAAS0AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+
+def login(message=''):
+    """SSO login page (WebsiteSSO/PCS/), optionally with an error message."""
+    return render('login', {'viewstate': VIEWSTATE, 'viewstategenerator': VIEWSTATEGENERATOR,
+        'eventvalidation': EVENTVALIDATION, 'message': message})
+
+def patientlist(uid, patients=20):
+    """Patient list shown after logging in."""
+    return render('patientlist', {'uid': uid}, {'patients': [{'bed': '%02d' % (k + 1), 'name': '測試病人%d' % (k + 1),
+        'chartno': '%08d' % (k + 1)} for k in range(patients)]})
+
+def autologin(chartno):
+    """EmrQuery start page for a patient (where autologin.aspx redirects to)."""
+    return render('autologin', {'chartno': chartno})
+
+def medicalsn(i):
+    """Visit ID ('medicalsn') of the i-th outpatient visit (0 being the newest)."""
+    return 'O%010d' % (1000 + i)
+
+def _visitdate(i):
+    return LASTDAY - datetime.timedelta(days=7 * i)
+
+def visitlist(visits, admissions=3):
+    """Visit list (list2.aspx) with the given number of outpatient visits (newest first) and admissions."""
+    rows = [{'medicalsn': medicalsn(i), 'date': _visitdate(i).strftime('%Y/%m/%d'),
+        'attending': ATTENDINGS[i % len(ATTENDINGS)], 'department': '小兒科'} for i in range(visits)]
+    adm = [{'medicalsn': 'I%011d' % (1 + i), 'date': (LASTDAY - datetime.timedelta(days=90 * i)).strftime('%Y/%m/%d'),
+        'attending': ATTENDINGS[i % len(ATTENDINGS)], 'department': '小兒病房'} for i in range(admissions)]
+    er = [{'medicalsn': 'E%011d' % 1, 'date': LASTDAY.strftime('%Y/%m/%d'), 'attending': ATTENDINGS[0]}]
+    return render('list2', {'chartno': CHARTNO, 'startdate': _visitdate(visits).isoformat(), 'enddate': LASTDAY.isoformat()},
+        {'visits': rows, 'admissions': adm, 'emergencies': er})
+
+def _lines(r, prefix, count, variants=3):
+    # Lines of a note segment; most are carried over from visit to visit
+    return '<br />'.join('%s %d: 病況描述 %d' % (prefix, j, r.randrange(variants) if j % 3 == 0 else 0) for j in range(count))
+
+def soap(i, lines=8):
+    """OPD note (viewer.aspx?type=soap) of the i-th outpatient visit (see visitlist())."""
+    r = random.Random(i)
+    return render('soap', {'chartno': CHARTNO, 'medicalsn': medicalsn(i), 'attending': ATTENDINGS[i % len(ATTENDINGS)],
+        'department': '小兒科', 'date': _visitdate(i).strftime('%Y/%m/%d') + ' 09:%02d' % (i % 60),
+        'subjective': _lines(r, 'S', lines), 'objective': _lines(r, 'O', lines), 'diagnosis': _lines(r, 'Dx', 3, 8),
+        'plan': _lines(r, 'P', lines), 'lab': 'CBC/DC: WNL'})
+
+def opd(i, diagnoses=3):
+    """OPD visit page (viewer.aspx) of the i-th outpatient visit, for its diagnoses."""
+    r = random.Random(i)
+    return render('opd', {'chartno': CHARTNO, 'medicalsn': medicalsn(i), 'attending': ATTENDINGS[i % len(ATTENDINGS)],
+        'department': '小兒科', 'date': _visitdate(i).strftime('%Y/%m/%d') + ' 09:%02d' % (i % 60)},
+        {'diagnoses': [{'diagnosis': '%d.診斷 %d' % (k + 1, r.randrange(20))} for k in range(diagnoses)]})
+
+def problemlist(i, problems=4):
+    """Problem list (viewer_v2.aspx?type=PL) of the i-th admission."""
+    return render('problemlist', {'chartno': CHARTNO, 'medicalsn': 'I%011d' % (1 + i), 'attending': ATTENDINGS[i % len(ATTENDINGS)],
+        'ward': '小兒病房', 'date': (LASTDAY - datetime.timedelta(days=90 * i)).strftime('%Y/%m/%d') + ' 10:00'},
+        {'problems': [{'problem': '問題 %d' % (k + i)} for k in range(problems)]})
+
+def notedates(days):
+    """Dates (YYYY/MM/DD) of the nursing records of an admission lasting the given number of days, oldest first."""
+    return [(LASTDAY - datetime.timedelta(days=k)).strftime('%Y/%m/%d') for k in range(days)][::-1]
+
+def nislist(days):
+    """List of nursing records (NISlist.aspx) for the given number of days."""
+    return render('nislist', {'chartno': CHARTNO, 'encounterid': ENCOUNTERID},
+        {'days': [{'date': d} for d in notedates(days)]})
+
+def viewreport(date, events=24):
+    """Daily nursing records (viewReport.aspx) with the given number of events."""
+    rows = [{'row': k, 'time': '%02d:%02d' % (k * 24 // events, (k * 37) % 60), 'event_type': '護理類別 %d' % (k % 4),
+        'assessment_type': '評估 %d' % (k % 3), 'action': '處置 %s %d' % (date, k), 'followup': '追蹤 %d' % k} for k in range(events)]
+    return render('viewreport', {'chartno': CHARTNO, 'encounterid': ENCOUNTERID, 'date': date}, {'events': rows})
+
+def tprm3(days, perday=6):
+    """TPR chart (tprm3.aspx) with the given number of days of measurements."""
+    points = list()
+    for d in notedates(days):
+        for k in range(perday):
+            title = '%s  %02d:00\n*體溫 : 36.%d\n*脈搏 : 1%02d\n*呼吸 : 2%d\n*收縮壓 : 1%02d\n*舒張壓 : 6%d' % (d, k * 24 // perday, k, 10 + k, k, k, k)
+            points.append({'x': 10 * len(points), 'y': 100 + k, 'title': title})
+    return render('tprm3', {'chartno': CHARTNO}, {'points': points})
+
+def showshift(orders):
+    """Order sheet (showShift.aspx) with the given number of regular and stat orders each."""
+    def rows(kind):
+        return [{'type': '口服' if k % 2 else '注射', 'order': '%s藥品 %d' % (kind, k),
+            'time': '%s %02d00 -- %s' % ((LASTDAY - datetime.timedelta(days=k % 7)).isoformat(), k % 24, LASTDAY.isoformat())} for k in range(orders)]
+    return render('showshift', {'encounterid': ENCOUNTERID}, {'regular': rows('常規'), 'stat': rows('臨時')})
+
+def ivue_patient():
+    """iVue encounter page (patient.aspx)."""
+    return render('ivue_patient', {'id': IVUE_ID})
+
+def ivue_tpr(page, pages):
+    """The page-th (0 being the newest) of the given number of iVue TPR sheet pages (12 columns each)."""
+    newest = datetime.datetime.combine(LASTDAY, datetime.time(0)) - datetime.timedelta(hours=24 * page)
+    times = [newest - datetime.timedelta(hours=2 * j) for j in range(12)]
+    prev = ''
+    if page + 1 < pages:
+        prev = '<a href="patientEncounter.aspx?Page=2-%s-%d">上一頁</a>' % (IVUE_ID, 12 * (page + 1) + 1)
+    def cells(values):
+        return [{'value': v} for v in values]
+    return render('ivue_tpr', {'id': IVUE_ID, 'prev': prev}, {
+        'time': cells(t.strftime('%d-%m-%Y %H:%M') for t in times),
+        'temp': cells('%0.1f' % (36 + j / 10) if j % 3 else '' for j in range(12)),
+        'site': cells('耳溫' for j in range(12)),
+        'hr': cells(str(120 + j) for j in range(12)),
+        'rr': cells(str(30 + j) if j % 2 else '' for j in range(12)),
+        'spo2': cells(str(95 + j % 5) for j in range(12))})
+
+def ivue_basicinfo():
+    """iVue basic info sheet (sheet 1)."""
+    return render('ivue_basicinfo', {'bed': 'NICU-01', 'admitted': (LASTDAY - datetime.timedelta(days=30)).strftime('%Y/%m/%d') + ' 10:00',
+        'birthweight': '2500'})
+
+def ivue_handover(entries=5):
+    """iVue handover sheet (sheet 8) with the given number of entries in each history."""
+    start = LASTDAY - datetime.timedelta(days=30)
+    def rows(text):
+        return [{'entry': '%s %s %d' % ((start + datetime.timedelta(days=k)).strftime('%m/%d').lstrip('0').replace('/0', '/'), text, k)} for k in range(entries)]
+    return render('ivue_handover', blocks={'surgery': rows('手術'), 'respiration': rows('呼吸器'), 'cxr': rows('胸部X光'),
+        'vaccine': [{'entry': '◎疫苗%d 注射日期:%s' % (k, (start + datetime.timedelta(days=k)).strftime('%Y/%m/%d'))} for k in range(entries)]})
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+# parse_benchmark.py - parse time and peak memory of saved EMR/iVue pages,
+# full tree vs. targeted parsing (tools/lib/parse.py) with each backend
+
+# Initially created in October 2026
+
+import argparse
+import json
+import pathlib
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'tools'))
+from lib import parse
+
+import pages
+
+# Pages built from the fixtures, used when no saved pages are given
+FIXTURE_PAGES = [
+    ('visitlist', 'list2 (100 visits)', lambda: pages.visitlist(100)),
+    ('soap', 'soap', lambda: pages.soap(0)),
+    ('opd', 'opd', lambda: pages.opd(0)),
+    ('problemlist', 'problemlist', lambda: pages.problemlist(0)),
+    ('tpr', 'tprm3 (7 days)', lambda: pages.tprm3(7)),
+    ('nislist', 'nislist (30 days)', lambda: pages.nislist(30)),
+    ('nursing', 'viewreport', lambda: pages.viewreport('2020/01/10')),
+    ('orders', 'showshift (100 orders)', lambda: pages.showshift(100)),
+    ('ivue', 'ivue_tpr', lambda: pages.ivue_tpr(0, 2)),
+    ('ivue', 'ivue_handover', lambda: pages.ivue_handover()),
+]
+
+def measure(markup, pagetype, repeat):
+    """Parses a page repeatedly and returns (median seconds, peak bytes, number of tags kept)."""
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        soup = parse.parse(markup, pagetype)
+        times.append(time.perf_counter() - start)
+    del soup
+    # Peak memory is measured in a separate run, as tracing slows parsing down
+    tracemalloc.start()
+    soup = parse.parse(markup, pagetype)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(times), peak, len(soup.find_all(True))
+
+def run(pagelist, backends, repeat):
+    """Benchmarks each (page type, name or path, contents) in pagelist and returns a list of result dicts."""
+    results = list()
+    for pagetype, path, markup in pagelist:
+        for backend in backends:
+            parse.configure(backend)
+            for mode, target in (('full', None), ('targeted', pagetype)):
+                seconds, peak, tags = measure(markup, target, repeat)
+                results.append({'pagetype': pagetype, 'page': str(path), 'bytes': len(markup.encode('utf-8')),
+                    'backend': backend, 'mode': mode, 'seconds': seconds, 'peak_bytes': peak, 'tags': tags})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parse time and peak memory per page type, full vs. targeted parsing",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-p", "--page", nargs=2, action="append", metavar=("PAGETYPE", "FILE"),
+        help="Saved page and its type (one of: " + ", ".join(parse.TARGETS) + "); can be given several times (defaults to pages built from the fixtures)")
+    parser.add_argument("-b", "--backend", nargs="+", choices=parse.BACKENDS, default=parse.BACKENDS, help="Parser backends to compare")
+    parser.add_argument("-n", "--repeat", type=int, default=10, help="Number of timed runs per page (the median is reported)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON instead of a table")
+    args = parser.parse_args()
+
+    for pagetype, path in args.page or []:
+        assert pagetype in parse.TARGETS, "Unknown page type: " + pagetype
+    assert args.repeat > 0, "Number of runs must be positive"
+
+    if args.page:
+        pagelist = [(pagetype, path, pathlib.Path(path).read_text(encoding='utf-8')) for pagetype, path in args.page]
+    else:
+        pagelist = [(pagetype, name, make()) for pagetype, name, make in FIXTURE_PAGES]
+    results = run(pagelist, args.backend, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<24} {:<12} {:<9} {:>10} {:>12} {:>8}".format("Page", "Backend", "Mode", "ms", "Peak KiB", "Tags"))
+        for r in results:
+            print("{:<24} {:<12} {:<9} {:>10.2f} {:>12.1f} {:>8}".format(r['page'], r['backend'], r['mode'],
+                r['seconds'] * 1000, r['peak_bytes'] / 1024, r['tags']))
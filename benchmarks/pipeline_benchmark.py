@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+# pipeline_benchmark.py - wall time and request rate of each tool run end to
+# end against the local replay server (see replay_server.py)
+#
+# Each tool is run as it would be from the command line (or the web UI), so
+# the numbers include logging in, network round trips and writing output.
+# The server runs in this process; its latency, jitter and error rate can be
+# set to see how the tools cope with a slow or flaky server.
+
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from replay_server import ReplayServer
+
+import pages
+
+TOOLDIR = pathlib.Path(__file__).resolve().parent.parent / 'tools'
+UID = '123456'
+CHARTNO = '00000001'
+
+def commands(baseurl, outputdir, patients):
+    """Returns the command line (without the interpreter) of each tool, run against baseurl."""
+    login = ['-u', UID, '-p', 'x', '--baseurl', baseurl, '-o', outputdir]
+    chartnofile = pathlib.Path(outputdir) / 'chartno.txt'
+    chartnofile.write_text(''.join('%08d\n' % (k + 1) for k in range(patients)), encoding='utf-8')
+    return {
+        'encounters': ['emr_encounters.py', '-c', CHARTNO] + login,
+        'diagnosis': ['emr_diagnosis.py', '-c', CHARTNO] + login,
+        'diff': ['emr_diff.py', '-c', CHARTNO] + login,
+        'vitals': ['emr_vitals.py', '-c', CHARTNO] + login,
+        'nursing': ['emr_nursing.py', '-c', CHARTNO, '-e', pages.ENCOUNTERID] + login,
+        'orders': ['emr_orders.py', '-c', CHARTNO, '-e', pages.ENCOUNTERID] + login,
+        'summary': ['emr_summary.py', '-f', str(chartnofile)] + login,
+        'ivue': ['ivue_scraper.py', '-c', CHARTNO, '-e', pages.ENCOUNTERID, '-a', '-m', 'all',
+            '--baseurl', baseurl + 'iVue/', '-o', outputdir],
+    }
+
+def run(server, tools, repeat, patients, debug=False):
+    """Runs each tool repeat times against server and returns a list of result dicts."""
+    env = dict(os.environ)
+    # The server is local; a proxy set for hisweb would get in the way
+    for k in ('http_proxy', 'HTTP_PROXY'):
+        env.pop(k, None)
+    results = list()
+    with tempfile.TemporaryDirectory() as outputdir:
+        cmds = commands(server.baseurl, outputdir, patients)
+        for tool in tools:
+            times = list()
+            stats = list()
+            failures = 0
+            for _ in range(repeat):
+                server.reset_stats()
+                start = time.perf_counter()
+                p = subprocess.run([sys.executable] + cmds[tool], cwd=TOOLDIR, env=env, capture_output=True, text=True)
+                times.append(time.perf_counter() - start)
+                stats.append(server.stats())
+                if p.returncode != 0:
+                    failures += 1
+                    if debug:
+                        print('[DEBUG]', tool, 'failed:', p.stderr.strip().splitlines()[-1:], file=sys.stderr)
+            requests = statistics.median(s['requests'] for s in stats)
+            wall = statistics.median(times)
+            results.append({'tool': tool, 'wall_s': wall, 'min_s': min(times), 'requests': requests,
+                'requests_per_s': requests / wall if wall else 0.0, 'bytes': statistics.median(s['bytes'] for s in stats),
+                'errors': sum(s['errors'] + s['resets'] for s in stats), 'failed_runs': failures, 'runs': repeat})
+            if debug:
+                print('[DEBUG]', tool, '%.3f s' % wall, '%d requests' % requests, file=sys.stderr)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end wall time and request rate of each tool against the local replay server",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--debug", action="store_true", help="Print timings as they are taken")
+    tools = ['encounters', 'diagnosis', 'diff', 'vitals', 'nursing', 'orders', 'summary', 'ivue']
+    parser.add_argument("-t", "--tool", nargs="+", choices=tools, default=tools, help="Tools to run")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="Number of runs per tool (the median is reported)")
+    parser.add_argument("-k", "--patients", type=int, default=5, help="Number of patients in the chart number file given to emr_summary.py")
+    parser.add_argument("-v", "--visits", type=int, default=100, help="Number of outpatient visits in the visit list")
+    parser.add_argument("-d", "--days", type=int, default=7, help="Number of days of nursing records and TPR measurements")
+    parser.add_argument("-g", "--pages", type=int, default=10, help="Number of iVue TPR sheet pages")
+    parser.add_argument("-l", "--latency", type=float, default=0.05, help="Mean delay before each response, in seconds")
+    parser.add_argument("-J", "--jitter", type=float, default=0.02, help="Maximum deviation from the mean delay, in seconds")
+    parser.add_argument("-E", "--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500 error")
+    parser.add_argument("-R", "--reset-rate", type=float, default=0.0, help="Fraction of requests where the connection is dropped")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Seed for the random delays and failures")
+    parser.add_argument("-o", "--output", type=str, help="Write results to this file instead of standard output")
+    args = parser.parse_args()
+
+    assert args.repeat > 0, "Number of runs must be positive"
+    assert args.jitter <= args.latency, "Jitter can't be larger than the mean delay"
+
+    server = ReplayServer(('127.0.0.1', 0), visits=args.visits, days=args.days, pages=args.pages, latency=args.latency,
+        jitter=args.jitter, error_rate=args.error_rate, reset_rate=args.reset_rate, seed=args.seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        results = run(server, args.tool, args.repeat, args.patients, args.debug)
+    finally:
+        server.shutdown()
+        server.server_close()
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'server': {'visits': args.visits, 'days': args.days, 'pages': args.pages, 'latency_s': args.latency,
+            'jitter_s': args.jitter, 'error_rate': args.error_rate, 'reset_rate': args.reset_rate},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
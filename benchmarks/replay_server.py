@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+# replay_server.py - local stand-in for hisweb and iVue serving pages built
+# from the fixtures (see pages.py), for running the tools end to end without
+# the hospital network
+#
+# Covers the SSO login (hidden form fields and auth cookie), the EmrQuery
+# autologin redirect to a cookieless "(S(...))" session URL, the EmrQuery
+# tree pages, the PCS order sheet and the iVue sheet pages including paging.
+# Latency, jitter and failures can be injected to see how the tools behave
+# against a slow or flaky server. Point the tools at it with --baseurl, e.g.
+#
+#     python3 replay_server.py -l 0.08 -J 0.04
+#     python3 ../tools/emr_vitals.py -u 123456 -p x -c 00000001 --baseurl http://127.0.0.1:8765/
+#     python3 ../tools/ivue_scraper.py -c 00000001 -e I00000000001 --baseurl http://127.0.0.1:8765/iVue/
+
+import argparse
+import collections
+import functools
+import gzip
+import http.cookies
+import http.server
+import json
+import random
+import re
+import secrets
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+
+import pages
+
+# EmrQuery session IDs look like ASP.NET cookieless session IDs
+_session_regex = re.compile(r'^/EmrQuery/\(S\(([a-z0-9]+)\)\)/tree/(\w+\.aspx)$')
+AUTH_COOKIE = '.ASPXAUTH'
+
+class ReplayServer(http.server.ThreadingHTTPServer):
+    """HTTP server answering like hisweb/iVue (see ReplayHandler).
+
+    Args:
+        address (tuple): (host, port) to listen on; port 0 picks a free port.
+        visits (int): Number of outpatient visits in the visit list.
+        days (int): Number of days of nursing records and TPR measurements.
+        pages (int): Number of iVue TPR sheet pages.
+        orders (int): Number of regular and stat orders each.
+        latency (float): Mean delay (in seconds) before each response.
+        jitter (float): Maximum deviation (in seconds) from the mean delay.
+        error_rate (float): Fraction of requests answered with "500 Internal Server Error".
+        reset_rate (float): Fraction of requests where the connection is dropped without a response.
+        compress (bool): Gzip responses when the client accepts it.
+        session_ttl (float): Seconds after which an EmrQuery session ID expires (0 for never); pages of an
+            expired or unknown session are redirected to the SSO login page.
+        seed (int) [optional]: Seed for the random delays and failures.
+        verbose (bool): Log each request to standard error.
+
+    """
+    daemon_threads = True
+    # Keep-alive connections from the tools' connection pools
+    request_queue_size = 64
+
+    def __init__(self, address, visits=100, days=7, pages=10, orders=50, latency=0.0, jitter=0.0,
+            error_rate=0.0, reset_rate=0.0, compress=False, session_ttl=0.0, seed=None, verbose=False):
+        super().__init__(address, ReplayHandler)
+        self.visits = visits
+        self.days = days
+        self.pages = pages
+        self.orders = orders
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.compress = compress
+        self.session_ttl = session_ttl
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.tokens = set()
+        # Session ID: time handed out
+        self.sessions = dict()
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def baseurl(self):
+        """Base URL to give the EMR tools (--baseurl); iVue is under baseurl + 'iVue/'."""
+        host, port = self.server_address[:2]
+        return 'http://%s:%d/' % (host, port)
+
+    def reset_stats(self):
+        with self.lock:
+            self.started = time.perf_counter()
+            self.counts = collections.Counter()
+            self.errors = 0
+            self.resets = 0
+            self.bytes = 0
+
+    def stats(self):
+        """Returns the number of requests (in total and per page), failures and bytes sent since the last reset."""
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            total = sum(self.counts.values())
+            return {'requests': total, 'errors': self.errors, 'resets': self.resets, 'bytes': self.bytes,
+                'seconds': elapsed, 'requests_per_s': total / elapsed if elapsed else 0.0, 'pages': dict(self.counts)}
+
+    def delay(self):
+        with self.lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def failure(self):
+        # Returns 'reset', 'error' or None
+        with self.lock:
+            x = self.random.random()
+        if x < self.reset_rate:
+            return 'reset'
+        if x < self.reset_rate + self.error_rate:
+            return 'error'
+        return None
+
+# Generated pages only depend on their arguments
+_page = functools.lru_cache(maxsize=1024)(lambda name, *args: getattr(pages, name)(*args))
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'Microsoft-IIS/7.5'
+    sys_version = ''
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        body = b''
+        if self.command == 'POST':
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path == '/_stats':
+            return self.send_stats()
+        time.sleep(self.server.delay())
+        failure = self.server.failure()
+        if failure == 'reset':
+            with self.server.lock:
+                self.server.resets += 1
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if failure == 'error':
+            with self.server.lock:
+                self.server.errors += 1
+            return self.send(500, '<html><body><h1>Server Error in \'/\' Application.</h1></body></html>')
+        name, route = self.route(url.path)
+        with self.server.lock:
+            self.server.counts[name] += 1
+        if route is None:
+            return self.send(404, '<html><body><h1>404 - File or directory not found.</h1></body></html>')
+        m = _session_regex.match(url.path)
+        if m and self.server.session_ttl:
+            with self.server.lock:
+                issued = self.server.sessions.get(m.group(1))
+            if issued is None or time.monotonic() - issued > self.server.session_ttl:
+                return self.redirect('/WebsiteSSO/PCS/')
+        return route(query, body)
+
+    def route(self, path):
+        """Returns (page name, handler) for a path; handler is None for unknown pages."""
+        m = _session_regex.match(path)
+        if m:
+            page = m.group(2)
+            handler = {'default.aspx': self.emr_start, 'list2.aspx': self.visitlist, 'viewer.aspx': self.viewer,
+                'viewer_v2.aspx': self.viewer_v2, 'tprm3.aspx': self.tprm3, 'NISlist.aspx': self.nislist,
+                'viewReport.aspx': self.viewreport}.get(page)
+            return '/EmrQuery/(S(...))/tree/' + page, handler
+        handler = {'/WebsiteSSO/PCS/': self.login, '/WebsiteSSO/PCS/default.aspx': self.login,
+            '/WebsiteSSO/PCS/showShift.aspx': self.showshift, '/EmrQuery/autologin.aspx': self.autologin,
+            '/iVue/patient.aspx': self.ivue_patient, '/iVue/patientEncounter.aspx': self.ivue_sheet}.get(path)
+        return path, handler
+
+    def send(self, status, content, headers=()):
+        data = content.encode('utf-8')
+        compressed = self.server.compress and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if compressed:
+            data = gzip.compress(data, compresslevel=1)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+        with self.server.lock:
+            self.server.bytes += len(data)
+
+    def send_stats(self):
+        # Neither delayed nor counted, so that polling it doesn't change the numbers
+        data = json.dumps(self.server.stats()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def redirect(self, location, headers=()):
+        self.send(302, '<html><body>Object moved to <a href="%s">here</a>.</body></html>' % location,
+            [('Location', location)] + list(headers))
+
+    ## SSO login
+
+    def login(self, query, body):
+        if self.command == 'GET':
+            return self.send(200, pages.login())
+        form = dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+        # Stale or missing hidden fields are rejected, as ASP.NET would
+        if form.get('__VIEWSTATE') != pages.VIEWSTATE or form.get('__EVENTVALIDATION') != pages.EVENTVALIDATION:
+            return self.send(500, '<html><body><h1>Invalid postback or callback argument.</h1></body></html>')
+        if not form.get('TextBoxId') or not form.get('TextBoxPwd'):
+            return self.send(200, pages.login('帳號或密碼錯誤'))
+        token = secrets.token_hex(16).upper()
+        with self.server.lock:
+            self.server.tokens.add(token)
+        return self.send(200, pages.patientlist(form['TextBoxId']),
+            [('Set-Cookie', '%s=%s; path=/; HttpOnly' % (AUTH_COOKIE, token))])
+
+    def authenticated(self):
+        cookies = http.cookies.SimpleCookie(self.headers.get('Cookie', ''))
+        return AUTH_COOKIE in cookies and cookies[AUTH_COOKIE].value in self.server.tokens
+
+    def autologin(self, query, body):
+        # Without a valid SSO cookie, the user is sent back to the login page
+        if not self.authenticated():
+            return self.redirect('/WebsiteSSO/PCS/')
+        sessionid = ''.join(secrets.choice('abcdefghijklmnopqrstuvwxyz012345') for _ in range(24))
+        with self.server.lock:
+            self.server.sessions[sessionid] = time.monotonic()
+        return self.redirect('/EmrQuery/(S(%s))/tree/default.aspx?chartno=%s' % (sessionid, query.get('chartno', '')))
+
+    ## EmrQuery tree pages (any well-formed session ID is accepted, unless session_ttl is set)
+
+    def emr_start(self, query, body):
+        return self.send(200, pages.autologin(query.get('chartno', '')))
+
+    def visitlist(self, query, body):
+        return self.send(200, _page('visitlist', self.server.visits))
+
+    def viewer(self, query, body):
+        medicalsn = query.get('medicalsn', '')
+        if not re.match(r'^O\d+$', medicalsn):
+            return self.send(404, '<html><body>No record</body></html>')
+        i = int(medicalsn[1:]) - 1000
+        if query.get('type') == 'soap':
+            return self.send(200, _page('soap', i))
+        return self.send(200, _page('opd', i))
+
+    def viewer_v2(self, query, body):
+        medicalsn = query.get('medicalsn', '')
+        if query.get('type') != 'PL' or not re.match(r'^I\d+$', medicalsn):
+            return self.send(404, '<html><body>No record</body></html>')
+        return self.send(200, _page('problemlist', int(medicalsn[1:]) - 1))
+
+    def tprm3(self, query, body):
+        return self.send(200, _page('tprm3', self.server.days))
+
+    def nislist(self, query, body):
+        return self.send(200, _page('nislist', self.server.days))
+
+    def viewreport(self, query, body):
+        # There is no fixture for the admission datasheet (GTYPE=2_1)
+        if 'NDATE' not in query:
+            return self.send(404, '<html><body>No record</body></html>')
+        return self.send(200, _page('viewreport', query['NDATE']))
+
+    ## PCS
+
+    def showshift(self, query, body):
+        return self.send(200, _page('showshift', self.server.orders))
+
+    ## iVue
+
+    def ivue_patient(self, query, body):
+        return self.send(200, _page('ivue_patient'))
+
+    def ivue_sheet(self, query, body):
+        m = re.match(r'^(\d+)-(\d+)-(\d+)$', query.get('Page', ''))
+        if not m:
+            return self.send(404, '<html><body>No record</body></html>')
+        sheet, count = int(m.group(1)), int(m.group(3))
+        if sheet == 1:
+            return self.send(200, _page('ivue_basicinfo'))
+        if sheet == 8:
+            return self.send(200, _page('ivue_handover'))
+        if sheet == 2 and (count - 1) // 12 < self.server.pages:
+            return self.send(200, _page('ivue_tpr', (count - 1) // 12, self.server.pages))
+        return self.send(404, '<html><body>No record</body></html>')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the hisweb and iVue servers, serving pages built from the fixtures",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-H", "--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-P", "--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("-v", "--visits", type=int, default=100, help="Number of outpatient visits in the visit list")
+    parser.add_argument("-d", "--days", type=int, default=7, help="Number of days of nursing records and TPR measurements")
+    parser.add_argument("-g", "--pages", type=int, default=10, help="Number of iVue TPR sheet pages")
+    parser.add_argument("-r", "--orders", type=int, default=50, help="Number of regular and stat orders each")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="Mean delay before each response, in seconds")
+    parser.add_argument("-J", "--jitter", type=float, default=0.0, help="Maximum deviation from the mean delay, in seconds")
+    parser.add_argument("-E", "--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500 error")
+    parser.add_argument("-R", "--reset-rate", type=float, default=0.0, help="Fraction of requests where the connection is dropped")
+    parser.add_argument("-T", "--session-ttl", type=float, default=0.0, help="Seconds after which an EmrQuery session expires (0 for never)")
+    parser.add_argument("-z", "--gzip", action="store_true", help="Gzip responses when the client accepts it")
+    parser.add_argument("-s", "--seed", type=int, help="Seed for the random delays and failures")
+    parser.add_argument("--verbose", action="store_true", help="Log each request")
+    args = parser.parse_args()
+
+    assert args.jitter <= args.latency, "Jitter can't be larger than the mean delay"
+    assert 0 <= args.error_rate + args.reset_rate <= 1, "Error and reset rates must add up to a fraction"
+
+    server = ReplayServer((args.host, args.port), visits=args.visits, days=args.days, pages=args.pages, orders=args.orders,
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, reset_rate=args.reset_rate,
+        compress=args.gzip, session_ttl=args.session_ttl, seed=args.seed, verbose=args.verbose)
+    print("Serving on", server.baseurl, "(iVue at " + server.baseurl + "iVue/); Ctrl-C to stop", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print(json.dumps(server.stats(), indent=2))
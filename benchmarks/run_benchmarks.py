@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+# run_benchmarks.py - offline timings of the parse and render stages of each
+# tool, over pages built from the anonymized fixtures (see pages.py)
+#
+# Results are written as JSON; with --baseline, timings are compared against
+# an earlier run and regressions are reported (exit status 1).
+
+import argparse
+import datetime
+import itertools
+import json
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import bs4
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'tools'))
+import emr_diagnosis
+import emr_diff
+import emr_encounters
+import emr_nursing
+import emr_orders
+import emr_vitals
+import ivue_scraper
+from lib import parse
+
+import pages
+
+VISITS = [1, 10, 100, 1000]
+PAGES = [1, 10, 50, 200]
+
+class Case:
+    """A tool's parse and render stages over pages of a given size.
+
+    Args:
+        unit (str): What the size counts (visits, pages, ...).
+        sizes (list): Sizes to run the case at.
+        make (function): Takes a size and returns the pages the tool would download.
+        parse (function): Takes the pages and returns the parsed data.
+        render (function): Takes the parsed data and an output directory, and writes the tool's output.
+
+    """
+    def __init__(self, unit, sizes, make, parse, render):
+        self.unit = unit
+        self.sizes = sizes
+        self.make = make
+        self.parse = parse
+        self.render = render
+
+## emr_encounters.py
+
+def encounters_render(out, outputdir):
+    o_list, i_list, e_list = out
+    emr_encounters.write_encounters(o_list + i_list + e_list, outputdir, pages.CHARTNO, '2019-01-01', '2020-01-10')
+
+## emr_diagnosis.py
+
+def diagnosis_make(n):
+    return pages.visitlist(n), [pages.opd(i) for i in range(n)], [pages.problemlist(i) for i in range(3)]
+
+def diagnosis_parse(p):
+    visit_list, o_pages, i_pages = p
+    emr_diagnosis.parse_visitlist(visit_list)
+    diagnoses = dict()
+    for v in o_pages:
+        emr_diagnosis.merge_diagnoses(diagnoses, *emr_diagnosis.parse_outpatient(v))
+    for v in i_pages:
+        emr_diagnosis.merge_diagnoses(diagnoses, *emr_diagnosis.parse_inpatient(v))
+    return diagnoses
+
+def diagnosis_render(diagnoses, outputdir):
+    with open(pathlib.Path(outputdir) / 'diag.html', mode='w', encoding='utf-8') as fh:
+        print(emr_diagnosis.render_diagnoses(diagnoses, pages.CHARTNO), file=fh)
+
+## emr_diff.py
+
+def diff_make(n):
+    return pages.visitlist(n), {pages.medicalsn(i): pages.soap(i) for i in range(n)}
+
+def diff_parse(p):
+    visit_list, notes = p
+    d = emr_diff.parse_visitlist(visit_list)
+    return {name: [(sn, emr_diff.parse_note(notes[sn])) for sn in d[name]] for name in d}
+
+def diff_attendings(d, engine='htmldiff'):
+    # Same as emr_diff.diff_attendings() in a full (non-incremental) run, with the notes already fetched
+    render = emr_diff.ENGINES[engine]
+    tables = itertools.count()
+    ids = dict()
+    for name in d:
+        cache = [[], [], [], []]
+        yield name, [render(date, sn, segments, cache, 50, tables, ids) for sn, (date, segments) in d[name] if len(segments) >= 4]
+
+def diff_render(d, outputdir):
+    with open(pathlib.Path(outputdir) / 'diff.html', mode='w', encoding='utf-8') as fh:
+        emr_diff.write_report(fh, pages.CHARTNO, d.keys(), diff_attendings(d))
+
+## emr_nursing.py
+
+def nursing_make(n):
+    return pages.nislist(n), {d: pages.viewreport(d) for d in pages.notedates(n)}
+
+def nursing_parse(p):
+    nislist, sheets = p
+    out_list = list()
+    for notedate in emr_nursing.parse_notedates(nislist):
+        out_list.extend(emr_nursing.parse_events(sheets[notedate], notedate))
+    return out_list
+
+## ivue_scraper.py
+
+def ivue_make(n):
+    return [pages.ivue_tpr(k, n) for k in range(n)], pages.ivue_basicinfo(), pages.ivue_handover()
+
+def ivue_parse(p):
+    tpr_pages, basicinfo, handover = p
+    out = {m: dict() for m in ivue_scraper.MODES}
+    for page in tpr_pages:
+        soup = parse.parse(page, 'ivue')
+        for m in ivue_scraper.TPR_MODES:
+            out[m].update(ivue_scraper.TPR_MODES[m](soup))
+    basicinfo_soup = parse.parse(basicinfo, 'ivue')
+    icuhandover_soup = parse.parse(handover, 'ivue')
+    for m in ivue_scraper.HANDOVER_MODES:
+        out[m] = getattr(ivue_scraper, m)(basicinfo_soup, icuhandover_soup)
+    out['vaccine'] = ivue_scraper.vaccine(icuhandover_soup)
+    return out
+
+def ivue_render(out, outputdir):
+    for m in out:
+        ivue_scraper.writeout(out[m], outputdir, pages.CHARTNO, pages.ENCOUNTERID, m)
+
+CASES = {
+    'encounters': Case('visits', VISITS, pages.visitlist, emr_encounters.parse_encounters, encounters_render),
+    'diagnosis': Case('visits', VISITS, diagnosis_make, diagnosis_parse, diagnosis_render),
+    'diff': Case('visits', VISITS, diff_make, diff_parse, diff_render),
+    'vitals': Case('days', PAGES, pages.tprm3, emr_vitals.parse_vitals,
+        lambda out, outputdir: emr_vitals.write_vitals(out, outputdir, pages.CHARTNO)),
+    'nursing': Case('days', PAGES, nursing_make, nursing_parse,
+        lambda out, outputdir: emr_nursing.write_nursing(out, outputdir, pages.CHARTNO, pages.ENCOUNTERID)),
+    'orders': Case('orders', VISITS, pages.showshift, emr_orders.parse_orders,
+        lambda out, outputdir: emr_orders.write_orders(out, outputdir, pages.CHARTNO)),
+    'ivue': Case('pages', PAGES, ivue_make, ivue_parse, ivue_render),
+}
+
+def timed(repeat, function, *args):
+    """Calls function repeat times and returns (list of run times in seconds, last return value)."""
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = function(*args)
+        times.append(time.perf_counter() - start)
+    return times, out
+
+def run(cases, repeat, maxsize=None, debug=False):
+    """Runs the named cases and returns a list of result dicts."""
+    results = list()
+    with tempfile.TemporaryDirectory() as outputdir:
+        for name in cases:
+            case = CASES[name]
+            for size in case.sizes:
+                if maxsize and size > maxsize:
+                    continue
+                p = case.make(size)
+                for stage in ('parse', 'render'):
+                    if stage == 'parse':
+                        times, out = timed(repeat, case.parse, p)
+                    else:
+                        times, _ = timed(repeat, case.render, out, outputdir)
+                    results.append({'case': name, 'stage': stage, 'unit': case.unit, 'size': size,
+                        'median_s': statistics.median(times), 'min_s': min(times), 'runs': repeat})
+                    if debug:
+                        print('[DEBUG]', name, stage, size, case.unit, '%.4f s' % results[-1]['median_s'], file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Returns the results whose median is more than tolerance (fraction) slower than in the baseline."""
+    old = {(r['case'], r['stage'], r['size']): r['median_s'] for r in baseline['results']}
+    regressions = list()
+    for r in results:
+        before = old.get((r['case'], r['stage'], r['size']))
+        if before and r['median_s'] > before * (1 + tolerance):
+            regressions.append(dict(r, baseline_s=before))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the parse and render stages of each tool",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--debug", action="store_true", help="Print timings as they are taken")
+    parser.add_argument("-c", "--case", nargs="+", choices=list(CASES), default=list(CASES), help="Cases to run")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="Number of timed runs per stage and size (the median is reported)")
+    parser.add_argument("-m", "--maxsize", type=int, help="Skip sizes above this")
+    parser.add_argument("-b", "--backend", choices=parse.BACKENDS, default=parse.BACKEND, help="Parser backend")
+    parser.add_argument("-o", "--output", type=str, help="Write results to this file instead of standard output")
+    parser.add_argument("--baseline", type=str, help="Results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Slowdown (fraction of the baseline time) reported as a regression")
+    args = parser.parse_args()
+
+    assert args.repeat > 0, "Number of runs must be positive"
+
+    parse.configure(args.backend)
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'bs4': bs4.__version__,
+        'backend': args.backend,
+        'results': run(args.case, args.repeat, args.maxsize, args.debug),
+    }
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, mode='r', encoding='utf-8') as fh:
+            regressions = compare(report['results'], json.load(fh), args.tolerance)
+        for r in regressions:
+            print("[Regression] {case} {stage} at {size} {unit}: {median_s:.4f} s (baseline {baseline_s:.4f} s)".format(**r), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
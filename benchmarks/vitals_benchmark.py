@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+# vitals_benchmark.py - time to load the vital signs of an ICU stay and take
+# the last day of them, from the CSV files ivue_scraper.py writes (one per
+# mode, parsed back into numbers) vs. the columnar vitals store
+# (lib/vitalstore.py), and to resample them to hourly means from the store
+
+# Initially created in October 2026
+
+import argparse
+import csv
+import datetime
+import json
+import math
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'tools'))
+from lib import vitalstore
+
+import pages
+
+DAYS = [7, 30, 90]
+MODES = ['temp', 'hr', 'rr']
+
+def make(days, interval):
+    """Measurements every interval minutes over the given number of days up to pages.LASTDAY, as {mode: {datetime: str}} (as from ivue_scraper.py)."""
+    end = datetime.datetime.combine(pages.LASTDAY, datetime.time(0))
+    out = {mode: dict() for mode in MODES}
+    for k in range(days * 24 * 60 // interval):
+        t = end - datetime.timedelta(minutes=interval * k)
+        # Temperature is taken less often
+        if k % 4 == 0:
+            out['temp'][t] = '%0.1f(耳溫)' % (36 + (k % 15) / 10)
+        out['hr'][t] = str(110 + k % 40)
+        out['rr'][t] = str(25 + k % 15)
+    return out
+
+def write_csv(out, outputdir):
+    # As ivue_scraper.writeout() writes them
+    for mode in MODES:
+        with open(outputdir / (pages.CHARTNO + '_' + pages.ENCOUNTERID + '_icu_' + mode + '.csv'), mode='w', encoding='utf-8', newline='') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(['Date', 'Event'])
+            for t in sorted(out[mode]):
+                writer.writerow([t, out[mode][t]])
+
+def write_store(out, outputdir):
+    rows = dict()
+    for mode in MODES:
+        for t, v in out[mode].items():
+            rows.setdefault(t, dict())[mode] = v
+    vitalstore.VitalStore(pages.CHARTNO, path=outputdir / 'store').add(rows.items())
+
+def load_csv(outputdir, start):
+    # Every file is read and parsed, then the rows from start on are kept
+    out = dict()
+    for mode in MODES:
+        with open(outputdir / (pages.CHARTNO + '_' + pages.ENCOUNTERID + '_icu_' + mode + '.csv'), mode='r', encoding='utf-8', newline='') as fh:
+            rows = [(datetime.datetime.fromisoformat(r['Date']), vitalstore.value(r['Event'])) for r in csv.DictReader(fh)]
+        out[mode] = [(t, x) for t, x in rows if t >= start]
+    return sum(len(x) for x in out.values())
+
+def load_store(outputdir, start):
+    times, values = vitalstore.VitalStore(pages.CHARTNO, path=outputdir / 'store').slice(start, channels=MODES)
+    return sum(1 for mode in MODES for x in values[mode] if not math.isnan(x))
+
+def resample_store(outputdir, start):
+    times, values = vitalstore.VitalStore(pages.CHARTNO, path=outputdir / 'store').resample(3600, channels=MODES)
+    return len(times)
+
+READERS = {
+    'csv': load_csv,
+    'store': load_store,
+    'resample': resample_store,
+}
+
+def measure(reader, outputdir, start, repeat):
+    """Reads repeatedly and returns (median seconds, values read)."""
+    times = list()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        n = reader(outputdir, start)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times), n
+
+def run(sizes, interval, readers, repeat):
+    """Benchmarks each reader at each length of stay (in days) and returns a list of result dicts."""
+    results = list()
+    start = datetime.datetime.combine(pages.LASTDAY, datetime.time(0)) - datetime.timedelta(days=1)
+    for days in sizes:
+        with tempfile.TemporaryDirectory() as outputdir:
+            outputdir = pathlib.Path(outputdir)
+            out = make(days, interval)
+            write_csv(out, outputdir)
+            write_store(out, outputdir)
+            size = {'csv': sum(p.stat().st_size for p in outputdir.glob('*.csv')),
+                'store': sum(p.stat().st_size for p in (outputdir / 'store').iterdir())}
+            for name in readers:
+                seconds, n = measure(READERS[name], outputdir, start, repeat)
+                results.append({'days': days, 'interval': interval, 'reader': name, 'seconds': seconds, 'values': n,
+                    'bytes': size['csv' if name == 'csv' else 'store']})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load time of the vital signs of an ICU stay, CSV files vs. the vitals store",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-d", "--days", type=int, nargs="+", default=DAYS, help="Lengths of stay (in days) to benchmark")
+    parser.add_argument("-i", "--interval", type=int, default=5, help="Minutes between measurements")
+    parser.add_argument("-r", "--reader", nargs="+", choices=list(READERS), default=list(READERS), help="Readers to compare")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="Number of timed runs per size (the median is reported)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON instead of a table")
+    args = parser.parse_args()
+
+    assert args.repeat > 0, "Number of runs must be positive"
+    assert args.interval > 0, "Interval must be positive"
+
+    results = run(args.days, args.interval, args.reader, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:>5} {:<9} {:>10} {:>8} {:>10}".format("Days", "Reader", "ms", "Values", "KiB"))
+        for r in results:
+            print("{:>5} {:<9} {:>10.1f} {:>8} {:>10.1f}".format(r['days'], r['reader'],
+                r['seconds'] * 1000, r['values'], r['bytes'] / 1024))
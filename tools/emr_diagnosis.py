@@ -9,15 +9,170 @@
 
 import argparse
 import datetime
+import json
 import os
 import pathlib
 import re
 import sys
-import urllib.request
-
-import bs4
 
+from lib import batch
+from lib import client
+from lib import metrics
+from lib import parse
+from lib import progress
 from lib import session
+from lib import visitlist
+
+# Build regexes
+date_regex = re.compile("\d{4}/\d{2}/\d{2} \d{2}:\d{2}")
+## 'O' prefix for outpatient, 'I' prefix for inpatient, 'E' prefix for ED
+o_regex = re.compile("^((?!type).)*medicalsn=(O.+)$") # TODO: consider changing this to grab the diagnosis subpage only
+i_regex = re.compile("type=PL.+medicalsn=(I.+)$") # TODO: design better regex here?
+#e_regex = re.compile("^((?!type).)*medicalsn=(E.+)$") # ED records of limited utility due to being based on (possibly improper) ICD-10 codes
+## Regex for name of attending. The spaces on either end are '\xa0' symbols (non-breaking spaces), as parsed from the HTML "&nbsp;". Digit on the front is from the date.
+n_regex = re.compile("[0-9]\xa0(.+)\xa0.+$")
+
+def parse_visitlist(visit_list):
+    """Parses the visit list page (list2.aspx) into lists of links to outpatient and inpatient (problem list) visit pages."""
+    return visit_links(visitlist.parse_visits(visit_list))
+
+def visit_links(visits):
+    """Returns lists of links to the outpatient and inpatient (problem list) visit pages of visits (see lib/visitlist.py)."""
+    links = [i for v in visits for i in v["links"]]
+    #e_visits = [i for i in links if e_regex.search(i)]
+    return [i for i in links if o_regex.search(i)], [i for i in links if i_regex.search(i)]
+
+def parse_outpatient(v):
+    """Parses an outpatient visit page into its date, attending physician and list of diagnoses."""
+    date = re.search(date_regex, v).group()
+    d = parse.parse(v, 'opd').findChildren('p')[1]
+    #o_diagnoses = [re.search('\W?\d+[.](.+)$',i).groups()[0] for i in d.strings if re.search('\W?\d+[.](.+)$', i) != None]
+    o_diagnoses = [i for i in d.strings]
+    o_diagnoses.pop(0)
+    attending = re.search('醫師 : (.+?)\W', v).groups()[0]
+    return date, attending, o_diagnoses
+
+def parse_inpatient(v):
+    """Parses an inpatient problem list page into its date, attending physician and list of diagnoses.
+
+    Raises:
+        AttributeError if the page has no date.
+
+    """
+    ## Also worth noting: problem list can actually be empty (!) for certain old visits
+    date = re.search(date_regex, v).group()
+    i_diagnoses = [i.text for i in parse.parse(v, 'problemlist').findChildren('td',attrs={'width':''})[4:]]
+    attending = re.search('醫師 : (.+?)\W', v).groups()[0]
+    return date, attending, i_diagnoses
+
+def merge_diagnoses(diagnoses, date, attending, new):
+    """Adds diagnoses from one visit to a dict of diagnosis: (date, attending), keeping the earliest date."""
+    for j in new:
+        if j in diagnoses.keys() and diagnoses[j][0] < date:
+            continue
+        else:
+            diagnoses[j] = (date, attending)
+
+def stale(visits, href, today):
+    """Whether a visit page has to be fetched (again), given the stored visits (see main) and today's date (datetime.date).
+
+    Pages of past visits don't change, but a visit of the last few days (as
+    in lib/visitlist.py) may still be written and the problem list of a
+    current stay ('iviewer' rather than 'viewer_v2') changes during the stay.
+    """
+    settled = (today - datetime.timedelta(days=visitlist.RECENT_DAYS)).isoformat()
+    return href not in visits or "iviewer" in href or visits[href][0][:10].replace("/", "-") > settled
+
+def render_diagnoses(diagnoses, chartno):
+    """Renders a dict of diagnoses (see merge_diagnoses()) as an HTML report sorted by date."""
+    # Change diagnoses from dict to list; list of tuples of the form (diagnosis, date, attending)
+    diagnoses = [(i, diagnoses[i][0], diagnoses[i][1]) for i in diagnoses.keys()]
+
+    # Sort by date
+    diagnoses.sort(key=lambda x: x[1])
+
+    html_out = "<html lang='en'>\n<head>\n  <meta charset='utf-8'>\n  <title>Diagnosis log for {patient}</title>\n</head>\n<body>\n".format(patient=chartno)
+    js = ""
+    table_head = "  <table>\n    <tr>\n      <th>Diagnosis</th><th>Date</th><th>Attending physician</th>\n"
+    table_content = ""
+    table_footer = "  </table>\n</body>\n</html>"
+    for i in diagnoses:
+        table_content = table_content + "      <tr><td>" + i[0] + "</td><td>" + i[1] + "</td><td>" + i[2] + "</td></tr>\n"
+    return html_out + table_head + table_content + table_footer
+
+def diagnose_patient(args, rooturl, chartno):
+    """Fetches the visits of a patient and writes the report of diagnoses (options as in main); returns its path."""
+    # Get list of visits (only the days not cached from earlier runs are fetched)
+    progress.report("visit list")
+    o_visits, i_visits = visit_links(visitlist.get_visits(rooturl, chartno, args.startdate, args.enddate, args.debug))
+
+    # Visits processed in earlier runs: link of the visit page: (date,
+    # attending, list of diagnoses), so that an incremental run only has to
+    # fetch the pages of new visits. The state is only read and written with
+    # --incremental.
+    statepath = session.STATEDIR / (session.statekey(rooturl, chartno) + "_diag.json")
+    visits = dict()
+    if args.incremental:
+        try:
+            with open(statepath, mode="r", encoding="utf-8") as fh:
+                visits = json.load(fh)["visits"]
+        except (OSError, ValueError, KeyError):
+            pass
+    today = datetime.date.today()
+    o_fetch = [i for i in o_visits if stale(visits, i, today)]
+    i_fetch = [i for i in i_visits if stale(visits, i, today)]
+    if args.debug:
+        print("[DEBUG] Visits stored:", len(o_visits) + len(i_visits) - len(o_fetch) - len(i_fetch), file=sys.stderr)
+
+    # Visit pages are fetched concurrently, but come back in the order of the
+    # visit list
+
+    # Outpatient visits #
+    progress.report("outpatient visits", 0, len(o_fetch))
+    for k, (i, v) in enumerate(zip(o_fetch, client.fetch_many([rooturl+i for i in o_fetch], args.maxconn))):
+        visits[i] = parse_outpatient(v)
+        progress.report("outpatient visits", k + 1, len(o_fetch))
+
+    # Inpatient visits #
+    ## Worth noting that 'viewer_v2' seems to be for a past inpatient stay while 'iviewer' is for a current stay
+    progress.report("inpatient visits", 0, len(i_fetch))
+    for k, (i, v) in enumerate(zip(i_fetch, client.fetch_many([rooturl+i for i in i_fetch], args.maxconn))):
+        progress.report("inpatient visits", k + 1, len(i_fetch))
+        try:
+            visits[i] = parse_inpatient(v)
+        except AttributeError:
+            print(v)
+            print("[Error] ISO8601-formatted date not found", file=sys.stderr)
+            continue
+
+    if args.incremental:
+        session.STATEDIR.mkdir(exist_ok=True)
+        # Written to a temporary file first, so that a run cut short leaves the state as it was
+        tmppath = statepath.with_name(statepath.name + ".%d.tmp" % os.getpid())
+        with open(tmppath, mode="w", encoding="utf-8") as fh:
+            json.dump({"visits": visits}, fh, ensure_ascii=False)
+        os.replace(tmppath, statepath)
+
+    # First appearances are merged in the order of the visit list, the same
+    # as fetching every visit, from the stored diagnoses of each visit
+    diagnoses = dict()
+    for i in o_visits + i_visits:
+        if i in visits:
+            merge_diagnoses(diagnoses, *visits[i])
+
+    # Emergency department visits #
+    ## Doubts about finishing this part since it is of limited utility
+    #for i in e_visits:
+        # ...
+
+    progress.report("writing")
+    html_out = render_diagnoses(diagnoses, chartno)
+
+    # Note that the default encoding on other OSs may not be UTF-8
+    outpath = pathlib.Path(args.outputdir) / (chartno + "_diag_" + args.startdate + "_" + args.enddate + ".html")
+    with open(outpath, mode="w", encoding="utf-8") as fh:
+        print(html_out, file=fh)
+    return outpath
 
 if __name__ == '__main__':
     # Change working directory to location of this script
@@ -30,18 +185,29 @@ if __name__ == '__main__':
     parser.add_argument("--debug", action="store_true", help="Print debug info")
     parser.add_argument("-u", "--uid", type=str, required=True, help="User ID")
     parser.add_argument("-p", "--passwd", type=str, required=True, help="Password")
-    parser.add_argument("-c", "--chartno", type=str, required=True, help="Chart number")
+    patients = parser.add_mutually_exclusive_group(required=True)
+    patients.add_argument("-c", "--chartno", type=str, help="Chart number")
+    patients.add_argument("-f", "--chartnofile", type=str, help="File containing chart numbers, one on each line (one report per patient and an index are written)")
     parser.add_argument("-s", "--startdate", type=str, help="Starting date in ISO8601 format", default="2019-01-01")
     parser.add_argument("-e", "--enddate", type=str, help="Ending date in ISO8601 format (defaults to today)", default=datetime.date.today().isoformat())
     ## TODO: modify HTML output to include sorting within page
     #parser.add_argument("-r", "--reverse", action="store_true", help="Reverse output chronology")
+    parser.add_argument("-i", "--incremental", action="store_true", help="Only fetch visits not processed in earlier runs (diagnoses of processed visits are kept in the 'state' directory)")
+    parser.add_argument("-j", "--maxconn", type=int, help="Maximum number of concurrent requests to the EMR server (and of patients processed at the same time with --chartnofile)", default=client.POOLSIZE)
     parser.add_argument("-o", "--outputdir", type=str, help="Set output directory", default=pathlib.Path.cwd().parent / 'cache')
+    parser.add_argument("--baseurl", type=str, help="Base URL of the hisweb server (e.g. a local test server)", default=session.BASEURL)
+    parser.add_argument("--metrics", type=str, help="Write request/parse timings to this file (Prometheus textfile if it ends in .prom, otherwise appended as JSON lines)")
     parser.add_argument("--version", action="version", version="%(prog)s 0.2.1 'Annihilation'")
     args = parser.parse_args()
+    metrics.setup(args)
 
     # Input validation
     assert re.match('\d{6}', args.uid), "ID number malformed (less than 6 digits)"
-    assert re.match('\d{8}', args.chartno), "Chart number malformed (less than 8 digits)"
+    if args.chartnofile:
+        chartnos = batch.read_chartnos(args.chartnofile)
+    else:
+        assert re.match('\d{8}', args.chartno), "Chart number malformed (less than 8 digits)"
+    assert args.maxconn > 0, "Number of concurrent requests must be positive"
     try:
         datetime.datetime.strptime(args.startdate, '%Y-%m-%d')
     except ValueError:
@@ -53,89 +219,18 @@ if __name__ == '__main__':
 
     if args.debug:
         print("[DEBUG] UID: ", args.uid, file=sys.stderr)
-        print("[DEBUG] Chart number: ", args.chartno, file=sys.stderr)
+        print("[DEBUG] Chart number: ", args.chartno or args.chartnofile, file=sys.stderr)
         print("[DEBUG] Start date: ", args.startdate, file=sys.stderr)
         print("[DEBUG] End date: ", args.enddate, file=sys.stderr)
 
-    ROOTURL = "http://hisweb.hosp.ncku/EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
-
-    # Get list of visits
-
-    visit_list_url = "list2.aspx?" + "chartno=" + args.chartno + "&start=" + args.startdate + "&stop=" + args.enddate + "&query=0"
-    with urllib.request.urlopen(ROOTURL + visit_list_url) as f:
-        visit_list = f.read().decode("utf-8")
-
-    # Build regexes
-    date_regex = re.compile("\d{4}/\d{2}/\d{2} \d{2}:\d{2}")
-    ## 'O' prefix for outpatient, 'I' prefix for inpatient, 'E' prefix for ED
-    o_regex = re.compile("^((?!type).)*medicalsn=(O.+)$") # TODO: consider changing this to grab the diagnosis subpage only
-    i_regex = re.compile("type=PL.+medicalsn=(I.+)$") # TODO: design better regex here?
-    #e_regex = re.compile("^((?!type).)*medicalsn=(E.+)$") # ED records of limited utility due to being based on (possibly improper) ICD-10 codes
-    ## Regex for name of attending. The spaces on either end are '\xa0' symbols (non-breaking spaces), as parsed from the HTML "&nbsp;". Digit on the front is from the date.
-    n_regex = re.compile("[0-9]\xa0(.+)\xa0.+$")
-    
-    visit_list_soup = bs4.BeautifulSoup(visit_list, "html.parser")
-    o_visits = visit_list_soup.find_all("a", href=o_regex)
-    i_visits = visit_list_soup.find_all("a", href=i_regex)
-    #e_visits = visit_list_soup.find_all("a", href=e_regex)
-
-    diagnoses = dict()
-
-    # Outpatient visits #
-    for i in o_visits:
-        v = urllib.request.urlopen(ROOTURL+i.attrs['href']).read().decode('utf-8')
-        date = re.search(date_regex, v).group()
-        d = bs4.BeautifulSoup(v, 'html.parser').findChildren('p')[1]
-        #o_diagnoses = [re.search('\W?\d+[.](.+)$',i).groups()[0] for i in d.strings if re.search('\W?\d+[.](.+)$', i) != None]
-        o_diagnoses = [i for i in d.strings]
-        o_diagnoses.pop(0)
-        attending = re.search('醫師 : (.+?)\W', v).groups()[0]
-        for j in o_diagnoses:
-            if j in diagnoses.keys() and diagnoses[j][0] < date:
-                continue
-            else:
-                diagnoses[j] = (date, attending)
-
-    # Inpatient visits #
-    ## Worth noting that 'viewer_v2' seems to be for a past inpatient stay while 'iviewer' is for a current stay
-    ## Also worth noting: problem list can actually be empty (!) for certain old visits
-    for i in i_visits:
-        v = urllib.request.urlopen(ROOTURL+i.attrs['href']).read().decode('utf-8')
-        try:
-            date = re.search(date_regex, v).group()
-        except AttributeError:
-            print(v)
-            print("[Error] ISO8601-formatted date not found", file=sys.stderr)
-            continue
-        i_diagnoses = [i.text for i in bs4.BeautifulSoup(v, 'html.parser').findChildren('td',attrs={'width':''})[4:]]
-        attending = re.search('醫師 : (.+?)\W', v).groups()[0]
-        for j in i_diagnoses:
-            if j in diagnoses.keys() and diagnoses[j][0] < date:
-                continue
-            else:
-                diagnoses[j] = (date, attending)
-
-    # Emergency department visits #
-    ## Doubts about finishing this part since it is of limited utility
-    #for i in e_visits:
-        # ...
-
-    # Change diagnoses from dict to list; list of tuples of the form (diagnosis, date, attending)
-    diagnoses = [(i, diagnoses[i][0], diagnoses[i][1]) for i in diagnoses.keys()]
-
-    # Sort by date
-    diagnoses.sort(key=lambda x: x[1])
+    client.configure(poolsize=args.maxconn)
 
-    html_out = "<html lang='en'>\n<head>\n  <meta charset='utf-8'>\n  <title>Diagnosis log for {patient}</title>\n</head>\n<body>\n".format(patient=args.chartno)
-    js = ""
-    table_head = "  <table>\n    <tr>\n      <th>Diagnosis</th><th>Date</th><th>Attending physician</th>\n"
-    table_content = ""
-    table_footer = "  </table>\n</body>\n</html>"
-    for i in diagnoses:
-        table_content = table_content + "      <tr><td>" + i[0] + "</td><td>" + i[1] + "</td><td>" + i[2] + "</td></tr>\n"
-    html_out = html_out + table_head + table_content + table_footer 
+    progress.report("login")
+    if args.chartnofile:
+        # One login for all patients; at most args.maxconn patients at a time
+        results = batch.run(chartnos, lambda chartno: diagnose_patient(args, batch.patient_rooturl(args, chartno), chartno), args.maxconn, args.debug)
+        batch.write_index(results, args.outputdir, "emr_diagnosis.py", "diag", args.startdate, args.enddate)
+        sys.exit(1 if any(error for _, _, error in results) else 0)
 
-    # Note that the default encoding on other OSs may not be UTF-8
-    outpath = pathlib.Path(args.outputdir) / (args.chartno + "_diag_" + args.startdate + "_" + args.enddate + ".html")
-    with open(outpath, mode="w", encoding="utf-8") as fh:
-        print(html_out, file=fh)
+    ROOTURL = session.get_baseurl(args) + "EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
+    diagnose_patient(args, ROOTURL, args.chartno)
@@ -10,15 +10,336 @@
 import argparse
 import difflib
 import datetime
+import html
+import itertools
+import json
 import os
 import pathlib
 import re
 import sys
-import urllib.request
 
-import bs4
+import jinja2
 
+from lib import batch
+from lib import client
+from lib import metrics
+from lib import noteindex
+from lib import parse
+from lib import progress
 from lib import session
+from lib import visitlist
+
+## 'O' prefix for outpatient, 'I' prefix for inpatient
+o_regex = re.compile("^((?!type).)*medicalsn=(O.+)$")
+date_regex = re.compile("\d{4}/\d{2}/\d{2} \d{2}:\d{2}")
+# TODO: Build a mechanism for selecting which parts to calculate a delta on
+segment_names = ("Subjective", "Objective", "Diagnosis", "Assessment & Plan")
+
+def parse_visitlist(visit_list):
+    """Parses the visit list page (list2.aspx) into a dict of attending: sorted list of outpatient visit IDs ('medicalsn')."""
+    return group_visits(visitlist.parse_visits(visit_list))
+
+def group_visits(visits):
+    """Sorts outpatient visits (see lib/visitlist.py) into a dict of attending: sorted list of visit IDs ('medicalsn')."""
+    # Put the ID of each visit ("medicalsn") into bins based on name of attending
+    d = dict()
+    for v in visits:
+        for i in v["links"]:
+            if not o_regex.search(i):
+                continue
+            ## No autovivification in Python...
+            if v["attending"] not in d.keys():
+                d[v["attending"]] = []
+            d[v["attending"]].append(re.search(o_regex, i).groups()[1])
+    for i in d.keys():
+        d[i] = set(d[i])
+        d[i] = list(d[i])
+        d[i].sort()
+    return d
+
+def parse_note(n):
+    """Parses an OPD note (viewer.aspx?type=soap) into the time of visit and the lines of each segment of the note."""
+    note = parse.parse(n, "soap")
+    # Get time of visit from header
+    header = note.find(attrs={"class":"portlet-header"})
+    date = re.search(date_regex, header.text).group()
+    main_text = note.find(attrs={"class":"portlet-content"}).findChildren(attrs={"class":"small"})
+    # Subjective: main_text[0], objective: main_text[1], assessment: main_text[2], plan: main_text[3]
+    # (main_text[4] contains lab tests but this is more clearly expressed and worked on with the relevant LIS tools)
+    return date, [[x for x in m.stripped_strings] for m in main_text]
+
+class _HtmlDiff(difflib.HtmlDiff):
+    # HtmlDiff numbers its tables (and the IDs in them) by a counter shared
+    # by all instances, which patients diffed at the same time would share;
+    # tables are numbered by a counter of the report instead
+    def __init__(self, tables, **kwargs):
+        super().__init__(**kwargs)
+        self._tables = tables
+
+    def _make_prefix(self):
+        n = next(self._tables)
+        self._prefix = ["from%d_" % n, "to%d_" % n]
+
+def render_visit(date, medicalsn, segments, cache, wraplen, tables=None, ids=None):
+    """Renders the diffs of a note (see parse_note()) against the previous note, whose segments are kept in cache (updated in place).
+
+    Tables are numbered by tables (an iterator of int, e.g. itertools.count()), which should be one per report
+    (ids is unused, see render_visit_compact()).
+    """
+    if tables is None:
+        tables = itertools.count()
+    diff = "\n  <p><h3>Visit at {date} (medicalsn {medicalsn})</h3></p>\n".format(date=date, medicalsn=medicalsn)
+    # Pseudocode:
+    #if d not in [i[0] for i in diagnosis]:
+    #    diagnosis.append([d, name, date])
+    for i in (2,0,1,3):
+        segment = segments[i]
+        #print("=== ", segment_names[i], " ===")
+        #for j in difflib.ndiff(cache[i], segment):
+        #    print(j)
+        u = _HtmlDiff(tables, tabsize=4, wrapcolumn=wraplen)
+        diff += "  <p><h4>{s}</h4></p>\n".format(s=segment_names[i])
+        diff += u.make_table(cache[i], segment, context=True, numlines=3)
+        cache[i] = segment
+    return diff
+
+# Lines are replaced by small integers before diffing, so that
+# SequenceMatcher hashes and compares integers instead of long lines. The
+# table of IDs (line: ID) is kept for one report (see diff_attendings()),
+# as the same lines come up again note after note.
+def _ids(lines, ids):
+    out = list()
+    for x in lines:
+        i = ids.get(x)
+        if i is None:
+            i = ids[x] = len(ids)
+        out.append(i)
+    return out
+
+def _inline(old, new):
+    # Renders a changed line with the changed characters marked, or returns
+    # None if the lines have too little in common for that to help
+    sm = difflib.SequenceMatcher(None, old, new)
+    if sm.real_quick_ratio() < 0.5 or sm.quick_ratio() < 0.5 or sm.ratio() < 0.5:
+        return None
+    out = ["<div class='c'>"]
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        if tag == "equal":
+            out.append(html.escape(old[i1:i2]))
+            continue
+        if tag in ("delete", "replace"):
+            out.append("<del>" + html.escape(old[i1:i2]) + "</del>")
+        if tag in ("insert", "replace"):
+            out.append("<ins>" + html.escape(new[j1:j2]) + "</ins>")
+    out.append("</div>")
+    return "".join(out)
+
+def render_lines(old, new, context=3, ids=None):
+    """Renders the changes from one list of lines to another as compact HTML.
+
+    Added and removed lines are shown whole, changed lines with the changed
+    characters marked, and unchanged lines only as context (up to context
+    lines around each change). ids (dict) is the table of line IDs to use,
+    one per report.
+    """
+    if ids is None:
+        ids = dict()
+    a, b = _ids(old, ids), _ids(new, ids)
+    if a == b:
+        return "  <p class='same'>(no changes)</p>\n"
+    out = ["  <div class='diff'>"]
+    opcodes = difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+    for k, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+        if tag == "equal":
+            # Context after the previous change and before the next one
+            head = context if k > 0 else 0
+            tail = context if k < len(opcodes) - 1 else 0
+            # (a single line is shown rather than skipped)
+            if head + tail + 1 >= j2 - j1:
+                out.extend("<div>" + html.escape(x) + "</div>" for x in new[j1:j2])
+                continue
+            out.extend("<div>" + html.escape(x) + "</div>" for x in new[j1:j1 + head])
+            out.append("<div class='s'>&#8942; {n} unchanged lines</div>".format(n=j2 - j1 - head - tail))
+            out.extend("<div>" + html.escape(x) + "</div>" for x in new[j2 - tail:j2])
+            continue
+        if tag == "replace":
+            # Lines replaced one for one are shown as changed lines where possible
+            for x, y in zip(old[i1:i2], new[j1:j2]):
+                changed = _inline(x, y)
+                if changed:
+                    out.append(changed)
+                else:
+                    out.append("<div class='d'>" + html.escape(x) + "</div>")
+                    out.append("<div class='a'>" + html.escape(y) + "</div>")
+            n = min(i2 - i1, j2 - j1)
+            i1, j1 = i1 + n, j1 + n
+        out.extend("<div class='d'>" + html.escape(x) + "</div>" for x in old[i1:i2])
+        out.extend("<div class='a'>" + html.escape(x) + "</div>" for x in new[j1:j2])
+    out.append("</div>\n")
+    return "".join(out)
+
+def render_visit_compact(date, medicalsn, segments, cache, wraplen=None, tables=None, ids=None):
+    """Same as render_visit(), but with the compact markup of render_lines() instead of difflib.HtmlDiff tables (wraplen and tables are unused; ids is the table of line IDs of the report, see render_lines())."""
+    diff = ["\n  <p><h3>Visit at {date} (medicalsn {medicalsn})</h3></p>\n".format(date=date, medicalsn=medicalsn)]
+    for i in (2,0,1,3):
+        diff.append("  <p><h4>{s}</h4></p>\n".format(s=segment_names[i]))
+        diff.append(render_lines(cache[i], segments[i], ids=ids))
+        cache[i] = segments[i]
+    return "".join(diff)
+
+# Diff renderers selectable with --engine
+ENGINES = {"compact": render_visit_compact, "htmldiff": render_visit}
+
+def settled(date, today):
+    """Whether a note (date as in parse_note()) is old enough not to change any more (as in lib/visitlist.py)."""
+    return date[:10].replace("/", "-") <= (today - datetime.timedelta(days=visitlist.RECENT_DAYS)).isoformat()
+
+def diff_attendings(rooturl, chartno, d, state, engine="htmldiff", wraplen=50, reverse=False, partial=None, index=None, debug=False):
+    """Fetches the notes of each attending and renders the diff of each note against the previous one.
+
+    Notes are fetched as the results are consumed, so the report can be
+    written out as it is made (see write_report()).
+
+    Args:
+        rooturl (str): EmrQuery URL including the session ID.
+        chartno (str): Chart number.
+        d (dict): Attending: list of visit IDs, as returned by parse_visitlist().
+        state (dict): Rendered diffs and last note segments from earlier runs, and the number of the next
+            table of the report (updated in place; notes that may still change are left out, see settled()).
+        engine (str): Key of ENGINES.
+        wraplen (int): Table wrap length for the 'htmldiff' engine.
+        reverse (bool): List the diffs of each attending newest first.
+        partial (str) [optional]: Name of the partial report, given with the progress reports.
+        index (lib.noteindex.NoteIndex) [optional]: Full-text index the notes fetched are added to
+            (notes with stored diffs are fetched for it if missing).
+        debug (bool): Print debug info.
+
+    Yields:
+        tuple: (name of attending, list of rendered diffs)
+
+    """
+    render = ENGINES[engine]
+    tables = itertools.count(state["tables"])
+    # Line IDs of the compact engine, for this report only
+    ids = dict()
+    today = datetime.date.today()
+    notes_done = 0
+    notes_total = sum(len(d[name]) for name in d)
+    progress.report("notes", notes_done, notes_total)
+    for name in d.keys():
+        print(("### Notes for Dr. " + name + " ###").encode('utf-8'))
+        d[name].sort()
+        # Comparing all components
+        cache = [[],[],[],[]] # cache for note
+        stored = state["attendings"].get(name)
+        if stored:
+            done = {x["medicalsn"]: x["diff"] for x in stored["visits"]}
+            # A visit older than the newest stored one (e.g. after moving the
+            # start date back) breaks the chain of diffs, so start over then
+            if any(x not in done and x < stored["visits"][-1]["medicalsn"] for x in d[name]):
+                stored = None
+            else:
+                cache = list(stored["cache"])
+        if not stored:
+            done = dict()
+            stored = state["attendings"][name] = {"visits": [], "cache": list(cache)}
+        # Notes from the last few days may still be written, so neither they
+        # nor the notes after them are stored (they are fetched again next run)
+        storing = True
+        diffs = list()
+        for v in range(0,len(d[name])):
+            notes_done += 1
+            if d[name][v] in done:
+                diff = done[d[name][v]]
+                if debug:
+                    print("[DEBUG] Using stored diff for medicalsn", d[name][v], file=sys.stderr)
+                if diff is not None:
+                    diffs.append(diff)
+                if index is not None and not index.has(d[name][v]):
+                    n = client.urlopen(rooturl+"viewer.aspx?type=soap"+"&chartno="+chartno+"&medicalsn="+d[name][v]).read().decode("utf-8")
+                    date, segments = parse_note(n)
+                    index.add(d[name][v], date, name, list(zip(segment_names, segments)))
+                continue
+            n = client.urlopen(rooturl+"viewer.aspx?type=soap"+"&chartno="+chartno+"&medicalsn="+d[name][v]).read().decode("utf-8")# fetch note
+            date, segments = parse_note(n)
+            if index is not None:
+                index.add(d[name][v], date, name, list(zip(segment_names, segments)))
+            print("=== Visit at " + date + " (medicalsn", d[name][v], ") ===")
+            progress.report("notes", notes_done, notes_total)
+            storing = storing and settled(date, today)
+            # Skip note if there are less than 4 segments (e.g. when the visit is just for vaccination)
+            if len(segments) < 4:
+                if storing:
+                    stored["visits"].append({"medicalsn": d[name][v], "diff": None})
+                continue
+            diff = render(date, d[name][v], segments, cache, wraplen, tables, ids)
+            if storing:
+                stored["visits"].append({"medicalsn": d[name][v], "diff": diff})
+                stored["cache"] = list(cache)
+            diffs.append(diff)
+        if reverse:
+            diffs.reverse()
+        # Number of the next table, for the next run (the counter is taken up again from it)
+        state["tables"] = next(tables)
+        tables = itertools.count(state["tables"])
+        yield name, diffs
+        # The notes of this attending have been written out by now
+        if partial:
+            progress.report("notes", notes_done, notes_total, partial=partial)
+
+def write_report(fh, chartno, names, attendings, engine="htmldiff"):
+    """Writes the HTML report (template diff.html) to fh, one attending at a time as attendings (see diff_attendings()) yields them."""
+    templateloader = jinja2.FileSystemLoader(searchpath=os.path.dirname(os.path.abspath(__file__)))
+    templateenv = jinja2.Environment(loader=templateloader, autoescape=True)
+    template = templateenv.get_template('diff.html')
+    template.stream(chartno=chartno, names=list(names), attendings=attendings, engine=engine).dump(fh)
+
+def diff_patient(args, rooturl, chartno):
+    """Fetches the OPD notes of a patient and writes the diff report (options as in main); returns its path."""
+    # Get list of visits (only the days not cached from earlier runs are fetched)
+    progress.report("visit list")
+    d = group_visits(visitlist.get_visits(rooturl, chartno, args.startdate, args.enddate, args.debug))
+    # Retrieve OPD notes of each attending and calculate unified diffs
+    # (assuming that each attending uses his own notes as a base)
+
+    # State from earlier runs: for each attending, the rendered diff of every
+    # visit processed so far (None for skipped notes) and the last note
+    # segments, so that an incremental run only has to fetch newer visits.
+    # Notes for past visits don't change, so the stored diffs stay valid.
+    # The state is only read and written with --incremental.
+    statepath = session.STATEDIR / (session.statekey(rooturl, chartno) + "_diff.json")
+    state = None
+    if args.incremental:
+        try:
+            with open(statepath, mode="r", encoding="utf-8") as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            pass
+    if state is None or state["wraplen"] != args.wraplen or state.get("engine", "htmldiff") != args.engine:
+        state = {"engine": args.engine, "wraplen": args.wraplen, "tables": 0, "attendings": dict()}
+    outpath = pathlib.Path(args.outputdir) / (chartno + "_diff_" + args.startdate + "_" + args.enddate + ".html")
+    # The report is written out attending by attending as the notes are
+    # fetched, to a partial report that replaces the report once done (and
+    # can be read before then, e.g. from the web UI)
+    partialpath = outpath.with_name(outpath.stem + ".part.html")
+    # Notes fetched are also added to the full-text index of the patient (see emr_search.py)
+    with noteindex.NoteIndex(chartno, baseurl=rooturl) as index:
+        attendings = diff_attendings(rooturl, chartno, d, state, engine=args.engine, wraplen=args.wraplen, reverse=args.reverse,
+            partial=partialpath.name, index=index, debug=args.debug)
+        # Line buffered, so that each attending is in the file once written
+        with open(partialpath, mode="w", encoding="utf-8", buffering=1) as fh:
+            write_report(fh, chartno, d.keys(), attendings, engine=args.engine)
+
+    if args.incremental:
+        session.STATEDIR.mkdir(exist_ok=True)
+        tmppath = statepath.with_name(statepath.name + ".%d.tmp" % os.getpid())
+        with open(tmppath, mode="w", encoding="utf-8") as fh:
+            json.dump(state, fh)
+        os.replace(tmppath, statepath)
+
+    progress.report("writing")
+    os.replace(partialpath, outpath)
+    return outpath
 
 if __name__ == '__main__':
     # Change working directory to location of this script
@@ -36,106 +357,41 @@ if __name__ == '__main__':
     #parser.add_argument("--mode", choices=["PN", "OPD"], default="OPD", help="Specify parts of records to compare; 'OPD' for outpatient, 'PN' for progress")
     parser.add_argument("-u", "--uid", type=str, required=True, help="User ID")
     parser.add_argument("-p", "--passwd", type=str, required=True, help="Password")
-    parser.add_argument("-c", "--chartno", type=str, required=True, help="Chart number")
+    patients = parser.add_mutually_exclusive_group(required=True)
+    patients.add_argument("-c", "--chartno", type=str, help="Chart number")
+    patients.add_argument("-f", "--chartnofile", type=str, help="File containing chart numbers, one on each line (one report per patient and an index are written)")
     parser.add_argument("-s", "--startdate", type=str, help="Starting date in ISO8601 format", default="2019-01-01")
     parser.add_argument("-o", "--outputdir", type=str, help="Set output directory", default=pathlib.Path.cwd().parent / 'cache')
     parser.add_argument("-e", "--enddate", type=str, help="Ending date in ISO8601 format (defaults to today)", default=datetime.date.today().isoformat())
     parser.add_argument("-r", "--reverse", action="store_true", help="Reverse output chronology")
-    parser.add_argument("-w", "--wraplen", type=int, help="Set table wrap length", default=50)
+    parser.add_argument("-w", "--wraplen", type=int, help="Set table wrap length ('htmldiff' engine)", default=50)
+    parser.add_argument("--engine", choices=list(ENGINES), help="Diff rendering: side by side tables ('htmldiff'), or changed lines only, with changes within lines marked ('compact')", default="htmldiff")
+    parser.add_argument("-i", "--incremental", action="store_true", help="Only fetch and diff visits newer than those from the last run (diffs are taken against the previous stored visit, even if before the start date)")
+    parser.add_argument("-j", "--maxconn", type=int, help="Maximum number of patients processed (and requests per server) at the same time with --chartnofile", default=client.POOLSIZE)
+    parser.add_argument("--baseurl", type=str, help="Base URL of the hisweb server (e.g. a local test server)", default=session.BASEURL)
+    parser.add_argument("--metrics", type=str, help="Write request/parse timings to this file (Prometheus textfile if it ends in .prom, otherwise appended as JSON lines)")
     parser.add_argument("--version", action="version", version="%(prog)s 0.2.1 'Annihilation'")
     args = parser.parse_args()
+    metrics.setup(args)
+
+    if args.chartnofile:
+        chartnos = batch.read_chartnos(args.chartnofile)
+    assert args.maxconn > 0, "Number of concurrent patients must be positive"
 
     if args.debug:
         print("[DEBUG] UID: ", args.uid, file=sys.stderr)
-        print("[DEBUG] Chart number: ", args.chartno, file=sys.stderr)
+        print("[DEBUG] Chart number: ", args.chartno or args.chartnofile, file=sys.stderr)
         print("[DEBUG] Start date: ", args.startdate, file=sys.stderr)
         print("[DEBUG] End date: ", args.enddate, file=sys.stderr)
 
-    ROOTURL = "http://hisweb.hosp.ncku/EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
-
-    # Get list of visits
+    client.configure(poolsize=args.maxconn)
 
-    visit_list_url = "list2.aspx?" + "chartno=" + args.chartno + "&start=" + args.startdate + "&stop=" + args.enddate + "&query=0"
-    with urllib.request.urlopen(ROOTURL + visit_list_url) as f:
-        visit_list = f.read().decode("utf-8")
-
-    # Parse visit list: get IDs of each visit ("medicalsn") and put each into bins based on name of attending
-    d = dict()
-    ## build regex
-    ## 'O' prefix for outpatient, 'I' prefix for inpatient
-    o_regex = re.compile("^((?!type).)*medicalsn=(O.+)$")
-    ## Regex for name of attending. The spaces on either end are '\xa0' symbols (non-breaking spaces), as parsed from the HTML "&nbsp;".
-    n_regex = re.compile("[0-9]\xa0(.+)\xa0.+$")
-    visit_list_soup = bs4.BeautifulSoup(visit_list, "html.parser")
-    visits = visit_list_soup.find_all("a", href=o_regex)
-    for i in visits:
-        name = re.search(n_regex, i.text).groups()[0]
-        ## No autovivification in Python...
-        if name not in d.keys():
-            d[name] = []
-        d[name].append(re.search(o_regex, i["href"]).groups()[1])
-    for i in d.keys():
-        d[i] = set(d[i])
-        d[i] = list(d[i])
-        d[i].sort()
-    # Retrieve OPD notes of each attending and calculate unified diffs
-    # (assuming that each attending uses his own notes as a base)
-    # TODO: Build a mechanism for selecting which parts to calculate a delta on
-    segment_names = ("Subjective", "Objective", "Diagnosis", "Assessment & Plan")
-    # List of diagnoses
-    diagnoses = []
-    date_regex = re.compile("\d{4}/\d{2}/\d{2} \d{2}:\d{2}")
-    # HTML output, generated as a string. Double curly braces are used for the stylesheet since single ones trigger string formatting (and hence errors). Stylesheet copied from difflib.HtmlDiff.make_file output.
-    # TODO: consider reworking this to use normal text output from difflib
-    # along with Jinja2 templates, since the difflib.HtmlDiff output kind of
-    # sucks.
-    html_out = "<html lang='en'>\n<head>\n  <meta charset='utf-8'>\n  <title>OPD Visit Diff Report for {patient}</title>\n  <style type='text/css'>\n    table.diff {{font-family:Courier; border:medium;}}\n    .diff_header {{background-color:#e0e0e0}}\n    td.diff_header {{text-align:right}}\n    .diff_next {{background-color:#c0c0c0}}\n    .diff_add {{background-color:#aaffaa}}\n    .diff_chg {{background-color:#ffff77}}\n    .diff_sub {{background-color:#ffaaaa}}\n    #toc_container {{border: 1px solid #aaa; padding: 20px; width: auto;}}\n    .toc_title {{text-align: center;}}\n  </style>\n</head>\n<body>\n".format(patient=args.chartno)
-
-    toc = "  <div id='toc_container'>\n    <ul>\n"
-    for name in d.keys():
-        toc = toc + "      <li><a href='#" + name + "'>" + name + "</a></li>\n"
-    html_out = html_out + toc + "    </ul>\n  </div>\n"
-
-    for name in d.keys():
-        print(("### Notes for Dr. " + name + " ###").encode('utf-8'))
-        html_out += "  <hr/>\n  <p><h2 id='{doctor}'>Notes for Dr. {doctor}</h2></p>\n".format(doctor=name)
-        d[name].sort()
-        # Comparing all components
-        cache = [[],[],[],[]] # cache for note
-        total_diffs = ""
-        for v in range(0,len(d[name])):
-            n = urllib.request.urlopen(ROOTURL+"viewer.aspx?type=soap"+"&chartno="+args.chartno+"&medicalsn="+d[name][v]).read().decode("utf-8")# fetch note
-            note = bs4.BeautifulSoup(n, "html.parser")
-            # Get time of visit from header
-            header = note.find(attrs={"class":"portlet-header"})
-            date = re.search(date_regex, header.text).group()
-            main_text = note.find(attrs={"class":"portlet-content"}).findChildren(attrs={"class":"small"})
-            print("=== Visit at " + date + " (medicalsn", d[name][v], ") ===")
-            diff = "\n  <p><h3>Visit at {date} (medicalsn {medicalsn})</h3></p>\n".format(date=date, medicalsn=d[name][v])
-            # Subjective: main_text[0], objective: main_text[1], assessment: main_text[2], plan: main_text[3]
-            # (main_text[4] contains lab tests but this is more clearly expressed and worked on with the relevant LIS tools)
-            # Skip note if there are less than 4 segments (e.g. when the visit is just for vaccination)
-            if len(main_text) < 4:
-                continue
-            # Pseudocode:
-            #if d not in [i[0] for i in diagnosis]:
-            #    diagnosis.append([d, name, date])
-            for i in (2,0,1,3):
-                segment = [x for x in main_text[i].stripped_strings]
-                #print("=== ", segment_names[i], " ===")
-                #for j in difflib.ndiff(cache[i], segment):
-                #    print(j)
-                u = difflib.HtmlDiff(tabsize=4, wrapcolumn=args.wraplen)
-                diff += "  <p><h4>{s}</h4></p>\n".format(s=segment_names[i])
-                diff += u.make_table(cache[i], segment, context=True, numlines=3)
-                cache[i] = segment
-            if args.reverse:
-                total_diffs = diff + total_diffs
-            else:
-                total_diffs += diff
-        html_out += total_diffs
-    html_out += "\n</body>\n</html>"
+    progress.report("login")
+    if args.chartnofile:
+        # One login for all patients; at most args.maxconn patients at a time
+        results = batch.run(chartnos, lambda chartno: diff_patient(args, batch.patient_rooturl(args, chartno), chartno), args.maxconn, args.debug)
+        batch.write_index(results, args.outputdir, "emr_diff.py", "diff", args.startdate, args.enddate)
+        sys.exit(1 if any(error for _, _, error in results) else 0)
 
-    outpath = pathlib.Path(args.outputdir) / (args.chartno + "_diff_" + args.startdate + "_" + args.enddate + ".html") 
-    with open(outpath, mode="w", encoding="utf-8") as fh:
-        print(html_out, file=fh)
+    ROOTURL = session.get_baseurl(args) + "EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
+    diff_patient(args, ROOTURL, args.chartno)
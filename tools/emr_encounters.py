@@ -14,11 +14,55 @@ import os
 import pathlib
 import re
 import sys
-import urllib.request
-
-import bs4
 
+from lib import batch
+from lib import client
+from lib import metrics
 from lib import session
+from lib import visitlist
+
+def get_encounters(rooturl, chartno, startdate, enddate, debug=False):
+    """Retrieves encounter IDs ('medicalsn') of a patient from the visit list.
+
+    Args:
+        rooturl (str): Root URL of the EmrQuery tree pages, including the session ID.
+        chartno (str): Chart number, e.g., "12345678".
+        startdate (str): Starting date in ISO8601 format.
+        enddate (str): Ending date in ISO8601 format.
+        debug (bool) [optional]: Print debug info.
+
+    Returns:
+        tuple: Sorted lists of outpatient, inpatient and ED encounter IDs.
+
+    """
+    # Get list of visits (only the days not cached from earlier runs are fetched)
+    return sort_encounters(visitlist.get_visits(rooturl, chartno, startdate, enddate, debug))
+
+def parse_encounters(visit_list):
+    """Parses the visit list page (list2.aspx) into sorted lists of outpatient, inpatient and ED encounter IDs."""
+    return sort_encounters(visitlist.parse_visits(visit_list))
+
+def sort_encounters(visits):
+    """Sorts visits (see lib/visitlist.py) into sorted lists of outpatient, inpatient and ED encounter IDs."""
+    ## 'O' prefix for outpatient, 'I' prefix for inpatient, 'E' prefix for ED
+    ## Worth noting that 'viewer_v2' seems to be for a past inpatient stay while 'iviewer' is for a current stay
+    sets = {'O': set(), 'I': set(), 'E': set()}
+    for v in visits:
+        m = re.match("[OIE]\d+", v["medicalsn"])
+        if m:
+            sets[v["type"]].add(m.group())
+    return sorted(sets['O']), sorted(sets['I']), sorted(sets['E'])
+
+def write_encounters(out_list, outputdir, chartno, startdate, enddate):
+    """Writes encounter IDs to a CSV file in outputdir and returns its path."""
+    # Note that the default encoding on other OSs may not be UTF-8
+    outpath = pathlib.Path(outputdir) / (chartno + "_enct_" + startdate + "_" + enddate + ".csv")
+    with open(outpath, mode="w", encoding="utf-8", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Chart number", "Encounter ID"])
+        for i in out_list:
+            writer.writerow([chartno, i])
+    return outpath
 
 if __name__ == '__main__':
     # Change working directory to location of this script
@@ -31,18 +75,29 @@ if __name__ == '__main__':
     parser.add_argument("--debug", action="store_true", help="Print debug info")
     parser.add_argument("-u", "--uid", type=str, required=True, help="User ID")
     parser.add_argument("-p", "--passwd", type=str, required=True, help="Password")
-    parser.add_argument("-c", "--chartno", type=str, required=True, help="Chart number")
+    patients = parser.add_mutually_exclusive_group(required=True)
+    patients.add_argument("-c", "--chartno", type=str, help="Chart number")
+    patients.add_argument("-f", "--chartnofile", type=str, help="File containing chart numbers, one on each line (one CSV file per patient and an index are written)")
     parser.add_argument("-s", "--startdate", type=str, help="Starting date in ISO8601 format", default="2019-01-01")
     parser.add_argument("-e", "--enddate", type=str, help="Ending date in ISO8601 format (defaults to today)", default=datetime.date.today().isoformat())
     #parser.add_argument("-r", "--reverse", action="store_true", help="Reverse output chronology")
     parser.add_argument("-l", "--latest", action="store_true", help="Print the patient's latest inpatient encounter ID to standard output")
     parser.add_argument("-o", "--outputdir", type=str, help="Set output directory", default=pathlib.Path.cwd().parent / 'cache')
+    parser.add_argument("-j", "--maxconn", type=int, help="Maximum number of patients processed (and requests per server) at the same time with --chartnofile", default=client.POOLSIZE)
+    parser.add_argument("--baseurl", type=str, help="Base URL of the hisweb server (e.g. a local test server)", default=session.BASEURL)
+    parser.add_argument("--metrics", type=str, help="Write request/parse timings to this file (Prometheus textfile if it ends in .prom, otherwise appended as JSON lines)")
     parser.add_argument("--version", action="version", version="%(prog)s 0.2.1 'Annihilation'")
     args = parser.parse_args()
+    metrics.setup(args)
 
     # Input validation
     assert re.match('\d{6}', args.uid), "ID number malformed (less than 6 digits)"
-    assert re.match('\d{8}', args.chartno), "Chart number malformed (less than 8 digits)"
+    if args.chartnofile:
+        chartnos = batch.read_chartnos(args.chartnofile)
+        assert not args.latest, "--latest only applies to a single chart number"
+    else:
+        assert re.match('\d{8}', args.chartno), "Chart number malformed (less than 8 digits)"
+    assert args.maxconn > 0, "Number of concurrent patients must be positive"
     try:
         datetime.datetime.strptime(args.startdate, '%Y-%m-%d')
     except ValueError:
@@ -54,53 +109,32 @@ if __name__ == '__main__':
 
     if args.debug:
         print("[DEBUG] UID: ", args.uid, file=sys.stderr)
-        print("[DEBUG] Chart number: ", args.chartno, file=sys.stderr)
+        print("[DEBUG] Chart number: ", args.chartno or args.chartnofile, file=sys.stderr)
         print("[DEBUG] Start date: ", args.startdate, file=sys.stderr)
         print("[DEBUG] End date: ", args.enddate, file=sys.stderr)
 
-    ROOTURL = "http://hisweb.hosp.ncku/EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
+    client.configure(poolsize=args.maxconn)
 
-    # Get list of visits
-    visit_list_url = "list2.aspx?" + "chartno=" + args.chartno + "&start=" + args.startdate + "&stop=" + args.enddate + "&query=0"
-    with urllib.request.urlopen(ROOTURL + visit_list_url) as f:
-        visit_list = f.read().decode("utf-8")
+    if args.chartnofile:
+        # One login for all patients; at most args.maxconn patients at a time
+        def process(chartno):
+            o_list, i_list, e_list = get_encounters(batch.patient_rooturl(args, chartno), chartno, args.startdate, args.enddate, args.debug)
+            return write_encounters(o_list + i_list + e_list, args.outputdir, chartno, args.startdate, args.enddate)
+        results = batch.run(chartnos, process, args.maxconn, args.debug)
+        batch.write_index(results, args.outputdir, "emr_encounters.py", "enct", args.startdate, args.enddate)
+        sys.exit(1 if any(error for _, _, error in results) else 0)
 
-    # Build regexes
-    date_regex = re.compile("\d{4}/\d{2}/\d{2} \d{2}:\d{2}")
-    ## 'O' prefix for outpatient, 'I' prefix for inpatient, 'E' prefix for ED
-    o_regex = re.compile("medicalsn=(O\d+)")
-    i_regex = re.compile("medicalsn=(I\d+)")
-    e_regex = re.compile("medicalsn=(E\d+)")
-    
-    visit_list_soup = bs4.BeautifulSoup(visit_list, "html.parser")
-    o_visits = visit_list_soup.find_all("a", href=o_regex)
-    i_visits = visit_list_soup.find_all("a", href=i_regex)
-    e_visits = visit_list_soup.find_all("a", href=e_regex)
-
-    o_set = set()
-    i_set = set()
-    e_set = set()
-
-    # Outpatient visits #
-    for i in o_visits:
-        o_set.add(re.search(o_regex, i['href']).groups(0)[0])
-
-    # Inpatient visits #
-    ## Worth noting that 'viewer_v2' seems to be for a past inpatient stay while 'iviewer' is for a current stay
-    for i in i_visits:
-        i_set.add(re.search(i_regex, i['href']).groups(0)[0])
+    ROOTURL = session.get_baseurl(args) + "EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
+
+    o_list, i_list, e_list = get_encounters(ROOTURL, args.chartno, args.startdate, args.enddate, args.debug)
 
-    # Emergency department visits #
-    for i in e_visits:
-        e_set.add(re.search(e_regex, i['href']).groups(0)[0])
-        
     out_list = list()
-    out_list.extend(sorted(list(o_set)))
-    out_list.extend(sorted(list(i_set)))
-    out_list.extend(sorted(list(e_set)))
+    out_list.extend(o_list)
+    out_list.extend(i_list)
+    out_list.extend(e_list)
 
     if args.latest:
-        print(sorted(list(i_set))[-1], end='', file=sys.stdout)
+        print(i_list[-1], end='', file=sys.stdout)
         #outpath = pathlib.Path(args.outputdir) / (args.chartno + "_enct_adm_latest_" + datetime.date.today().isoformat() + ".csv")
         #with open(outpath, mode="w", encoding="utf-8", newline="") as csvfile:
         #    writer = csv.writer(csvfile)
@@ -109,10 +143,4 @@ if __name__ == '__main__':
         #    writer.writerow([latest_admission])
         exit(0)
 
-    # Note that the default encoding on other OSs may not be UTF-8
-    outpath = pathlib.Path(args.outputdir) / (args.chartno + "_enct_" + args.startdate + "_" + args.enddate + ".csv")
-    with open(outpath, mode="w", encoding="utf-8", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["Chart number", "Encounter ID"])
-        for i in out_list:
-            writer.writerow([args.chartno, i])
+    write_encounters(out_list, args.outputdir, args.chartno, args.startdate, args.enddate)
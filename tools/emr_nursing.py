@@ -15,12 +15,187 @@ import os
 import pathlib
 import re
 import sys
-import urllib.request
-
-import bs4
 
+from lib import client
+from lib import metrics
+from lib import parse
 from lib import session
 
+# Column names of the CSV output for mode 'other'
+FIELDS = ["Time", "Event_Type", "Assessment_Type", "Action"]
+## Number of an event ("1.", "2.", ...) in the last column of a row
+_event_num_regex = re.compile(r'^\d+\.$')
+# Days up to today whose records may still be added to; earlier days are
+# closed records, kept in the 'state' directory once fetched
+OPEN_DAYS = 2
+
+def get_notedates(rooturl, chartno, encounterid):
+    """Returns the dates (YYYY/MM/DD) for which nursing records exist for an encounter."""
+    # Extract valid dates for nursing records
+    nursing_record_rooturl = rooturl + "NISlist.aspx?ChartNo=" + chartno + "&CaseNo="+ encounterid + "&GTYPE=2"
+    with client.urlopen(nursing_record_rooturl) as f:
+        nursing_record_root = f.read().decode("utf-8")
+    return parse_notedates(nursing_record_root)
+
+def parse_notedates(nursing_record_root):
+    """Parses the list of nursing records (NISlist.aspx) into dates (YYYY/MM/DD)."""
+    nursing_record_root_soup = parse.parse(nursing_record_root, 'nislist')
+    return [x.text for x in nursing_record_root_soup.findAll('a', text=re.compile('\d{4}/\d{2}/\d{2}'))]
+
+def parse_admission(nursing_sheet):
+    """Parses the admission nursing datasheet into a dict."""
+    out_dict = dict()
+    nursing_sheet_soup = parse.parse(nursing_sheet, 'nursing')
+    # TODO: Pending code for parsing the admission datasheet
+    tables_all = nursing_sheet_soup.findAll('table')
+    # Administrative info
+    admin_table = tables_all[7]
+    out_dict['pid'] = admin_table.find('td',text='病歷號').next_sibling.text.strip()
+    out_dict['name'] = admin_table.find('td',text='病患姓名').next_sibling.text.strip()
+    out_dict['dob'] = admin_table.find('td',text='生日').next_sibling.text.strip()
+    out_dict['gender'] = admin_table.find('td',text='性別').next_sibling.text.strip()
+    # Basic info
+    basic_info_table = tables_all[9]
+    out_dict['diagnosis'] = basic_info_table.find('td',text='入院診斷').next_sibling.text.strip()
+    out_dict['height'] = basic_info_table.find('td',text='身高').next_sibling.text.strip()
+    out_dict['weight'] = basic_info_table.find('td',text='體重').next_sibling.text.strip()
+    out_dict['vitals'] = basic_info_table.find('td',text='生命徵象').next_sibling.text.strip()
+    # ...
+    # History
+    history_table = tables_all[11]
+    out_dict['family_history'] = history_table.find('td',text='家族病史').next_sibling.text.strip()
+    out_dict['medical_history'] = history_table.find('td',text='過去病史').next_sibling.text.strip()
+    out_dict['longterm_drugs'] = history_table.find('td',text='長期用藥').next_sibling.text.strip()
+    out_dict['medication_allergies'] = history_table.find('td',text='藥物過敏史').next_sibling.text.strip()
+    out_dict['food_allergies'] = history_table.find('td',text='食物過敏史').next_sibling.text.strip()
+    out_dict['other_allergies'] = history_table.find('td',text='其他過敏史').next_sibling.text.strip()
+    out_dict['present_illness'] = history_table.find('td',text='此次發病經過').next_sibling.text.strip()
+    # Evaluation
+    evaluation_table = tables_all[13]
+    out_dict['religion'] = evaluation_table.find('td',text='靈性').next_sibling.text.strip()
+    out_dict['personal_history'] = evaluation_table.find('td',text='個人史').next_sibling.text.strip()
+    out_dict['family_history_eval'] = evaluation_table.find('td',text='家族史').next_sibling.text.strip()
+    out_dict['neuro'] = evaluation_table.find('td',text='神經').next_sibling.text.strip()
+    out_dict['sensory'] = evaluation_table.find('td',text='感官').next_sibling.text.strip()
+    out_dict['respiration'] = evaluation_table.find('td',text='呼吸').next_sibling.text.strip()
+    out_dict['cardiovascular'] = evaluation_table.find('td',text='心血管').next_sibling.text.strip()
+    out_dict['digestion'] = evaluation_table.find('td',text='消化').next_sibling.text.strip()
+    out_dict['urogenital'] = evaluation_table.find('td',text='泌尿/生殖').next_sibling.text.strip()
+    out_dict['musculoskeletal'] = evaluation_table.find('td',text='肌肉骨骼').next_sibling.text.strip()
+    out_dict['skin'] = evaluation_table.find('td',text='皮膚').next_sibling.text.strip()
+    out_dict['bloodtype'] = evaluation_table.find('td',text='血型').next_sibling.text.strip()
+    # At the Pediatrics department the 'routine' row contains the circumference of the head, chest and abdomen
+    out_dict['routine'] = evaluation_table.find('td',text='常規').next_sibling.text.strip()
+    return out_dict
+
+def parse_events(nursing_sheet, notedate):
+    """Parses a daily nursing sheet, yielding lists of time, event type, assessment type and action (see FIELDS).
+
+    The sheet is walked once in document order: the time (c1), event type
+    (c2) and assessment type (c3) cells of a row are carried forward to the
+    numbered events ("1.", "2.", ...) after them, which may be several per row.
+    """
+    # Consider creating full ISO8601-compliant time instead of only %H:%M
+    day = datetime.datetime.strptime(notedate, '%Y/%m/%d').strftime('%Y-%m-%d') + ' '
+    current = {'c1': None, 'c2': None, 'c3': None}
+    for tag in parse.parse(nursing_sheet, 'nursing').find_all(['td', 'div']):
+        if tag.name == 'td':
+            column = tag.get('id', '')[-2:]
+            if column in current:
+                current[column] = tag.text
+        elif tag.string is not None and _event_num_regex.match(tag.string):
+            action = tag.parent.find_next_sibling().text
+            yield [day + current['c1'], current['c2'], current['c3'], action]
+
+def storepath(chartno, encounterid, baseurl=session.BASEURL):
+    return session.STATEDIR / (session.statekey(baseurl, chartno) + "_nurs_" + encounterid + ".json")
+
+def load_days(chartno, encounterid, baseurl=session.BASEURL):
+    """Returns the stored events of the closed days of an encounter, as a dict of date (YYYY/MM/DD): events (see parse_events())."""
+    try:
+        with open(storepath(chartno, encounterid, baseurl), mode="r", encoding="utf-8") as fh:
+            return json.load(fh)["days"]
+    except (OSError, ValueError, KeyError):
+        return dict()
+
+def save_days(chartno, encounterid, days, baseurl=session.BASEURL):
+    """Stores the events of closed days (see load_days())."""
+    session.STATEDIR.mkdir(exist_ok=True)
+    path = storepath(chartno, encounterid, baseurl)
+    tmppath = path.with_name(path.name + ".%d.tmp" % os.getpid())
+    with open(tmppath, mode="w", encoding="utf-8") as fh:
+        json.dump({"days": days}, fh, ensure_ascii=False)
+    os.replace(tmppath, path)
+
+def get_nursing(rooturl, chartno, encounterid, mode="other", date=None, maxconn=client.POOLSIZE, debug=False):
+    """Retrieves nursing records for an encounter.
+
+    Args:
+        rooturl (str): Root URL of the EmrQuery tree pages, including the session ID.
+        chartno (str): Chart number, e.g., "12345678".
+        encounterid (str): Encounter ID, e.g., "I20190014727".
+        mode (str) [optional]: 'admission' for the admission datasheet, 'other' for daily records.
+        date (str) [optional]: Date in ISO8601 format (all dates if None).
+        maxconn (int) [optional]: Maximum number of days fetched at the same time (mode 'other').
+        debug (bool) [optional]: Print debug info.
+
+    Returns:
+        dict (mode 'admission') or list of lists in the order of FIELDS (mode 'other').
+
+    In mode 'other', days before the last OPEN_DAYS are only fetched once;
+    their events are stored and read back on later runs.
+    """
+    if date:
+        notedate = [datetime.datetime.strptime(date, '%Y-%m-%d').strftime('%Y/%m/%d')]
+    else:
+        notedate = get_notedates(rooturl, chartno, encounterid)
+
+    if mode == 'admission':
+        noteurl = rooturl + "viewReport.aspx?medicalsn=" + encounterid + "&GTYPE=2_1&CHARTNO=" + chartno
+        if debug:
+            print('[DEBUG] Getting admission note (url: ', noteurl, ')', file=sys.stderr)
+        with client.urlopen(noteurl) as f:
+            return parse_admission(f.read().decode("utf-8"))
+    elif mode != 'other':
+        raise ValueError("Incorrect mode: " + mode)
+
+    days = load_days(chartno, encounterid, rooturl)
+    opendays = set((datetime.date.today() - datetime.timedelta(days=k)).strftime('%Y/%m/%d') for k in range(OPEN_DAYS))
+    fetch = [x for x in notedate if x not in days or x in opendays]
+    # It's certainly bad form to use forward slashes in a date...
+    noteurl = [rooturl + "viewReport.aspx?medicalsn=" + encounterid + "&NDATE=" + x + "&CHARTNO=" + chartno for x in fetch]
+    if debug:
+        print('[DEBUG] Days stored:', len(notedate) - len(fetch), file=sys.stderr)
+        for x in zip(fetch, noteurl):
+            print('[DEBUG] Getting note on', x[0], '(url: ', x[1], ')', file=sys.stderr)
+
+    # Days are fetched concurrently, but come back in order
+    for x, nursing_sheet in zip(fetch, client.fetch_many(noteurl, maxconn)):
+        days[x] = list(parse_events(nursing_sheet, x))
+    if any(x not in opendays for x in fetch):
+        save_days(chartno, encounterid, {x: days[x] for x in days if x not in opendays}, rooturl)
+
+    out_list = list()
+    for x in notedate:
+        out_list.extend(days[x])
+    return out_list
+
+def write_nursing(out, outputdir, chartno, encounterid, mode="other"):
+    """Writes nursing records (as returned by get_nursing()) to outputdir and returns the path of the file."""
+    # Note that the default encoding on other OSs may not be UTF-8
+    if mode == 'admission':
+        outpath = pathlib.Path(outputdir) / (chartno + "_nurs_" + encounterid + "_adm" + ".json")
+        with open(outpath, mode="w", encoding="utf-8", newline="") as jsonfile:
+            json.dump(out, jsonfile)
+    if mode == 'other':
+        outpath = pathlib.Path(outputdir) / (chartno + "_nurs_" + encounterid + "_" + datetime.datetime.now().strftime("%Y-%m-%dT%H%M") + ".csv")
+        with open(outpath, mode="w", encoding="utf-8", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(FIELDS)
+            for i in out:
+                writer.writerow(i)
+    return outpath
+
 if __name__ == '__main__':
     # Change working directory to location of this script
     try:
@@ -37,12 +212,17 @@ if __name__ == '__main__':
     parser.add_argument("-e", "--encounterid", type=str, required=True, help="Encounter ID (medicalsn) (required)")
     parser.add_argument("-m", "--mode", type=str, choices=["admission", "other"], help="Type of nursing record to retrieve ('other' includes normal ward and ICU)", default="other")
     parser.add_argument("-o", "--outputdir", type=str, help="Set output directory", default=pathlib.Path.cwd().parent / 'cache')
+    parser.add_argument("-j", "--maxconn", type=int, help="Maximum number of concurrent requests to the EMR server", default=client.POOLSIZE)
+    parser.add_argument("--baseurl", type=str, help="Base URL of the hisweb server (e.g. a local test server)", default=session.BASEURL)
+    parser.add_argument("--metrics", type=str, help="Write request/parse timings to this file (Prometheus textfile if it ends in .prom, otherwise appended as JSON lines)")
     parser.add_argument("--version", action="version", version="%(prog)s 0.2.1 'Annihilation'")
     args = parser.parse_args()
+    metrics.setup(args)
     
     # Input validation
     assert re.match('\d{6}', args.uid), "ID number malformed (less than 6 digits)"
     assert re.match('[01]\d{7}', args.chartno), "Chart number malformed (less than 8 digits)"
+    assert args.maxconn > 0, "Number of concurrent requests must be positive"
     try:
         if args.date:
             datetime.datetime.strptime(args.date, '%Y-%m-%d')
@@ -55,99 +235,9 @@ if __name__ == '__main__':
         print("[DEBUG] Encounter ID: ", args.encounterid, file=sys.stderr)
         print("[DEBUG] Mode: ", args.mode, file=sys.stderr)
 
-    ROOTURL = "http://hisweb.hosp.ncku/EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
+    client.configure(poolsize=args.maxconn)
 
-    if args.date:
-        notedate = [datetime.datetime.strptime(args.date, '%Y-%m-%d').strftime('%Y/%m/%d')]
-    else:
-        # Extract valid dates for nursing records
-        nursing_record_rooturl = ROOTURL + "NISlist.aspx?ChartNo=" + args.chartno + "&CaseNo="+ args.encounterid + "&GTYPE=2"
-        with urllib.request.urlopen(nursing_record_rooturl) as f:
-            nursing_record_root = f.read().decode("utf-8")
-        nursing_record_root_soup = bs4.BeautifulSoup(nursing_record_root, 'lxml')
-        notedate = [x.text for x in nursing_record_root_soup.findAll('a', text=re.compile('\d{4}/\d{2}/\d{2}'))]
-
-    if args.mode == 'admission':
-        noteurl = [ROOTURL + "viewReport.aspx?medicalsn=" + args.encounterid + "&GTYPE=2_1&CHARTNO=" + args.chartno]
-    elif args.mode == 'other':
-        # It's certainly bad form to use forward slashes in a date...
-        noteurl = [ROOTURL + "viewReport.aspx?medicalsn=" + args.encounterid + "&NDATE=" + x + "&CHARTNO=" + args.chartno for x in notedate]
-    else:
-        print("Error: incorrect mode", file=sys.stderr)
-        exit(1)
+    ROOTURL = session.get_baseurl(args) + "EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
 
-    out_list = list()
-    out_dict = dict()
-
-    for x in zip(notedate, noteurl):
-        if args.debug:
-            print('[DEBUG] Getting note on', x[0], '(url: ', x[1], ')', file=sys.stderr)
-        with urllib.request.urlopen(x[1]) as f:
-            nursing_sheet = f.read().decode("utf-8")
-        if args.mode == 'admission':
-            nursing_sheet_soup = bs4.BeautifulSoup(nursing_sheet, 'html.parser')
-            # TODO: Pending code for parsing the admission datasheet
-            tables_all = nursing_sheet_soup.findAll('table')
-            # Administrative info
-            admin_table = tables_all[7]
-            out_dict['pid'] = admin_table.find('td',text='病歷號').next_sibling.text.strip()
-            out_dict['name'] = admin_table.find('td',text='病患姓名').next_sibling.text.strip()
-            out_dict['dob'] = admin_table.find('td',text='生日').next_sibling.text.strip()
-            out_dict['gender'] = admin_table.find('td',text='性別').next_sibling.text.strip()
-            # Basic info
-            basic_info_table = tables_all[9]
-            out_dict['diagnosis'] = basic_info_table.find('td',text='入院診斷').next_sibling.text.strip()
-            out_dict['height'] = basic_info_table.find('td',text='身高').next_sibling.text.strip()
-            out_dict['weight'] = basic_info_table.find('td',text='體重').next_sibling.text.strip()
-            out_dict['vitals'] = basic_info_table.find('td',text='生命徵象').next_sibling.text.strip()
-            # ...
-            # History
-            history_table = tables_all[11]
-            out_dict['family_history'] = history_table.find('td',text='家族病史').next_sibling.text.strip()
-            out_dict['medical_history'] = history_table.find('td',text='過去病史').next_sibling.text.strip()
-            out_dict['longterm_drugs'] = history_table.find('td',text='長期用藥').next_sibling.text.strip()
-            out_dict['medication_allergies'] = history_table.find('td',text='藥物過敏史').next_sibling.text.strip()
-            out_dict['food_allergies'] = history_table.find('td',text='食物過敏史').next_sibling.text.strip()
-            out_dict['other_allergies'] = history_table.find('td',text='其他過敏史').next_sibling.text.strip()
-            out_dict['present_illness'] = history_table.find('td',text='此次發病經過').next_sibling.text.strip()
-            # Evaluation
-            evaluation_table = tables_all[13]
-            out_dict['religion'] = evaluation_table.find('td',text='靈性').next_sibling.text.strip()
-            out_dict['personal_history'] = evaluation_table.find('td',text='個人史').next_sibling.text.strip()
-            out_dict['family_history_eval'] = evaluation_table.find('td',text='家族史').next_sibling.text.strip()
-            out_dict['neuro'] = evaluation_table.find('td',text='神經').next_sibling.text.strip()
-            out_dict['sensory'] = evaluation_table.find('td',text='感官').next_sibling.text.strip()
-            out_dict['respiration'] = evaluation_table.find('td',text='呼吸').next_sibling.text.strip()
-            out_dict['cardiovascular'] = evaluation_table.find('td',text='心血管').next_sibling.text.strip()
-            out_dict['digestion'] = evaluation_table.find('td',text='消化').next_sibling.text.strip()
-            out_dict['urogenital'] = evaluation_table.find('td',text='泌尿/生殖').next_sibling.text.strip()
-            out_dict['musculoskeletal'] = evaluation_table.find('td',text='肌肉骨骼').next_sibling.text.strip()
-            out_dict['skin'] = evaluation_table.find('td',text='皮膚').next_sibling.text.strip()
-            out_dict['bloodtype'] = evaluation_table.find('td',text='血型').next_sibling.text.strip()
-            # At the Pediatrics department the 'routine' row contains the circumference of the head, chest and abdomen
-            out_dict['routine'] = evaluation_table.find('td',text='常規').next_sibling.text.strip()
-        if args.mode == 'other':
-            nursing_sheet_soup = bs4.BeautifulSoup(nursing_sheet, 'html.parser')
-            event_num = nursing_sheet_soup.findAll('div', text=re.compile('^\d+\.$'))
-            for e in event_num:
-                # Consider creating full ISO8601-compliant time instead of only %H:%M
-                #date = e.findParent().find_previous('td', attrs={'id':re.compile('c0$')}).text
-                #time = e.findParent().find_previous('td', attrs={'id':re.compile('c1$')}).text
-                time = datetime.datetime.strptime(x[0], '%Y/%m/%d').strftime('%Y-%m-%d') + ' ' + e.findParent().find_previous('td', attrs={'id':re.compile('c1$')}).text
-                event_type = e.findParent().find_previous('td', attrs={'id':re.compile('c2$')}).text
-                assessment_type = e.findParent().find_previous('td', attrs={'id':re.compile('c3$')}).text
-                action = e.findParent().find_next_sibling().text
-                out_list.append([time, event_type, assessment_type, action])
-
-    # Note that the default encoding on other OSs may not be UTF-8
-    if args.mode == 'admission':
-        outpath = pathlib.Path(args.outputdir) / (args.chartno + "_nurs_" + args.encounterid + "_adm" + ".json")
-        with open(outpath, mode="w", encoding="utf-8", newline="") as jsonfile:
-            json.dump(out_dict, jsonfile)
-    if args.mode == 'other':
-        outpath = pathlib.Path(args.outputdir) / (args.chartno + "_nurs_" + args.encounterid + "_" + datetime.datetime.now().strftime("%Y-%m-%dT%H%M") + ".csv")
-        with open(outpath, mode="w", encoding="utf-8", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["Time", "Event_Type", "Assessment_Type", "Action"])
-            for i in out_list:
-                writer.writerow(i)
\ No newline at end of file
+    out = get_nursing(ROOTURL, args.chartno, args.encounterid, mode=args.mode, date=args.date, maxconn=args.maxconn, debug=args.debug)
+    write_nursing(out, args.outputdir, args.chartno, args.encounterid, mode=args.mode)
@@ -14,41 +14,33 @@ import os
 import pathlib
 import re
 import sys
-import urllib.request
 
-import bs4
+from lib import client
+from lib import metrics
+from lib import parse
+from lib import session
 
-if __name__ == '__main__':
-    # Change working directory to location of this script
-    try:
-        os.chdir(os.path.dirname(os.path.abspath(__file__)))
-    except OSError:
-        print("[Error] Couldn't change working directory to location of this script", file=sys.stderr)
-    parser = argparse.ArgumentParser(description="Retrieval of orders from NCKUH EMR",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("--debug", action="store_true", help="Print debug info")
-    parser.add_argument("-u", "--uid", type=str, required=True, help="User ID")
-    parser.add_argument("-p", "--passwd", type=str, required=True, help="Password")
-    # TODO: add shortcut so that giving the chart number would retrieve the latest applicable encounter ID
-    parser.add_argument("-c", "--chartno", type=str, required=True, help="Chart number")
-    parser.add_argument("-e", "--encounterid", type=str, help="Encounter ID ('medicalsn')")
-    parser.add_argument("-o", "--outputdir", type=str, help="Set output directory", default=pathlib.Path.cwd().parent / 'cache')
-    parser.add_argument("--version", action="version", version="%(prog)s 0.2.1 'Annihilation'")
-    args = parser.parse_args()
+# Column names of the CSV output
+FIELDS = ["Time", "Order", "Type"]
 
-    # Input validation
-    assert re.match('\d{6}', args.uid), "ID number malformed (less than 6 digits)"
-    assert re.match('\d{8}', args.chartno), "Chart number malformed (less than 8 digits)"
+def get_orders(rooturl, encounterid):
+    """Retrieves regular and stat orders for an encounter.
 
-    if args.debug:
-        print("[DEBUG] UID: ", args.uid, file=sys.stderr)
-        print("[DEBUG] Chart number: ", args.chartno, file=sys.stderr)
+    Args:
+        rooturl (str): Root URL of the PCS pages, e.g. "http://hisweb.hosp.ncku/WebsiteSSO/PCS/".
+        encounterid (str): Encounter ID, e.g., "I20190014727".
 
-    ROOTURL = "http://hisweb.hosp.ncku/WebsiteSSO/PCS/"
+    Returns:
+        out_list (list): Tuples of start time (datetime.datetime), order and order type.
 
-    with urllib.request.urlopen(ROOTURL + "showShift.aspx?type=1&caseno=" + args.encounterid) as f:
+    """
+    with client.urlopen(rooturl + "showShift.aspx?type=1&caseno=" + encounterid) as f:
         ordersheet = f.read().decode("utf-8")
-    ordersoup = bs4.BeautifulSoup(ordersheet, "html.parser")
+    return parse_orders(ordersheet)
+
+def parse_orders(ordersheet):
+    """Parses the order sheet (showShift.aspx) into tuples of start time, order and order type."""
+    ordersoup = parse.parse(ordersheet, "orders")
 
     # After consideration, it seems better to leave the filtering by date to the summary generator
     ## Here we're assuming that this script is run on the '2nd day' of duty
@@ -86,13 +78,52 @@ if __name__ == '__main__':
         out_list.extend(regular_new)
     if stat:
         out_list.extend(stat_new)
+    return out_list
 
-    if args.debug:
-        print(out_list, file=sys.stderr)
+def write_orders(out_list, outputdir, chartno):
+    """Writes orders to a timestamped CSV file in outputdir and returns its path."""
     # Note that the default encoding on other OSs may not be UTF-8
-    outpath = pathlib.Path(args.outputdir) / (args.chartno + "_orders_" + datetime.datetime.now().strftime("%Y-%m-%dT%H%M") + ".csv")
+    outpath = pathlib.Path(outputdir) / (chartno + "_orders_" + datetime.datetime.now().strftime("%Y-%m-%dT%H%M") + ".csv")
     with open(outpath, mode="w", encoding="utf-8", newline="") as csvfile:
         writer = csv.writer(csvfile)
-        writer.writerow(["Time", "Order", "Type"])
+        writer.writerow(FIELDS)
         for i in out_list:
             writer.writerow(i)
+    return outpath
+
+if __name__ == '__main__':
+    # Change working directory to location of this script
+    try:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        print("[Error] Couldn't change working directory to location of this script", file=sys.stderr)
+    parser = argparse.ArgumentParser(description="Retrieval of orders from NCKUH EMR",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--debug", action="store_true", help="Print debug info")
+    parser.add_argument("-u", "--uid", type=str, required=True, help="User ID")
+    parser.add_argument("-p", "--passwd", type=str, required=True, help="Password")
+    # TODO: add shortcut so that giving the chart number would retrieve the latest applicable encounter ID
+    parser.add_argument("-c", "--chartno", type=str, required=True, help="Chart number")
+    parser.add_argument("-e", "--encounterid", type=str, help="Encounter ID ('medicalsn')")
+    parser.add_argument("-o", "--outputdir", type=str, help="Set output directory", default=pathlib.Path.cwd().parent / 'cache')
+    parser.add_argument("--baseurl", type=str, help="Base URL of the hisweb server (e.g. a local test server)", default=session.BASEURL)
+    parser.add_argument("--metrics", type=str, help="Write request/parse timings to this file (Prometheus textfile if it ends in .prom, otherwise appended as JSON lines)")
+    parser.add_argument("--version", action="version", version="%(prog)s 0.2.1 'Annihilation'")
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    # Input validation
+    assert re.match('\d{6}', args.uid), "ID number malformed (less than 6 digits)"
+    assert re.match('\d{8}', args.chartno), "Chart number malformed (less than 8 digits)"
+
+    if args.debug:
+        print("[DEBUG] UID: ", args.uid, file=sys.stderr)
+        print("[DEBUG] Chart number: ", args.chartno, file=sys.stderr)
+
+    ROOTURL = session.get_baseurl(args) + "WebsiteSSO/PCS/"
+
+    out_list = get_orders(ROOTURL, args.encounterid)
+
+    if args.debug:
+        print(out_list, file=sys.stderr)
+    write_orders(out_list, args.outputdir, args.chartno)
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+# emr_search.py - finding when a word or phrase appears in the OPD notes of a
+# patient, from the full-text index built by emr_diff.py (lib/noteindex.py)
+
+# Initially created in October 2026
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from lib import noteindex
+from lib import session
+
+def print_occurrence(x):
+    print("{date} {medicalsn} Dr. {attending} [{segment}] {text}".format(**x))
+
+if __name__ == '__main__':
+    # Change working directory to location of this script
+    try:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        print("[Error] Couldn't change working directory to location of this script", file=sys.stderr)
+    parser = argparse.ArgumentParser(description="Searching the OPD notes of a patient fetched by emr_diff.py",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--debug", action="store_true", help="Print debug info")
+    parser.add_argument("-c", "--chartno", type=str, required=True, help="Chart number")
+    parser.add_argument("--baseurl", type=str, help="Base URL of the hisweb server the notes were fetched from (e.g. a local test server)", default=session.BASEURL)
+    parser.add_argument("-f", "--first", action="store_true", help="Only print the first occurrence")
+    parser.add_argument("--json", action="store_true", help="Print occurrences as JSON")
+    parser.add_argument("phrase", nargs="+", help="Word or phrase to search for (case-insensitive; the last word may be the start of a longer one)")
+    parser.add_argument("--version", action="version", version="%(prog)s 0.2.1 'Annihilation'")
+    args = parser.parse_args()
+
+    if not noteindex.indexpath(args.chartno, session.get_baseurl(args)).exists():
+        print("[Error] No notes indexed for chart number", args.chartno, "(run emr_diff.py first)", file=sys.stderr)
+        sys.exit(1)
+    phrase = " ".join(args.phrase)
+    with noteindex.NoteIndex(args.chartno, baseurl=session.get_baseurl(args)) as index:
+        start = time.perf_counter()
+        found = index.search(phrase)
+        if args.debug:
+            print("[DEBUG] {n} occurrences among {notes} notes in {ms:.1f} ms".format(n=len(found), notes=index.notes(),
+                ms=(time.perf_counter() - start) * 1000), file=sys.stderr)
+    if args.first:
+        found = found[:1]
+    if args.json:
+        print(json.dumps(found, ensure_ascii=False, indent=2))
+        sys.exit(0)
+    if not found:
+        print("No occurrences of '" + phrase + "'")
+        sys.exit(0)
+    print("First:", end=" ")
+    print_occurrence(found[0])
+    if not args.first:
+        print("All ({n} in {notes} notes):".format(n=len(found), notes=len(set(x["medicalsn"] for x in found))))
+        for x in found:
+            print_occurrence(x)
@@ -7,12 +7,6 @@
 # License: coffeeware
 # Initially created in September 2019
 
-# Notes on the use of old asyncio syntax:
-# I wrote this script using an older version of Python 3 (specifically version
-# 3.6.8), whose asyncio module has not yet implemented the run() function.
-# I'll probably get around to changing this once the version of Python 3 for
-# Xubuntu has been bumped up.to 3.7 or later. --cyyen 2019-09-13
-
 # Note on the range of time to summarize:
 # Initially I assumed that the time range to summarize would be from the evening
 # the day before to this morning, but that's assuming the previous day was a
@@ -21,120 +15,132 @@
 # last 24 hours. --cyyen 2019-09-15
 
 import argparse
-import asyncio
-import csv
+import concurrent.futures
 import datetime
-import glob
 import os
 import pathlib
-import subprocess
 import sys
 import time
-import urllib.request
 
 import jinja2
 
+import emr_encounters
+import emr_nursing
+import emr_orders
+import emr_vitals
+from lib import client
+from lib import metrics
+from lib import session
+
+def summarize_patient(args, chartno, lastoffservicetime):
+    """Retrieves vitals, nursing records and orders of a patient since lastoffservicetime.
+
+    The tools' outputs are also written to a subdirectory of args.outputdir
+    named after the chart number, as when running them separately.
+
+    Args:
+        args (argparse.Namespace): Arguments passed to the main program.
+        chartno (str): Chart number, e.g., "12345678".
+        lastoffservicetime (datetime.datetime): Records before this time are left out.
+
+    Returns:
+        dict: Lists of records (dicts keyed by the tools' CSV column names) under 'vitals', 'nursing' and 'orders'.
+
+    """
+    if args.debug:
+        print('[DEBUG] Working on ID number: ', chartno, file=sys.stderr)
+    # EmrQuery session IDs are per patient, but the SSO login is shared
+    patient_args = argparse.Namespace(**vars(args))
+    patient_args.chartno = chartno
+    rooturl = session.get_baseurl(args) + "EmrQuery/" + "(S(" + session.get_sessionid(patient_args) + "))/" + "tree/"
+    ### Get latest encounter code
+    o_list, i_list, e_list = emr_encounters.get_encounters(rooturl, chartno, "2019-01-01", datetime.date.today().isoformat())
+    if not i_list:
+        raise ValueError("no inpatient encounter found")
+    medicalsn = i_list[-1]
+    if args.debug:
+        print('[DEBUG] medicalsn: ', medicalsn, file=sys.stderr)
+    ## Create directory for each patient ID and output there
+    outsubdir = (pathlib.Path(args.outputdir) / chartno).resolve()
+    outsubdir.mkdir(exist_ok=True)
+    ## emr_vitals, emr_nursing and emr_orders
+    def vitals():
+        out = emr_vitals.get_vitals(rooturl, chartno, debug=args.debug)
+        emr_vitals.write_vitals(out, outsubdir, chartno)
+        return out
+    def nursing():
+        out = emr_nursing.get_nursing(rooturl, chartno, medicalsn, debug=args.debug)
+        emr_nursing.write_nursing(out, outsubdir, chartno, medicalsn)
+        return out
+    def orders():
+        out = emr_orders.get_orders(session.get_baseurl(args) + "WebsiteSSO/PCS/", medicalsn)
+        emr_orders.write_orders(out, outsubdir, chartno)
+        return out
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        vitals_out = executor.submit(vitals)
+        nursing_out = executor.submit(nursing)
+        orders_out = executor.submit(orders)
+
+    patient_data = dict()
+    # Patient's name here
+    #patient_data['name'] = ...
+    # Records are passed on as strings, the same as when read back from the tools' CSV files
+    patient_data['vitals'] = list()
+    patient_data['nursing'] = list()
+    patient_data['orders'] = list()
+    for l in (_record(emr_vitals.FIELDS, i) for i in vitals_out.result()):
+        if datetime.datetime.strptime(l['Time'], '%Y-%m-%dT%H:%M') < lastoffservicetime:
+            if args.debug:
+                print('[DEBUG] vitals time: ', l['Time'], file=sys.stderr)
+            continue
+        patient_data['vitals'].append(l)
+    for l in (_record(emr_nursing.FIELDS, i) for i in nursing_out.result()):
+        # Note the slightly different time specs (TODO: unify time specs)
+        if datetime.datetime.strptime(l['Time'], '%Y-%m-%d %H:%M') < lastoffservicetime:
+            if args.debug:
+                print('[DEBUG] nursing time: ', l['Time'], file=sys.stderr)
+            continue
+        patient_data['nursing'].append(l)
+    for l in (_record(emr_orders.FIELDS, i) for i in orders_out.result()):
+        # Note the slightly different time specs (TODO: unify time specs)
+        if datetime.datetime.strptime(l['Time'], '%Y-%m-%d %H:%M:%S') < lastoffservicetime:
+            if args.debug:
+                print('[DEBUG] orders time: ', l['Time'], file=sys.stderr)
+            continue
+        patient_data['orders'].append(l)
+    return patient_data
+
+def _record(fields, row):
+    # Same conversion as writing to and reading back from CSV (None becomes '')
+    return dict(zip(fields, ['' if x is None else str(x) for x in row]))
+
 def generate_summary(args):
     with open(args.chartnofile, 'r') as f:
-        chartnolist = f.readlines()
+        chartnolist = [chartno.strip() for chartno in f.readlines() if chartno.strip()]
     if args.debug:
         print('[DEBUG] chartnolist: ', chartnolist, file=sys.stderr)
+
+    # Default off-service time: 5PM (today (before midnight) or the day before (after midnight))
+    if datetime.datetime.now().time() > datetime.time(17):
+        LASTOFFSERVICETIME = datetime.datetime.now().replace(hour=17, minute=0, second=0, microsecond=0)
+    else:
+        LASTOFFSERVICETIME = (datetime.datetime.now() - datetime.timedelta(1)).replace(hour=17, minute=0, second=0, microsecond=0)
+    if args.debug:
+        print('[DEBUG] LASTOFFSERVICETIME: ', LASTOFFSERVICETIME, file=sys.stderr)
+
+    # Patients are handled concurrently, with at most args.maxconn at a time
+    # (the shared connection pool also caps requests to each server at that)
     patient_data = dict()
-    for chartno in chartnolist:
-        chartno = chartno.strip()
-        if args.debug:
-            print('[DEBUG] Working on ID number: ', chartno, file=sys.stderr)
-        ### Call emr_encounters to get latest encounter code
-        medicalsn = subprocess.run([sys.executable, 'emr_encounters.py', '-u', args.uid, '-p', args.passwd, '-c', chartno, '-l'], stdout=subprocess.PIPE).stdout.decode('utf-8')
-        if args.debug:
-            print('[DEBUG] medicalsn: ', medicalsn, file=sys.stderr)
-        ## Create directory for each patient ID and output there
-        try:
-            if args.debug:
-                print('[DEBUG] Creating subdirectory for {}'.format(chartno), file=sys.stderr)
-            os.mkdir(pathlib.Path(args.outputdir) / chartno)
-        except FileExistsError:
-            if args.debug:
-                print('[INFO] Subdirectory for {} exists, will write into that directory'.format(chartno), file=sys.stderr)
-        outsubdir = (pathlib.Path(args.outputdir) / chartno).resolve()
-        ## emr_vitals
-        ### Needs UID, passwd, chartno
-        @asyncio.coroutine
-        def vitals():
-            proc = asyncio.create_subprocess_exec(sys.executable, 'emr_vitals.py', '-u', args.uid, '-p', args.passwd, '-c', chartno, '-o', str(outsubdir))
-            p = yield from proc
-            yield from p.wait()
-        ## emr_nursing
-        ### Needs UID, passwd, chartno, encounter ID
-        @asyncio.coroutine
-        def nursing():
-            proc = asyncio.create_subprocess_exec(sys.executable, 'emr_nursing.py', '-u', args.uid, '-p', args.passwd, '-c', chartno, '-e', medicalsn, '-o', str(outsubdir))
-            p = yield from proc
-            yield from p.wait()
-        ## emr_orders
-        ### Needs UID, passwd, chartno, encounter ID
-        @asyncio.coroutine
-        def orders():
-            proc = asyncio.create_subprocess_exec(sys.executable, 'emr_orders.py', '-u', args.uid, '-p', args.passwd, '-c', chartno, '-e', medicalsn, '-o', str(outsubdir))
-            p = yield from proc
-            yield from p.wait()
-        if sys.platform == "win32":
-            loop = asyncio.ProactorEventLoop()
-            asyncio.set_event_loop(loop)
-        else:
-            loop = asyncio.get_event_loop()
-        loop.run_until_complete(asyncio.gather(nursing(),orders(),vitals()))
-        loop.close()
-        ## Generate report webpage using Jinja2
-        #vitals_out = next(outsubdir.glob(chartno + "_vitals_" + "*.csv"))
-        vitals_out = max(glob.glob(str(outsubdir / (chartno + "_vitals_*.csv"))), key=os.path.getctime)
-        #nursing_out = outsubdir / (chartno + "_nurs_" + medicalsn + ".csv")
-        #print(str(outsubdir / (chartno + "_nurs_" + str(medicalsn) + "*.csv")))
-        nursing_out = max(glob.glob(str(outsubdir / (chartno + "_nurs_" + medicalsn + "*.csv"))), key=os.path.getctime)
-        #orders_out = next(outsubdir.glob(chartno + "_orders_" + "*.csv"))
-        orders_out = max(glob.glob(str(outsubdir / (chartno + "_orders_*.csv"))), key=os.path.getctime)
-
-        patient_data[chartno] = dict()
-        # Patient's name here
-        #patient_data[chartno]['name'] = ...
-        patient_data[chartno]['vitals'] = list()
-        patient_data[chartno]['nursing'] = list()
-        patient_data[chartno]['orders'] = list()
-
-        # Default off-service time: 5PM (today (before midnight) or the day before (after midnight))
-        if datetime.datetime.now().time() > datetime.time(17):
-            LASTOFFSERVICETIME = datetime.datetime.now().replace(hour=17, minute=0, second=0, microsecond=0)
-        else:
-            LASTOFFSERVICETIME = (datetime.datetime.now() - datetime.timedelta(1)).replace(hour=17, minute=0, second=0, microsecond=0)
-        if args.debug:
-            print('[DEBUG] LASTOFFSERVICETIME: ', LASTOFFSERVICETIME, file=sys.stderr)
-
-        with open(vitals_out, 'r') as f:
-            r = csv.DictReader(f)
-            for l in r:
-                if datetime.datetime.strptime(l['Time'], '%Y-%m-%dT%H:%M') < LASTOFFSERVICETIME:
-                    if args.debug:
-                        print('[DEBUG] vitals time: ', l['Time'], file=sys.stderr)
-                    continue
-                patient_data[chartno]['vitals'].append(l)
-        with open(nursing_out, 'r') as f:
-            r = csv.DictReader(f)
-            for l in r:
-                # Note the slightly different time specs (TODO: unify time specs)
-                if datetime.datetime.strptime(l['Time'], '%Y-%m-%d %H:%M') < LASTOFFSERVICETIME:
-                    if args.debug:
-                        print('[DEBUG] nursing time: ', l['Time'], file=sys.stderr)
-                    continue
-                patient_data[chartno]['nursing'].append(l)
-        with open(orders_out, 'r') as f:
-            r = csv.DictReader(f)
-            for l in r:
-                # Note the slightly different time specs (TODO: unify time specs)
-                if datetime.datetime.strptime(l['Time'], '%Y-%m-%d %H:%M:%S') < LASTOFFSERVICETIME:
-                    if args.debug:
-                        print('[DEBUG] vitals time: ', l['Time'], file=sys.stderr)
-                    continue
-                patient_data[chartno]['orders'].append(l)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.maxconn) as executor:
+        futures = [executor.submit(summarize_patient, args, chartno, LASTOFFSERVICETIME) for chartno in chartnolist]
+        # Keep the order of the chart number file
+        for chartno, future in zip(chartnolist, futures):
+            try:
+                patient_data[chartno] = future.result()
+            except Exception as err:
+                print('[Error] Could not get data for {}: {}'.format(chartno, err), file=sys.stderr)
+
+    ## Generate report webpage using Jinja2
     templateloader = jinja2.FileSystemLoader(searchpath="./")
     templateenv = jinja2.Environment(loader=templateloader, autoescape=True)
     template = templateenv.get_template('summary.html')
@@ -156,16 +162,26 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--passwd", type=str, required=True, help="Password")
     parser.add_argument("-f", "--chartnofile", type=str, help="File containing chart numbers, one on each line", default=pathlib.Path.cwd().parent / 'config' / 'chartno.txt')
     parser.add_argument("-o", "--outputdir", type=str, help="Set output directory", default=pathlib.Path.cwd().parent / 'cache')
+    parser.add_argument("-j", "--maxconn", type=int, help="Maximum number of patients processed (and requests per server) at the same time", default=client.POOLSIZE)
     parser.add_argument("-d", "--daemon", action="store_true", help="Run as daemon")
     parser.add_argument("-t", "--time", type=str, help="Time of day to run (applies to daemon mode only), written as hourminute, e.g., 0630", default="0630")
+    parser.add_argument("--baseurl", type=str, help="Base URL of the hisweb server (e.g. a local test server)", default=session.BASEURL)
+    parser.add_argument("--metrics", type=str, help="Write request/parse timings to this file (Prometheus textfile if it ends in .prom, otherwise appended as JSON lines)")
     parser.add_argument("--version", action="version", version="%(prog)s 0.2.1 'Annihilation'")
     args = parser.parse_args()
+    metrics.setup(args)
+
+    assert args.maxconn > 0, "Number of concurrent patients must be positive"
+    client.configure(poolsize=args.maxconn)
 
     if args.daemon:
         run_time = time.strptime(args.time, '%H%M')
         while(True):
-            if time.localtime().tm_hour == run_time.tm_hour and time.localtime().tm_minute == run_time.tm_minute:
+            if time.localtime().tm_hour == run_time.tm_hour and time.localtime().tm_min == run_time.tm_min:
+                # Metrics are reported for each pass, without the time spent waiting
+                metrics.RECORDER.reset()
                 generate_summary(args)
+                metrics.flush()
             time.sleep(60)
     else:
         generate_summary(args)
\ No newline at end of file
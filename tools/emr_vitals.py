@@ -14,11 +14,63 @@ import os
 import pathlib
 import re
 import sys
-import urllib.request
-
-import bs4
 
+from lib import client
+from lib import metrics
+from lib import parse
 from lib import session
+from lib import vitalstore
+
+# Column names of the CSV output
+FIELDS = ["Time", "Temperature", "Pulse", "Respiration", "Systolic_BP", "Diastolic_BP"]
+
+def get_vitals(rooturl, chartno, debug=False):
+    """Retrieves vital signs measured within the past week from the TPR chart.
+
+    Args:
+        rooturl (str): Root URL of the EmrQuery tree pages, including the session ID.
+        chartno (str): Chart number, e.g., "12345678".
+        debug (bool) [optional]: Print debug info.
+
+    Returns:
+        out_list (list): Lists of time (ISO8601) and measurements (str, None if missing) in the order of FIELDS.
+
+    """
+    with client.urlopen(rooturl + "tprm3.aspx?type=tpri&chartno=" + chartno) as f:
+        tprsheet = f.read().decode("utf-8")
+    return parse_vitals(tprsheet, debug)
+
+def parse_vitals(tprsheet, debug=False):
+    """Parses the TPR chart page (tprm3.aspx) into lists in the order of FIELDS (see get_vitals())."""
+    tprsoup = parse.parse(tprsheet, "tpr")
+    measurements = sorted(set([i["title"] for i in tprsoup.findAll("area")]))
+    if debug:
+        print(measurements, file=sys.stderr)
+    out_list = []
+    for datapoint in measurements:
+        i = list(re.search('(\d{4}/\d{2}/\d{2}  \d{2}:\d{2})\n(?:.+體溫 : (\d{2}\.?\d?)\n)?(?:.+脈搏 : (\d{2,3})\n)?(?:.+呼吸 : (\d{2})\n)?(?:.+收縮壓 : (\d{2,3})\n)?(?:.+舒張壓 : (\d{2,3}))?', datapoint).groups())
+        i[0] = datetime.datetime.strptime(i[0], "%Y/%m/%d  %H:%M").strftime("%Y-%m-%dT%H:%M")
+        out_list.append(i)
+    if debug:
+        print(out_list, file=sys.stderr)
+    return out_list
+
+def store_vitals(out_list, chartno, encounterid=None, baseurl=session.BASEURL):
+    """Adds vital signs (see get_vitals()) to the vitals store of the patient (see lib/vitalstore.py) and returns the number of rows added or changed."""
+    store = vitalstore.VitalStore(chartno, encounterid, baseurl=baseurl)
+    # Measurements are in the same order as the channels of the store
+    return store.add((i[0], dict(zip(vitalstore.CHANNELS, i[1:]))) for i in out_list)
+
+def write_vitals(out_list, outputdir, chartno):
+    """Writes vital signs to a timestamped CSV file in outputdir and returns its path."""
+    # Note that the default encoding on other OSs may not be UTF-8
+    outpath = pathlib.Path(outputdir) / (chartno + "_vitals_" + datetime.datetime.now().strftime("%Y-%m-%dT%H%M") + ".csv")
+    with open(outpath, mode="w", encoding="utf-8", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDS)
+        for i in out_list:
+            writer.writerow(i)
+    return outpath
 
 if __name__ == '__main__':
     # Change working directory to location of this script
@@ -33,8 +85,13 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--passwd", type=str, required=True, help="Password")
     parser.add_argument("-c", "--chartno", type=str, required=True, help="Chart number")
     parser.add_argument("-o", "--outputdir", type=str, help="Set output directory", default=pathlib.Path.cwd().parent / 'cache')
+    parser.add_argument("-s", "--store", action="store_true", help="Also add the vital signs to the vitals store of the patient (state/<chartno>_vitals_<encounterid>)")
+    parser.add_argument("-e", "--encounterid", type=str, help="Encounter ID to file the vital signs under in the vitals store (the TPR chart isn't tied to one)")
+    parser.add_argument("--baseurl", type=str, help="Base URL of the hisweb server (e.g. a local test server)", default=session.BASEURL)
+    parser.add_argument("--metrics", type=str, help="Write request/parse timings to this file (Prometheus textfile if it ends in .prom, otherwise appended as JSON lines)")
     parser.add_argument("--version", action="version", version="%(prog)s 0.2.1 'Annihilation'")
     args = parser.parse_args()
+    metrics.setup(args)
 
     # Input validation
     assert re.match('\d{6}', args.uid), "ID number malformed (less than 6 digits)"
@@ -44,25 +101,11 @@ if __name__ == '__main__':
         print("[DEBUG] UID: ", args.uid, file=sys.stderr)
         print("[DEBUG] Chart number: ", args.chartno, file=sys.stderr)
 
-    ROOTURL = "http://hisweb.hosp.ncku/EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
+    ROOTURL = session.get_baseurl(args) + "EmrQuery/" + "(S(" + session.get_sessionid(args) + "))/" + "tree/"
 
-    with urllib.request.urlopen(ROOTURL + "tprm3.aspx?type=tpri&chartno=" + args.chartno) as f:
-        tprsheet = f.read().decode("utf-8")
-    tprsoup = bs4.BeautifulSoup(tprsheet, "html.parser")
-    measurements = sorted(set([i["title"] for i in tprsoup.findAll("area")]))
-    if args.debug:
-        print(measurements, file=sys.stderr)
-    out_list = []
-    for datapoint in measurements:
-        i = list(re.search('(\d{4}/\d{2}/\d{2}  \d{2}:\d{2})\n(?:.+體溫 : (\d{2}\.?\d?)\n)?(?:.+脈搏 : (\d{2,3})\n)?(?:.+呼吸 : (\d{2})\n)?(?:.+收縮壓 : (\d{2,3})\n)?(?:.+舒張壓 : (\d{2,3}))?', datapoint).groups())
-        i[0] = datetime.datetime.strptime(i[0], "%Y/%m/%d  %H:%M").strftime("%Y-%m-%dT%H:%M")
-        out_list.append(i)
-    if args.debug:
-        print(out_list, file=sys.stderr)
-    # Note that the default encoding on other OSs may not be UTF-8
-    outpath = pathlib.Path(args.outputdir) / (args.chartno + "_vitals_" + datetime.datetime.now().strftime("%Y-%m-%dT%H%M") + ".csv")
-    with open(outpath, mode="w", encoding="utf-8", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["Time", "Temperature", "Pulse", "Respiration", "Systolic_BP", "Diastolic_BP"])
-        for i in out_list:
-            writer.writerow(i)
+    out_list = get_vitals(ROOTURL, args.chartno, debug=args.debug)
+    write_vitals(out_list, args.outputdir, args.chartno)
+    if args.store:
+        n = store_vitals(out_list, args.chartno, args.encounterid, session.get_baseurl(args))
+        if args.debug:
+            print("[DEBUG] Rows added to the vitals store: ", n, file=sys.stderr)
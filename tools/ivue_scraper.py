@@ -18,74 +18,100 @@
 # 0.1.2 (2020-02-01): changed '-f'/'--file' to '-l'/'--list' for clarity; '-f'/'--filetype' now refers to output filetype
 
 import argparse
+import collections
+import concurrent.futures
 import csv
 import datetime
+import hashlib
+import json
 import os
 import pathlib
 import re
+import sqlite3
 import sys
 import time
-import urllib.request
 
-import bs4
+from lib import client
+from lib import metrics
+from lib import parse
+from lib import session
+from lib import vitalstore
 
-def get_ivue_data(baseurl, chartno, encounterid, mode):
+def get_ivue_data(baseurl, chartno, encounterid, modes, state=None):
     """Get tables from the iVue pages, parse them, pass them for further processing, and collect results.
 
     Args:
         baseurl (str): Base URL of the iVue interface, e.g. "http://192.168.202.9/iVue/".
         chartno (str): Chart number, e.g., "12345678".
         encounterid (str): Encounter ID, e.g., "I20190014727".
-        mode (str): Type of data to retrieve, e.g., 'hr' (heart rate)
+        modes (list): Types of data to retrieve, e.g., ['hr', 'rr'] (heart rate and respiratory rate)
+        state (dict) [optional]: What was already retrieved for this encounter (used in daemon mode, and updated
+            in place). TPR sheet pages are only fetched back to the newest time seen before, and modes from
+            the basic info and handover sheets are left out of the results if those sheets haven't changed.
 
     Returns:
-        results (dict): Dict of results. Keys are datetime.datetime objects while values are strings.
+        results (dict): Dict of results for each mode. Each is a dict whose keys are datetime.datetime objects
+            while values are strings.
 
     """
-    page = urllib.request.urlopen(baseurl + 'patient.aspx?ChartNo=' + chartno + '&CaseNo=' + encounterid).read().decode()
-    soup = bs4.BeautifulSoup(page, 'lxml')
-    id = re.search('patientEncounter.aspx\?Page=1\-(\d+)\-1', str(soup)).groups()[0]
+    page = client.urlopen(baseurl + 'patient.aspx?ChartNo=' + chartno + '&CaseNo=' + encounterid).read().decode()
+    id = re.search('patientEncounter.aspx\?Page=1\-(\d+)\-1', page).groups()[0]
 
     # Basic info: probably one page only
     # TPR sheet: many pages
     # ICU monitor: many pages
     # ICU handover: probably one page only
 
-    if mode == 'temp':
-        if args.allrecords:
-            results = dict()
-            for i in map(lambda x: temp(x), get_page_soup(baseurl, id, 2)):
-                results.update(i)
-        else:
-            results = temp(next(get_page_soup(baseurl, id, 2)))
-    if mode == 'hr':
-        if args.allrecords:
-            results = dict()
-            for i in map(lambda x: hr(x), get_page_soup(baseurl, id, 2)):
-                results.update(i)
+    results = dict()
+
+    # Each sheet is fetched once per encounter and every requested mode is
+    # parsed from the same pages
+    tpr_modes = [m for m in modes if m in TPR_MODES]
+    if tpr_modes:
+        for m in tpr_modes:
+            results[m] = dict()
+        newest = None
+        if state is not None and state.get('tpr_newest'):
+            newest = datetime.datetime.strptime(state['tpr_newest'], '%Y-%m-%d %H:%M:%S')
+        if newest:
+            # Page back from the newest page until reaching known data
+            tprsheets = get_page_soup(baseurl, id, 2)
+        elif args.allrecords:
+            tprsheets = get_page_soup(baseurl, id, 2, args.prefetch)
         else:
-            results = hr(next(get_page_soup(baseurl, id, 2)))
-    if mode == 'rr':
-        if args.allrecords:
-            results = dict()
-            for i in map(lambda x: rr(x), get_page_soup(baseurl, id, 2)):
-                results.update(i)
-        else:
-            results = rr(next(get_page_soup(baseurl, id, 2)))
-    if mode == 'surgery':
-        # '--allrecords' argument silently ignored
-        results = surgery(next(get_page_soup(baseurl, id, 1)), next(get_page_soup(baseurl, id, 8)))
-    if mode == 'respiration':
-        # '--allrecords' argument silently ignored
-        results = respiration(next(get_page_soup(baseurl, id, 1)), next(get_page_soup(baseurl, id, 8)))
-    if mode == 'cxr':
-        # '--allrecords' argument silently ignored
-        results = cxr(next(get_page_soup(baseurl, id, 1)), next(get_page_soup(baseurl, id, 8)))
-    if mode == 'vaccine':
-        # '--allrecords' argument silently ignored
-        results = vaccine(next(get_page_soup(baseurl, id, 8)))
+            tprsheets = [next(get_page_soup(baseurl, id, 2))]
+        for tprsheet_soup in tprsheets:
+            for m in tpr_modes:
+                results[m].update(TPR_MODES[m](tprsheet_soup))
+            times = tpr_times(tprsheet_soup)
+            if state is not None and times and str(max(times)) > state.get('tpr_newest', ''):
+                state['tpr_newest'] = str(max(times))
+            if newest and (not times or min(times) <= newest):
+                break
+    # '--allrecords' argument silently ignored for the remaining modes
+    if any(m in HANDOVER_MODES or m == 'vaccine' for m in modes):
+        icuhandover_soup = next(get_page_soup(baseurl, id, 8))
+    if any(m in HANDOVER_MODES for m in modes):
+        basicinfo_soup = next(get_page_soup(baseurl, id, 1))
+    if state is not None and any(m in HANDOVER_MODES or m == 'vaccine' for m in modes):
+        # Only the data table is hashed, since the rest of the page may differ between requests
+        sheets = [icuhandover_soup] + ([basicinfo_soup] if any(m in HANDOVER_MODES for m in modes) else [])
+        digest = hashlib.sha1(''.join(str(s.find('table', {'class': 'mainTBL'})) for s in sheets).encode()).hexdigest()
+        if digest == state.get('handover_hash'):
+            modes = [m for m in modes if m not in HANDOVER_MODES and m != 'vaccine']
+        state['handover_hash'] = digest
+    for m in modes:
+        if m in HANDOVER_MODES:
+            results[m] = HANDOVER_MODES[m](basicinfo_soup, icuhandover_soup)
+    if 'vaccine' in modes:
+        results['vaccine'] = vaccine(icuhandover_soup)
     return results
 
+def tpr_times(tprsheet_soup):
+    """Returns the times of all columns of a TPR sheet page as datetime.datetime objects."""
+    times = tprsheet_soup.find('table', {'class': 'mainTBL'}).find('td', string=re.compile('time')).parent.find_all('td')
+    return [datetime.datetime.strptime(t.text, "%d-%m-%Y %H:%M") for t in times[1:] if t.text]
+
 ## Modes of data-fetching
 
 def temp(tprsheet_soup):
@@ -250,6 +276,12 @@ def vaccine(icuhandover_soup):
 
 ## Housekeeping functions
 
+# Parsers for each mode, by the sheets they need: the TPR sheet (sheet 2), or
+# basic info (sheet 1) and the ICU handover sheet (sheet 8)
+TPR_MODES = {'temp': temp, 'hr': hr, 'rr': rr}
+HANDOVER_MODES = {'surgery': surgery, 'respiration': respiration, 'cxr': cxr}
+MODES = list(TPR_MODES) + list(HANDOVER_MODES) + ['vaccine']
+
 def parse_entries(hx, admission_date):
     """Parses history and yields entries. *Critical assumption is that year rollover will occur only once at most.*
 
@@ -295,9 +327,13 @@ def parse_entries(hx, admission_date):
             continue
         yield list([date, contents])
 
-def get_page_soup(baseurl, id, sheetno):
+def get_page_soup(baseurl, id, sheetno, prefetch=1):
     """Returns a generator yielding parsed pages; each call returns the previous page.
 
+    With prefetch > 1, the following pages are fetched (and parsed) ahead of
+    time by that many concurrent requests. Pages are still yielded in order,
+    but up to prefetch - 1 requests past the last page are wasted.
+
     Args:
         baseurl (str): Base URL of the iVue interface, e.g. "http://192.168.202.9/iVue/"
         id (str or int): ID code used by the iVue server, unique to every encounter, e.g. "59829"
@@ -311,9 +347,10 @@ def get_page_soup(baseurl, id, sheetno):
             7: Wound nursing records
             8: Pediatric ICU / Newborn ICU handover sheet
             9998: Nursing handover sheet (links to physician notes on another server; each note identified with UUID)
+        prefetch (int) [optional]: Number of pages to fetch concurrently (1 fetches pages one by one)
 
     Yields:
-        page_soup (bs4.BeautifulSoup): a BeautifulSoup object created by parsing the page
+        page_soup (bs4.BeautifulSoup): a BeautifulSoup object created by parsing the data table of the page (see lib/parse.py)
 
     Examples:
 
@@ -321,24 +358,45 @@ def get_page_soup(baseurl, id, sheetno):
         [<class 'bs4.BeautifulSoup'>, <class 'bs4.BeautifulSoup'>, ...]
 
     """
-    count = 1
-    while True:
-        page = urllib.request.urlopen(baseurl + 'patientEncounter.aspx?Page=' + str(sheetno) + '-' + str(id) + '-' + str(count)).read().decode()
-        page_soup = bs4.BeautifulSoup(page, 'lxml')
-        yield page_soup
-        # For debugging
-        if args.debug and count > 100:
-            print("[DEBUG] Halting after count > 100.", file=sys.stderr)
-            break
-        # Search for link to previous page and stop if no link found
-        count += 12
-        page_prev = page_soup.find('a', {'href': re.compile('patientEncounter.aspx\?Page='+str(sheetno)+'\-.+\-'+str(count)+'$')})
-        if not page_prev:
-            break
+    def fetch(count):
+        with metrics.timed('get_page_soup (sheet ' + str(sheetno) + ')'):
+            page = client.urlopen(baseurl + 'patientEncounter.aspx?Page=' + str(sheetno) + '-' + str(id) + '-' + str(count)).read().decode()
+            # Only the data table is parsed, so look for the link to the previous page in the raw page
+            page_prev = re.search('[\'"][^\'"]*patientEncounter.aspx\?Page='+str(sheetno)+'\-[^\'"]+\-'+str(count+12)+'[\'"]', page)
+            return parse.parse(page, 'ivue'), page_prev
 
-def writeout(output, outputdir, chartno, encounterid, mode):
-#def writeout(output, outputdir, chartno, encounterid, mode, filetype="csv"):
-    """Write retrieved iVue data to CSV output (UTF-8 encoding).
+    count = 1
+    # Pages are numbered 1, 13, 25, ...; keep up to 'prefetch' of them in flight
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch) if prefetch > 1 else None
+    pending = collections.deque()
+    next_count = count
+    try:
+        while True:
+            if executor:
+                while len(pending) < prefetch:
+                    pending.append(executor.submit(fetch, next_count))
+                    next_count += 12
+                page_soup, page_prev = pending.popleft().result()
+            else:
+                page_soup, page_prev = fetch(count)
+            yield page_soup
+            # For debugging
+            if args.debug and count > 100:
+                print("[DEBUG] Halting after count > 100.", file=sys.stderr)
+                break
+            # Search for link to previous page and stop if no link found
+            count += 12
+            if not page_prev:
+                break
+    finally:
+        if executor:
+            # Requests past the last page are discarded (including any errors they raised)
+            for f in pending:
+                f.cancel()
+            executor.shutdown(wait=False)
+
+def writeout(output, outputdir, chartno, encounterid, mode, filetype="csv", append=False):
+    """Write retrieved iVue data to CSV output (UTF-8 encoding) or to the SQLite database in outputdir (see SQLITE_SCHEMA).
 
     Args:
         output (dict): Dictionary containing retrieved data. Keys are datetime.datetime objects, while values are strings.
@@ -347,6 +405,8 @@ def writeout(output, outputdir, chartno, encounterid, mode):
         encounterid (str): Encounter ID, e.g., "I20190014727".
         mode (str): Type of data to retrieve, e.g., 'hr' (heart rate)
         filetype (str) [optional]: Filetype to write to (CSV or SQLite)
+        append (bool) [optional]: Append to the CSV file instead of overwriting it (records must be newer than
+            those already in the file)
 
     Returns:
         No return value.
@@ -359,21 +419,59 @@ def writeout(output, outputdir, chartno, encounterid, mode):
         # Note that the default encoding on certain OSs may not be UTF-8
         outpath = pathlib.Path(outputdir) / (chartno + '_' + encounterid + '_icu_' + mode + '.csv')
         #outpath = pathlib.Path(args.outputdir) / (chartno + '_' + encounterid + '_icu_' + args.mode + '.csv')
-        with open(outpath, mode='w', encoding='utf-8', newline='') as csvfile:
+        append = append and outpath.exists()
+        with open(outpath, mode='a' if append else 'w', encoding='utf-8', newline='') as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow(['Date', 'Event'])
+            if not append:
+                writer.writerow(['Date', 'Event'])
             for i in sorted(output.keys()):
                 writer.writerow([i, output[i]])
     elif filetype == "sqlite":
-        # TODO: implement sqlite output
-        pass
-
-def run_scraper(baseurl, args):
+        conn = sqlite3.connect(str(pathlib.Path(outputdir) / SQLITE_FILENAME))
+        try:
+            conn.executescript(SQLITE_SCHEMA)
+            rows = [(str(i), output[i], encounterid, mode) for i in sorted(output.keys())]
+            # Upsert in a single transaction. Done as UPDATE + INSERT OR IGNORE
+            # rather than INSERT ... ON CONFLICT, which needs SQLite 3.24+;
+            # unchanged rows are left alone either way.
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO encounters (encounterid, chartno) VALUES (?, ?)', (encounterid, chartno))
+                conn.executemany('UPDATE records SET value = ?2 WHERE encounterid = ?3 AND mode = ?4 AND timestamp = ?1 AND value IS NOT ?2', rows)
+                conn.executemany('INSERT OR IGNORE INTO records (timestamp, value, encounterid, mode) VALUES (?, ?, ?, ?)', rows)
+        finally:
+            conn.close()
+
+# SQLite output: one database per output directory, one row per record.
+# Timestamps are stored as 'YYYY-MM-DD HH:MM:SS' (as in the CSV output) so
+# that they sort and compare correctly as text.
+SQLITE_FILENAME = 'ivue.sqlite'
+SQLITE_SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS encounters (
+    encounterid TEXT PRIMARY KEY,
+    chartno TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS encounters_chartno ON encounters (chartno);
+CREATE TABLE IF NOT EXISTS records (
+    encounterid TEXT NOT NULL REFERENCES encounters (encounterid),
+    mode TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (encounterid, mode, timestamp)
+);
+CREATE INDEX IF NOT EXISTS records_mode_timestamp ON records (mode, timestamp);
+CREATE VIEW IF NOT EXISTS records_by_chartno AS
+    SELECT chartno, encounterid, mode, timestamp, value FROM records JOIN encounters USING (encounterid);
+"""
+
+def run_scraper(baseurl, args, state=None):
     """Runs scraper for all provided chart numbers and encounter IDs, then writes data by calling writeout().
 
     Args:
         baseurl (str): Base URL of the iVue interface, e.g. "http://192.168.202.9/iVue/"
         args (argparse.Namespace): Arguments passed to the main program
+        state (dict) [optional]: What has been retrieved and written so far, keyed by encounter ID (daemon
+            mode). If given, only new data is fetched and only new or changed TPR records are written.
 
     Returns:
         bool: True for sucess, false otherwise
@@ -385,20 +483,126 @@ def run_scraper(baseurl, args):
         with open(args.list, 'r') as fh:
             reader = csv.DictReader(fh)
             # ICU data is only extracted if the patient is admitted
-            encounters = [r for r in reader if r['Encounter_ID'][0] == 'I']
-        for e in encounters:
-            out = get_ivue_data(baseurl, e['Chart_number'], e['Encounter_ID'], args.mode)
-            writeout(out, args.outputdir, e['Chart_number'], e['Encounter_ID'], args.mode, filetype=args.filetype)
+            encounters = [(r['Chart_number'], r['Encounter_ID']) for r in reader if r['Encounter_ID'][0] == 'I']
     elif args.chartno and args.encounterid:
         if args.debug:
             print('[DEBUG] Fetching data for chart number ', args.chartno, ', encounter ID ', args.encounterid, file=sys.stderr)
-        out = get_ivue_data(baseurl, args.chartno, args.encounterid, args.mode)
-        writeout(out, args.outputdir, args.chartno, args.encounterid, args.mode, filetype=args.filetype)
+        encounters = [(args.chartno, args.encounterid)]
     else:
         print("[ERROR] Missing chart number(s) and encounter ID(s)", file=sys.stderr)
         return False
+    for chartno, encounterid in encounters:
+        try:
+            scrape(baseurl, args, chartno, encounterid, state)
+        except Exception as err:
+            if state is None:
+                raise
+            # The daemon carries on with the other encounters; what wasn't written is tried again next pass
+            print('[Error] Could not scrape encounter ID', encounterid, ':', err, file=sys.stderr)
     return True
 
+def scrape(baseurl, args, chartno, encounterid, state=None):
+    """Retrieves and writes data for one encounter (see run_scraper())."""
+    if state is None:
+        out = get_ivue_data(baseurl, chartno, encounterid, args.mode)
+        if args.store:
+            store_vitals(out, chartno, encounterid, storeurl(args))
+        for mode in out:
+            writeout(out[mode], args.outputdir, chartno, encounterid, mode, filetype=args.filetype)
+        return
+    encounter_state = state.setdefault(encounterid, {'written': dict()})
+    # What was fetched (newest TPR time, handover hash) is only taken into
+    # the state once everything has been written, so a failed write is
+    # retried on the next pass
+    fetched = {k: v for k, v in encounter_state.items() if k != 'written'}
+    # The newest TPR time is kept for the encounter, not per mode, so a TPR
+    # mode not written before (e.g. added when the daemon was restarted) is
+    # fetched as for a new encounter rather than back to that time only
+    if any(m in TPR_MODES and m not in encounter_state['written'] for m in args.mode):
+        fetched.pop('tpr_newest', None)
+    out = get_ivue_data(baseurl, chartno, encounterid, args.mode, fetched)
+    if args.store:
+        n = store_vitals(out, chartno, encounterid, storeurl(args))
+        if args.debug:
+            print('[DEBUG] ', n, ' rows added to the vitals store for encounter ID ', encounterid, file=sys.stderr)
+    for mode in out:
+        if mode not in TPR_MODES:
+            # Handover sheet has changed: rewrite from scratch
+            writeout(out[mode], args.outputdir, chartno, encounterid, mode, filetype=args.filetype)
+            continue
+        # TPR records are written if their time is new or their value has
+        # changed (e.g. charted late for an earlier column), going by the
+        # hash of each record written
+        written = encounter_state['written'].get(mode)
+        if isinstance(written, str):
+            # State from before hashes were kept (newest time written only)
+            written = {str(k): record_hash(v) for k, v in read_csv(args.outputdir, chartno, encounterid, mode).items()} if args.filetype == 'csv' else dict()
+        new = {k: v for k, v in out[mode].items() if written is None or written.get(str(k)) != record_hash(v)}
+        if args.debug:
+            print('[DEBUG] ', len(new), ' new ', mode, ' records for encounter ID ', encounterid, file=sys.stderr)
+        if args.filetype == 'sqlite' or written is None:
+            writeout(new, args.outputdir, chartno, encounterid, mode, filetype=args.filetype)
+        elif new and min(str(k) for k in new) > max(written, default=''):
+            writeout(new, args.outputdir, chartno, encounterid, mode, filetype=args.filetype, append=True)
+        elif new:
+            # Earlier records were added or changed: rewrite the file with them
+            records = read_csv(args.outputdir, chartno, encounterid, mode)
+            records.update(new)
+            writeout(records, args.outputdir, chartno, encounterid, mode, filetype=args.filetype)
+        written = written or dict()
+        written.update((str(k), record_hash(v)) for k, v in new.items())
+        encounter_state['written'][mode] = written
+    encounter_state.update(fetched)
+
+def record_hash(value):
+    """Returns a short hash of the value of a record, to tell whether it has changed since written."""
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()[:16]
+
+def read_csv(outputdir, chartno, encounterid, mode):
+    """Reads back the records of a CSV file written by writeout() (empty if there is none)."""
+    outpath = pathlib.Path(outputdir) / (chartno + '_' + encounterid + '_icu_' + mode + '.csv')
+    try:
+        with open(outpath, mode='r', encoding='utf-8', newline='') as csvfile:
+            return {datetime.datetime.strptime(r['Date'], '%Y-%m-%d %H:%M:%S'): r['Event'] for r in csv.DictReader(csvfile)}
+    except OSError:
+        return dict()
+
+def storeurl(args):
+    """Returns the URL the vitals store of a patient is keyed by (see session.statekey()): that of hisweb for the iVue server of the hospital, --baseurl otherwise."""
+    return getattr(args, 'baseurl', None) or session.BASEURL
+
+def store_vitals(out, chartno, encounterid, baseurl=session.BASEURL):
+    """Adds the TPR sheet records of out (see get_ivue_data()) to the vitals store of the patient (see lib/vitalstore.py) and returns the number of rows added or changed."""
+    rows = collections.defaultdict(dict)
+    # Modes of the TPR sheet are channels of the store
+    for mode in TPR_MODES:
+        for t, v in out.get(mode, dict()).items():
+            rows[t][mode] = v
+    return vitalstore.VitalStore(chartno, encounterid, baseurl=baseurl).add(rows.items())
+
+def load_state(outputdir):
+    """Loads daemon state saved by save_state() (empty if there is none)."""
+    try:
+        with open(pathlib.Path(outputdir) / STATE_FILENAME, 'r', encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return dict()
+
+def save_state(outputdir, state):
+    """Saves daemon state, so that a restarted daemon carries on where it left off."""
+    # Written to a temporary file first, so that a daemon killed while
+    # writing keeps the state of the last pass
+    statepath = pathlib.Path(outputdir) / STATE_FILENAME
+    tmppath = statepath.with_name(statepath.name + '.%d.tmp' % os.getpid())
+    with open(tmppath, 'w', encoding='utf-8') as fh:
+        json.dump(state, fh)
+    os.replace(tmppath, statepath)
+
+# Daemon state: per encounter ID, the newest TPR sheet time fetched, a hash
+# of the basic info/handover sheets and a hash of each TPR record written
+# (by time) per mode
+STATE_FILENAME = 'ivue_state.json'
+
 if __name__ == '__main__':
     # Change working directory to location of this script
     try:
@@ -411,27 +615,40 @@ if __name__ == '__main__':
     parser.add_argument("--debug", action="store_true", help="Print debug info")
     #parser.add_argument("-u", "--uid", type=str, required=True, help="User ID")
     #parser.add_argument("-p", "--passwd", type=str, required=True, help="Password")
-    parser.add_argument("-a", "--allrecords", action="store_true", help="Retrieve requested records from all pages for this encounter. *Note: This option will hammer the server hard and is IGNORED if running as daemon.*")
+    parser.add_argument("-a", "--allrecords", action="store_true", help="Retrieve requested records from all pages for this encounter. *Note: This option will hammer the server hard. If running as daemon, it only applies to encounters not seen before; after that only pages with new data are fetched.*")
+    parser.add_argument("-P", "--prefetch", type=int, help="Number of pages to fetch concurrently with '--allrecords'", default=1)
     parser.add_argument("-d", "--daemon", action="store_true", help="Run as daemon")
     parser.add_argument("-i", "--interval", type=int, help="Interval between checks (in seconds)", default=1800)
     parser.add_argument("-s", "--server", type=str, help="IP of iVue server", default="192.168.202.9")
+    parser.add_argument("--baseurl", type=str, help="Base URL of the iVue interface (overrides --server, e.g. for a local test server)")
     parser.add_argument("-l", "--list", type=str, help="List (CSV format) containing chart number and encounter ID, with header line ('Chart_number','Encounter_ID')")
     parser.add_argument("-c", "--chartno", type=str, required=('-f' not in sys.argv) and ('--file' not in sys.argv), help="Chart number")
     parser.add_argument("-e", "--encounterid", type=str, required=('-f' not in sys.argv) and ('--file' not in sys.argv), help="Encounter ID")
-    parser.add_argument("-m", "--mode", type=str, choices=["temp", "hr", "rr", "surgery", "respiration", "cxr", "vaccine"], help="Type of record to output", default="respiration")
+    parser.add_argument("-m", "--mode", type=str, nargs="+", choices=MODES + ["all"], help="Type(s) of record to output, one file each ('all' for every type)", default=["respiration"])
     #parser.add_argument("-n", "--nounits", action="store_true", help="Do not output measurement units")
     parser.add_argument("-f", "--filetype", type=str, choices=["csv","sqlite"], help="Output file format (CSV or SQLite)", default="csv")
     parser.add_argument("-o", "--outputdir", type=str, help="Set output directory", default=pathlib.Path.cwd())
+    parser.add_argument("-S", "--store", action="store_true", help="Also add temp/hr/rr records to the vitals store of the patient (state/<chartno>_vitals_<encounterid>)")
+    parser.add_argument("--metrics", type=str, help="Write request/parse timings to this file (Prometheus textfile if it ends in .prom, otherwise appended as JSON lines)")
     parser.add_argument("--version", action="version", version="%(prog)s 0.1.2 'Bicycle Repair Man'")
     args = parser.parse_args()
+    metrics.setup(args)
 
     # Input validation
     if args.chartno:
         assert re.match('\d{8}', args.chartno), 'Chart number malformed (less than 8 digits)'
+    assert args.prefetch > 0, 'Number of pages to prefetch must be positive'
+    if 'all' in args.mode:
+        args.mode = MODES
+    # Drop duplicates but keep the order given
+    args.mode = list(dict.fromkeys(args.mode))
+    client.configure(poolsize=max(args.prefetch, client.POOLSIZE))
 
     # Example URL: http://192.168.202.9/iVue/patient.aspx?ChartNo=19314023&CaseNo=I20190014727
     # TODO: Potential for URL injection here...needs a safety check
-    BASEURL = 'http://' + args.server + '/iVue/'
+    BASEURL = args.baseurl or 'http://' + args.server + '/iVue/'
+    if not BASEURL.endswith('/'):
+        BASEURL += '/'
 
     if args.debug:
         print('[DEBUG] BASEURL is: ', BASEURL, file=sys.stderr)
@@ -440,12 +657,16 @@ if __name__ == '__main__':
     if args.daemon:
         if args.debug:
             print('[DEBUG] Running as daemon with process ID ', os.getpid(), ' and an update interval of ', args.interval, ' seconds.', file=sys.stderr)
-        # Ignore switch to get all records since most of the returned data is the same and static
-        if args.allrecords:
-            args.allrecords = False
+        # Only new data is fetched and written on each pass; what has been
+        # seen so far is kept in the output directory
+        state = load_state(args.outputdir)
         while True:
             print(time.ctime(), "Getting data...")
-            run_scraper(BASEURL, args)
+            # Metrics are reported for each pass, without the time spent waiting
+            metrics.RECORDER.reset()
+            run_scraper(BASEURL, args, state)
+            save_state(args.outputdir, state)
+            metrics.flush()
             print(time.ctime(), "Finished writing to file.")
             time.sleep(args.interval)
     else:
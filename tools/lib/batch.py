@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+# batch.py - running a tool over a list of patients ('--chartnofile')
+#
+# Tools that work on one patient (emr_encounters.py, emr_diagnosis.py,
+# emr_diff.py) can instead be given a file of chart numbers. The SSO login
+# happens once and is shared by all patients (EmrQuery session IDs are per
+# patient, but only take a request each), patients are processed
+# concurrently (at most --maxconn at a time), and an index of the output of
+# each patient is written alongside (template batch.html).
+
+import argparse
+import concurrent.futures
+import datetime
+import os
+import pathlib
+import re
+import sys
+
+import jinja2
+
+from lib import session
+
+def read_chartnos(path):
+    """Reads chart numbers from a file, one on each line (blank lines and lines starting with '#' are skipped).
+
+    Raises:
+        AssertionError if a chart number is malformed.
+
+    """
+    with open(path, mode='r', encoding='utf-8') as f:
+        chartnos = [x.strip() for x in f if x.strip() and not x.strip().startswith('#')]
+    for chartno in chartnos:
+        assert re.match(r'^\d{8}$', chartno), "Chart number malformed: " + chartno
+    # Each patient only once, in the order of the file
+    return list(dict.fromkeys(chartnos))
+
+def patient_rooturl(args, chartno):
+    """Returns the root URL of the EmrQuery tree pages of a patient (including the session ID), logging in if needed."""
+    patient_args = argparse.Namespace(**vars(args))
+    patient_args.chartno = chartno
+    return session.get_baseurl(args) + "EmrQuery/" + "(S(" + session.get_sessionid(patient_args) + "))/" + "tree/"
+
+def run(chartnos, process, workers, debug=False):
+    """Calls process(chartno) for each patient, at most workers at a time.
+
+    A patient that fails is reported and left out; the others carry on.
+
+    Returns:
+        list: (chart number, return value of process or None, error message or None), in the order of chartnos.
+
+    """
+    results = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process, chartno) for chartno in chartnos]
+        for chartno, future in zip(chartnos, futures):
+            try:
+                results.append((chartno, future.result(), None))
+                if debug:
+                    print('[DEBUG] Done with chart number', chartno, file=sys.stderr)
+            except Exception as err:
+                print('[Error] Could not process {}: {}'.format(chartno, err), file=sys.stderr)
+                results.append((chartno, None, str(err)))
+    return results
+
+def write_index(results, outputdir, tool, kind, startdate, enddate):
+    """Writes the index of a batch run to outputdir and returns its path.
+
+    Args:
+        results (list): As returned by run(), with the path of the output of each patient as return value.
+        outputdir (str or pathlib.Path): Output directory of the tool.
+        tool (str): Name of the tool.
+        kind (str): Kind of output, as in the file names of the tool (e.g. 'diag').
+        startdate (str): Starting date in ISO8601 format.
+        enddate (str): Ending date in ISO8601 format.
+
+    """
+    outpath = pathlib.Path(outputdir) / ('batch_' + kind + '_' + startdate + '_' + enddate + '.html')
+    rows = [{'chartno': chartno, 'output': os.path.relpath(path, outputdir) if path else None, 'error': error}
+        for chartno, path, error in results]
+    templateloader = jinja2.FileSystemLoader(searchpath=pathlib.Path(__file__).resolve().parent.parent)
+    templateenv = jinja2.Environment(loader=templateloader, autoescape=True)
+    template = templateenv.get_template('batch.html')
+    with open(outpath, mode='w', encoding='utf-8') as fh:
+        print(template.render(rows=rows, tool=tool, startdate=startdate, enddate=enddate,
+            date=datetime.datetime.now().strftime('%Y-%m-%dT%H%M')), file=fh)
+    return outpath
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+# client.py - keep-alive HTTP client shared by the tools
+#
+# urllib.request.urlopen() opens a new TCP connection for every page (and
+# sends "Connection: close"), which is most of the cost when a tool fetches
+# hundreds of pages from the same EMR/iVue host. This module keeps a pool of
+# HTTP/1.1 connections per host instead and plugs into urllib as a handler,
+# so cookie handling, redirects and HTTP errors work the same as before.
+
+import concurrent.futures
+import gzip
+import http.client
+import io
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import urllib.response
+import zlib
+
+from lib import metrics
+
+# Maximum number of connections kept open to a single host; requests beyond
+# this number wait for a free connection
+POOLSIZE = 4
+# Socket timeout (in seconds) for connecting and reading
+TIMEOUT = 60
+
+# Errors seen when the server has quietly closed an idle keep-alive connection
+_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+class ConnectionPool:
+    """Pool of keep-alive connections to a single host.
+
+    Args:
+        host (str): Host name (optionally with port) to connect to.
+        size (int): Maximum number of connections in use at the same time.
+        timeout (int or float): Socket timeout in seconds.
+
+    """
+    def __init__(self, host, size, timeout):
+        self.host = host
+        self.timeout = timeout
+        self._idle = list()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        """Waits for a free slot and returns a tuple (connection, reused)."""
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return http.client.HTTPConnection(self.host, timeout=self.timeout), False
+
+    def release(self, conn, reusable=True):
+        """Returns a connection to the pool (or closes it if it can't be reused)."""
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = list()
+
+class Client:
+    """HTTP client keeping one connection pool per host.
+
+    Args:
+        poolsize (int): Maximum number of connections per host.
+        timeout (int or float): Socket timeout in seconds.
+
+    """
+    def __init__(self, poolsize=POOLSIZE, timeout=TIMEOUT):
+        self.poolsize = poolsize
+        self.timeout = timeout
+        self._pools = dict()
+        self._lock = threading.Lock()
+        self._proxies = urllib.request.getproxies()
+
+    def _pool(self, host):
+        with self._lock:
+            if host not in self._pools:
+                self._pools[host] = ConnectionPool(host, self.poolsize, self.timeout)
+            return self._pools[host]
+
+    def request(self, method, url, body=None, headers=None):
+        """Sends a request and reads the whole (decompressed) response.
+
+        Args:
+            method (str): HTTP method, e.g. "GET".
+            url (str): Absolute URL ("http://" only).
+            body (bytes) [optional]: Request body.
+            headers (dict) [optional]: Request headers.
+
+        Returns:
+            urllib.response.addinfourl: Response object as returned by urllib.request.urlopen().
+
+        Raises:
+            OSError (and subclasses such as http.client.HTTPException) on connection failure.
+
+        """
+        parts = urllib.parse.urlsplit(url)
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        # urllib adds this header itself for every request it sends; drop it
+        headers.pop('Connection', None)
+        target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        host = parts.netloc
+        proxy = self._proxies.get(parts.scheme)
+        if proxy and not urllib.request.proxy_bypass(parts.hostname):
+            # Plain HTTP proxies take the absolute URL as the request target
+            headers.setdefault('Host', parts.netloc)
+            target = urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path or '/', parts.query, ''))
+            host = urllib.parse.urlsplit(proxy).netloc or proxy
+        pool = self._pool(host)
+        start = time.perf_counter()
+        retries = 0
+        # A pooled connection may have been closed by the server in the
+        # meantime, so retry once on a fresh connection in that case
+        while True:
+            conn, reused = pool.acquire()
+            try:
+                conn.request(method, target, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except _STALE_ERRORS as err:
+                pool.release(conn, reusable=False)
+                if reused:
+                    retries += 1
+                    continue
+                metrics.record_request(method, url, None, time.perf_counter() - start, 0, retries, type(err).__name__)
+                raise
+            except BaseException as err:
+                pool.release(conn, reusable=False)
+                metrics.record_request(method, url, None, time.perf_counter() - start, 0, retries, type(err).__name__)
+                raise
+            pool.release(conn, reusable=not response.will_close)
+            break
+        metrics.record_request(method, url, response.status, time.perf_counter() - start, len(data), retries)
+        data = _decode(data, response.headers)
+        out = urllib.response.addinfourl(io.BytesIO(data), response.headers, url, response.status)
+        out.msg = response.reason
+        return out
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools = dict()
+
+def _decode(data, headers):
+    # Undo gzip/deflate content encoding; headers are fixed up to match
+    encoding = headers.get('Content-Encoding', '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        data = gzip.decompress(data)
+    elif encoding == 'deflate':
+        # Some servers send raw deflate streams without the zlib header
+        try:
+            data = zlib.decompress(data)
+        except zlib.error:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+    else:
+        return data
+    del headers['Content-Encoding']
+    del headers['Content-Length']
+    headers['Content-Length'] = str(len(data))
+    return data
+
+class PooledHTTPHandler(urllib.request.HTTPHandler):
+    """urllib handler sending "http://" requests through a Client."""
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def http_open(self, req):
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        try:
+            return self.client.request(req.get_method(), req.full_url, req.data, headers)
+        except OSError as err:
+            raise urllib.error.URLError(err)
+
+_client = None
+_opener = None
+_client_lock = threading.Lock()
+# Extra urllib handlers of the opener used by urlopen() (see add_handler())
+_handlers = list()
+
+def configure(poolsize=POOLSIZE, timeout=TIMEOUT):
+    """Replaces the shared client, e.g. to change the pool size from the command line."""
+    global _client, _opener
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = Client(poolsize, timeout)
+        _opener = None
+
+def add_handler(handler):
+    """Adds a urllib handler to the opener used by urlopen() and fetch_many() (e.g. session.SessionHandler)."""
+    global _opener
+    with _client_lock:
+        _handlers.append(handler)
+        _opener = None
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client()
+        return _client
+
+def build_opener(*handlers):
+    """Same as urllib.request.build_opener(), but with the shared connection pools."""
+    return urllib.request.build_opener(PooledHTTPHandler(get_client()), *handlers)
+
+def urlopen(url, data=None):
+    """Drop-in replacement for urllib.request.urlopen() using the shared connection pools."""
+    global _opener
+    opener = _opener
+    if opener is None:
+        opener = _opener = build_opener(*_handlers)
+    return opener.open(url, data)
+
+def fetch_many(urls, workers=POOLSIZE, encoding='utf-8'):
+    """Fetches pages concurrently, yielding their decoded contents in the same order as urls.
+
+    Args:
+        urls (list): URLs to fetch.
+        workers (int): Maximum number of requests in flight (also capped by the pool size per host).
+        encoding (str) [optional]: Encoding used to decode pages.
+
+    Yields:
+        str: Contents of each page, in the order of urls regardless of which request finishes first.
+
+    """
+    def fetch(url):
+        with urlopen(url) as f:
+            return f.read().decode(encoding)
+    if workers <= 1:
+        for url in urls:
+            yield fetch(url)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(fetch, urls)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+# metrics.py - per-request timings shared by the tools
+#
+# Every request sent through lib/client.py and every page parsed through
+# lib/parse.py is recorded here (URL class, latency, bytes, status, retries
+# and parse time), together with timed sections such as the SSO login. At
+# the end of a run the totals are printed with --debug and, with --metrics,
+# written either as JSON lines (one line per request, appended to the file)
+# or as a Prometheus textfile for the node exporter's textfile collector.
+
+import atexit
+import contextlib
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+
+# Metric names in the Prometheus textfile start with this
+PREFIX = 'emrtools_'
+
+# EmrQuery session IDs ("(S(...))") would give every patient its own URL class
+_session_regex = re.compile(r'\(S\([a-z0-9]+\)\)/')
+
+def url_class(url):
+    """Returns the page a URL points to, without session IDs or patient specific parameters.
+
+    Examples:
+
+        >>> url_class("http://hisweb.hosp.ncku/EmrQuery/(S(abc123))/tree/viewer.aspx?type=soap&medicalsn=O0000001000")
+        'viewer.aspx?type=soap'
+        >>> url_class("http://192.168.202.9/iVue/patientEncounter.aspx?Page=2-59829-13")
+        'patientEncounter.aspx?Page=2'
+
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = _session_regex.sub('', parts.path)
+    segments = [s for s in path.split('/') if s]
+    name = segments[-1] if segments else '/'
+    if path.endswith('/') and segments:
+        name += '/'
+    query = urllib.parse.parse_qs(parts.query)
+    # Keep the parameters selecting the kind of page
+    if 'type' in query:
+        name += '?type=' + query['type'][0]
+    elif 'Page' in query:
+        name += '?Page=' + query['Page'][0].split('-')[0]
+    return name
+
+class Recorder:
+    """Totals (and optionally individual events) of the requests, parses and timed sections of a run."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Individual events are only kept when they are to be written out
+        self.keep_events = False
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.requests = dict()
+            self.parses = dict()
+            self.sections = dict()
+            self.events = list()
+
+    def _event(self, event):
+        if self.keep_events:
+            event['ts'] = round(time.time(), 3)
+            self.events.append(event)
+
+    def request(self, method, url, status, seconds, nbytes, retries=0, error=None):
+        name = url_class(url)
+        with self._lock:
+            r = self.requests.setdefault(name, {'count': 0, 'errors': 0, 'retries': 0, 'bytes': 0, 'seconds': list(), 'status': dict()})
+            r['count'] += 1
+            r['retries'] += retries
+            r['bytes'] += nbytes
+            r['seconds'].append(seconds)
+            key = str(status) if status else 'error'
+            r['status'][key] = r['status'].get(key, 0) + 1
+            if error or not status or status >= 400:
+                r['errors'] += 1
+            self._event({'kind': 'request', 'class': name, 'method': method, 'status': status, 'seconds': round(seconds, 6),
+                'bytes': nbytes, 'retries': retries, 'error': error})
+
+    def parse(self, pagetype, seconds, nbytes):
+        with self._lock:
+            p = self.parses.setdefault(pagetype, {'count': 0, 'bytes': 0, 'seconds': 0.0})
+            p['count'] += 1
+            p['bytes'] += nbytes
+            p['seconds'] += seconds
+            self._event({'kind': 'parse', 'pagetype': pagetype, 'seconds': round(seconds, 6), 'bytes': nbytes})
+
+    def section(self, name, seconds):
+        with self._lock:
+            s = self.sections.setdefault(name, {'count': 0, 'seconds': 0.0})
+            s['count'] += 1
+            s['seconds'] += seconds
+            self._event({'kind': 'section', 'name': name, 'seconds': round(seconds, 6)})
+
+    def totals(self):
+        """Returns (wall seconds, number of requests, bytes received) since the last reset."""
+        with self._lock:
+            return (time.time() - self.started, sum(r['count'] for r in self.requests.values()),
+                sum(r['bytes'] for r in self.requests.values()))
+
+    def summary(self):
+        """Returns the totals as a table for printing."""
+        wall, count, nbytes = self.totals()
+        lines = ["{:<32} {:>6} {:>5} {:>5} {:>9} {:>8} {:>8} {:>8} {:>9}".format(
+            "Request", "n", "err", "retry", "total s", "mean ms", "p50 ms", "max ms", "KiB")]
+        with self._lock:
+            for name, r in sorted(self.requests.items(), key=lambda x: -sum(x[1]['seconds'])):
+                lines.append("{:<32} {:>6} {:>5} {:>5} {:>9.3f} {:>8.1f} {:>8.1f} {:>8.1f} {:>9.1f}".format(name[:32], r['count'],
+                    r['errors'], r['retries'], sum(r['seconds']), 1000 * statistics.mean(r['seconds']),
+                    1000 * statistics.median(r['seconds']), 1000 * max(r['seconds']), r['bytes'] / 1024))
+            if self.parses:
+                lines.append("{:<32} {:>6} {:>9} {:>8} {:>9}".format("Parse", "n", "total s", "mean ms", "KiB"))
+                for name, p in sorted(self.parses.items(), key=lambda x: -x[1]['seconds']):
+                    lines.append("{:<32} {:>6} {:>9.3f} {:>8.1f} {:>9.1f}".format(name, p['count'], p['seconds'],
+                        1000 * p['seconds'] / p['count'], p['bytes'] / 1024))
+            if self.sections:
+                lines.append("{:<32} {:>6} {:>9}".format("Section", "n", "total s"))
+                for name, s in sorted(self.sections.items(), key=lambda x: -x[1]['seconds']):
+                    lines.append("{:<32} {:>6} {:>9.3f}".format(name, s['count'], s['seconds']))
+        lines.append("Run: {:.2f} s, {} requests ({:.1f}/s), {:.1f} KiB received".format(wall, count, count / wall if wall else 0, nbytes / 1024))
+        return "\n".join(lines)
+
+    def write_jsonl(self, path, tool):
+        """Appends the recorded events and a line with the run totals to path."""
+        wall, count, nbytes = self.totals()
+        with self._lock:
+            events = self.events
+            self.events = list()
+        with open(path, mode='a', encoding='utf-8') as fh:
+            for event in events:
+                event['tool'] = tool
+                print(json.dumps(event, ensure_ascii=False), file=fh)
+            print(json.dumps({'kind': 'run', 'tool': tool, 'ts': round(time.time(), 3), 'seconds': round(wall, 3),
+                'requests': count, 'bytes': nbytes}), file=fh)
+
+    def write_prometheus(self, path, tool):
+        """Writes the totals to path in the Prometheus text format (replacing the file atomically).
+
+        All values are gauges covering the run (or daemon pass) since the last reset.
+        """
+        wall, count, nbytes = self.totals()
+        out = list()
+        def metric(name, kind, helptext, samples):
+            out.append('# HELP %s%s %s' % (PREFIX, name, helptext))
+            out.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+            for labels, value in samples:
+                out.append('%s%s{%s} %s' % (PREFIX, name, ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels), repr(float(value))))
+        with self._lock:
+            requests = sorted(self.requests.items())
+            metric('http_requests', 'gauge', 'Requests sent, by page and HTTP status ("error" if no response)',
+                [((('tool', tool), ('page', name), ('status', status)), n) for name, r in requests for status, n in sorted(r['status'].items())])
+            metric('http_request_duration_seconds_sum', 'gauge', 'Total time spent on requests, by page',
+                [((('tool', tool), ('page', name)), sum(r['seconds'])) for name, r in requests])
+            metric('http_request_duration_seconds_count', 'gauge', 'Number of timed requests, by page',
+                [((('tool', tool), ('page', name)), r['count']) for name, r in requests])
+            metric('http_request_duration_seconds_max', 'gauge', 'Slowest request, by page',
+                [((('tool', tool), ('page', name)), max(r['seconds'])) for name, r in requests])
+            metric('http_response_bytes', 'gauge', 'Bytes received, by page',
+                [((('tool', tool), ('page', name)), r['bytes']) for name, r in requests])
+            metric('http_retries', 'gauge', 'Requests retried on a fresh connection, by page',
+                [((('tool', tool), ('page', name)), r['retries']) for name, r in requests])
+            metric('parse_seconds_sum', 'gauge', 'Total time spent parsing pages, by page type',
+                [((('tool', tool), ('pagetype', name)), p['seconds']) for name, p in sorted(self.parses.items())])
+            metric('parse_seconds_count', 'gauge', 'Number of pages parsed, by page type',
+                [((('tool', tool), ('pagetype', name)), p['count']) for name, p in sorted(self.parses.items())])
+            metric('section_seconds_sum', 'gauge', 'Total time spent in timed sections (e.g. login)',
+                [((('tool', tool), ('section', name)), s['seconds']) for name, s in sorted(self.sections.items())])
+        metric('run_duration_seconds', 'gauge', 'Wall time of the last run', [((('tool', tool),), wall)])
+        metric('run_requests', 'gauge', 'Requests sent in the last run', [((('tool', tool),), count)])
+        metric('run_timestamp_seconds', 'gauge', 'Time the last run finished', [((('tool', tool),), time.time())])
+        # The textfile collector may read the file at any time, so never leave it half written
+        tmppath = str(path) + '.tmp'
+        with open(tmppath, mode='w', encoding='utf-8') as fh:
+            print('\n'.join(out), file=fh)
+        os.replace(tmppath, path)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+RECORDER = Recorder()
+# Set by setup()
+_args = None
+_tool = None
+
+def record_request(method, url, status, seconds, nbytes, retries=0, error=None):
+    """Records a request (status None if no response was received)."""
+    RECORDER.request(method, url, status, seconds, nbytes, retries, error)
+
+def record_parse(pagetype, seconds, nbytes):
+    """Records the parsing of a page."""
+    RECORDER.parse(pagetype, seconds, nbytes)
+
+@contextlib.contextmanager
+def timed(name):
+    """Records the time spent in a 'with' block as a section (e.g. 'login')."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        RECORDER.section(name, time.perf_counter() - start)
+
+def setup(args, tool=None):
+    """Reports metrics at the end of a run, as given by args.debug and args.metrics.
+
+    With args.metrics, metrics are written as a Prometheus textfile if its
+    name ends in ".prom", and as JSON lines otherwise.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments.
+        tool (str) [optional]: Tool name used in metrics (defaults to the script name).
+
+    """
+    global _args, _tool
+    _args = args
+    _tool = tool or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    path = getattr(args, 'metrics', None)
+    RECORDER.keep_events = bool(path) and not str(path).endswith('.prom')
+    # The working directory may change before exit
+    if path:
+        args.metrics = os.path.abspath(path)
+    RECORDER.reset()
+    atexit.register(flush)
+
+def flush():
+    """Prints (with --debug) and writes out (with --metrics) the metrics recorded so far, then starts over.
+
+    Called at exit; daemons call it after each pass.
+    """
+    if _args is None:
+        return
+    if getattr(_args, 'debug', False):
+        print("[DEBUG] Request metrics:\n" + RECORDER.summary(), file=sys.stderr)
+    path = getattr(_args, 'metrics', None)
+    if path:
+        try:
+            if str(path).endswith('.prom'):
+                RECORDER.write_prometheus(path, _tool)
+            else:
+                RECORDER.write_jsonl(path, _tool)
+        except OSError as err:
+            print("[Error] Couldn't write metrics to", path, ":", err, file=sys.stderr)
+    RECORDER.reset()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+# noteindex.py - full-text index of the OPD notes of a patient
+#
+# Lines of the SOAP segments of each note fetched (by emr_diff.py) are kept
+# in an SQLite database per patient in the 'state' directory, with an
+# inverted index from terms to lines: lowercased runs of letters and digits,
+# and single characters and bigrams of CJK text (which has no spaces to split
+# words on). A phrase is looked up by the lines holding all of its terms, and
+# those lines are then checked for the phrase itself. Words in a phrase match
+# whole words, except the last one, which may be the start of a longer word
+# (so "diabet" finds "diabetes", but "betes" doesn't).
+#
+# Notes carry most of their lines over from visit to visit, so each distinct
+# line is stored (and indexed) once, with the notes it occurs in.
+
+import re
+import sqlite3
+
+from lib import session
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS notes (
+    medicalsn TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    attending TEXT
+);
+CREATE TABLE IF NOT EXISTS texts (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS occurrences (
+    text INTEGER NOT NULL,
+    medicalsn TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    lineno INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS occurrences_text ON occurrences (text);
+CREATE INDEX IF NOT EXISTS occurrences_medicalsn ON occurrences (medicalsn);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    text INTEGER NOT NULL,
+    PRIMARY KEY (term, text)
+) WITHOUT ROWID;
+"""
+
+_term_regex = re.compile(r"[0-9a-z]+|[㐀-䶿一-鿿豈-﫿]+")
+_cjk_regex = re.compile(r"[㐀-䶿一-鿿豈-﫿]")
+
+def indexpath(chartno, baseurl=session.BASEURL):
+    return session.STATEDIR / (session.statekey(baseurl, chartno) + "_notes.sqlite")
+
+def terms(text):
+    """Returns the set of index terms of a line of text."""
+    out = set()
+    for run in _term_regex.findall(text.lower()):
+        if _cjk_regex.match(run):
+            out.update(run)
+            out.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            out.add(run)
+    return out
+
+def _query_terms(phrase):
+    # (term, whether it is a prefix) for the terms every line holding the
+    # phrase is indexed under: the CJK bigrams (or the character, if only
+    # one) and the words, the last of which may be the start of a longer word
+    out = list()
+    for m in _term_regex.finditer(phrase):
+        run = m.group()
+        if _cjk_regex.match(run):
+            out.extend((x, False) for x in ([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)]))
+        else:
+            out.append((run, m.end() == len(phrase)))
+    return list(dict.fromkeys(out))
+
+def _phrase_regex(phrase):
+    # Words start at the start of the phrase, as long as it starts with one
+    return re.compile(("(?<![0-9a-z])" if re.match("[0-9a-z]", phrase) else "") + re.escape(phrase))
+
+class NoteIndex:
+    """Full-text index of the OPD notes of a patient (kept in the 'state' directory, see indexpath()).
+
+    Args:
+        chartno (str): Chart number.
+        path (str or pathlib.Path) [optional]: Database to use instead.
+        baseurl (str) [optional]: Server the notes are from (see session.statekey()).
+
+    """
+    def __init__(self, chartno, path=None, baseurl=session.BASEURL):
+        self.chartno = chartno
+        self.path = path or indexpath(chartno, baseurl)
+        session.STATEDIR.mkdir(exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def has(self, medicalsn):
+        """Whether the note of a visit is in the index."""
+        return self.conn.execute("SELECT 1 FROM notes WHERE medicalsn = ?", (medicalsn,)).fetchone() is not None
+
+    def notes(self):
+        """Returns the number of notes in the index."""
+        return self.conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+    def add(self, medicalsn, date, attending, segments):
+        """Adds (or replaces) the note of a visit.
+
+        Args:
+            medicalsn (str): Visit ID.
+            date (str): Date and time of the visit (YYYY/MM/DD HH:MM, as in the note).
+            attending (str): Name of the attending.
+            segments (list): (name of segment, list of lines) for each segment of the note.
+
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM occurrences WHERE medicalsn = ?", (medicalsn,))
+            self.conn.execute("INSERT OR REPLACE INTO notes (medicalsn, date, attending) VALUES (?, ?, ?)", (medicalsn, date, attending))
+            occurrences = list()
+            for segment, lines in segments:
+                for lineno, line in enumerate(lines):
+                    row = self.conn.execute("SELECT id FROM texts WHERE text = ?", (line,)).fetchone()
+                    if row:
+                        textid = row[0]
+                    else:
+                        textid = self.conn.execute("INSERT INTO texts (text) VALUES (?)", (line,)).lastrowid
+                        self.conn.executemany("INSERT OR IGNORE INTO postings (term, text) VALUES (?, ?)",
+                            [(term, textid) for term in terms(line)])
+                    occurrences.append((textid, medicalsn, segment, lineno))
+            self.conn.executemany("INSERT INTO occurrences (text, medicalsn, segment, lineno) VALUES (?, ?, ?, ?)", occurrences)
+
+    def search(self, phrase):
+        """Finds the occurrences of a phrase (case-insensitive), oldest first.
+
+        Returns:
+            list: Dicts with the medicalsn, date, attending, segment, lineno and text of each line holding the phrase.
+
+        """
+        needle = phrase.lower().strip()
+        if not needle:
+            return list()
+        query = _query_terms(needle)
+        if query:
+            candidates = " INTERSECT ".join("SELECT text FROM postings WHERE term >= ? AND term < ?" if prefix
+                else "SELECT text FROM postings WHERE term = ?" for term, prefix in query)
+            params = list()
+            for term, prefix in query:
+                params.extend([term, term + "\uffff"] if prefix else [term])
+            texts = self.conn.execute("SELECT id, text FROM texts WHERE id IN (" + candidates + ")", params).fetchall()
+        else:
+            # Nothing to look up (e.g. only punctuation), so every line is checked
+            texts = self.conn.execute("SELECT id, text FROM texts").fetchall()
+        regex = _phrase_regex(needle)
+        found = {textid: text for textid, text in texts if regex.search(text.lower())}
+        if not found:
+            return list()
+        rows = self.conn.execute("SELECT o.text, n.medicalsn, n.date, n.attending, o.segment, o.lineno FROM occurrences o "
+            "JOIN notes n ON n.medicalsn = o.medicalsn WHERE o.text IN (" + ",".join("?" * len(found)) + ") "
+            "ORDER BY n.date, n.medicalsn, o.rowid", list(found)).fetchall()
+        return [{'medicalsn': medicalsn, 'date': date, 'attending': attending, 'segment': segment, 'lineno': lineno, 'text': found[textid]}
+            for textid, medicalsn, date, attending, segment, lineno in rows]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+# parse.py - targeted HTML parsing shared by the tools
+#
+# Most tools only need one or two elements from each page (a table, the
+# <area> tags of the TPR chart, ...), but building a full BeautifulSoup tree
+# of a page costs far more time and memory than the elements themselves.
+# parse() only builds the parts of a page listed in TARGETS for its page
+# type, and all tools use the same tree builder (BACKEND).
+
+import importlib.util
+import re
+import time
+
+import bs4
+
+from lib import metrics
+
+# Tree builders that can be selected with configure(). lxml is much faster,
+# but builds a different tree from malformed markup (e.g. unclosed <p> and
+# <td> tags), so the tools keep the html.parser they were written against
+BACKENDS = ['lxml', 'html.parser']
+BACKEND = 'html.parser'
+
+# Elements kept for each page type. Everything inside a kept element is kept
+# as well; None keeps the whole page.
+TARGETS = {
+    # SSO login page: hidden ASP.NET form fields
+    'login': bs4.SoupStrainer('input', attrs={'name': re.compile('^__')}),
+    # Patient list returned after logging in
+    'patientlist': bs4.SoupStrainer('table', attrs={'id': 'GridView1'}),
+    # EmrQuery visit list (list2.aspx)
+    'visitlist': bs4.SoupStrainer('a', attrs={'href': re.compile('medicalsn=')}),
+    # OPD note (viewer.aspx?type=soap)
+    'soap': bs4.SoupStrainer(attrs={'class': re.compile('portlet-(header|content)')}),
+    # OPD visit (viewer.aspx), for the diagnoses
+    'opd': bs4.SoupStrainer('p'),
+    # Inpatient problem list (viewer_v2.aspx?type=PL)
+    'problemlist': bs4.SoupStrainer('td', attrs={'width': ''}),
+    # TPR chart (tprm3.aspx)
+    'tpr': bs4.SoupStrainer('area'),
+    # List of nursing record dates (NISlist.aspx)
+    'nislist': bs4.SoupStrainer('a'),
+    # Nursing records (viewReport); parsed by position in the whole page
+    'nursing': None,
+    # Orders (showShift.aspx): regular and stat orders
+    'orders': bs4.SoupStrainer('table', attrs={'id': re.compile('^GridView[67]$')}),
+    # iVue sheet pages (patientEncounter.aspx)
+    'ivue': bs4.SoupStrainer('table', attrs={'class': re.compile(r'(^|\s)mainTBL(\s|$)')}),
+}
+
+def configure(backend):
+    """Selects the tree builder used by parse() (one of BACKENDS)."""
+    global BACKEND
+    if backend not in BACKENDS:
+        raise ValueError("Unknown parser backend: " + str(backend))
+    if backend == 'lxml' and importlib.util.find_spec('lxml') is None:
+        raise ValueError("Parser backend lxml is not installed")
+    BACKEND = backend
+
+def parse(markup, pagetype=None):
+    """Parses the parts of a page needed by the tools.
+
+    Args:
+        markup (str): Page contents.
+        pagetype (str) [optional]: Key of TARGETS (the whole page is parsed if None).
+
+    Returns:
+        bs4.BeautifulSoup: Tree containing only the target elements of the page.
+
+    """
+    start = time.perf_counter()
+    if pagetype is None or TARGETS[pagetype] is None:
+        soup = bs4.BeautifulSoup(markup, BACKEND)
+    else:
+        soup = bs4.BeautifulSoup(markup, BACKEND, parse_only=TARGETS[pagetype])
+    metrics.record_parse(pagetype or 'page', time.perf_counter() - start, len(markup))
+    return soup
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+# progress.py - machine-readable progress reports from the tools
+#
+# When the EMRTOOLS_PROGRESS environment variable is set (the web UI sets it
+# for the tools it runs), report() prints lines such as
+#
+#     @@progress {"phase": "notes", "done": 3, "total": 40}
+#
+# to standard output, between the tool's usual output, so that the web UI can
+# show how far a run has got. Otherwise report() does nothing.
+
+import json
+import os
+
+ENVVAR = 'EMRTOOLS_PROGRESS'
+MARKER = '@@progress '
+
+def enabled():
+    return bool(os.environ.get(ENVVAR))
+
+def report(phase, done=None, total=None, **extra):
+    """Reports the current phase of a run, and how much of it is done.
+
+    Args:
+        phase (str): Name of what the tool is doing, e.g. "notes".
+        done (int) [optional]: Number of items done in this phase.
+        total (int) [optional]: Number of items in this phase.
+        extra: Further fields, e.g. partial="<name of a partial report>".
+
+    """
+    if not enabled():
+        return
+    event = dict(extra, phase=phase)
+    if done is not None:
+        event['done'] = done
+    if total is not None:
+        event['total'] = total
+    print(MARKER + json.dumps(event, ensure_ascii=False), flush=True)
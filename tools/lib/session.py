@@ -3,20 +3,127 @@
 
 # session.py - functions for working with the NCKUH EMR
 
+import argparse
 import http.cookiejar
+import json
+import os
+import pathlib
+import threading
+import time
 import urllib.parse
 import urllib.request
 import re
 import sys
 
-import bs4
+from lib import client
+from lib import metrics
+from lib import parse
 
-def login(args):
+# Session state (SSO cookie jar and EmrQuery session IDs) is kept on disk so
+# that consecutive tool runs don't have to go through the SSO login again.
+# The directory sits next to the 'cache' directory used for reports, since
+# the web UI lists everything in 'cache'.
+STATEDIR = pathlib.Path(os.path.realpath(__file__)).parent.parent.parent / 'state'
+
+# EmrQuery runs on ASP.NET, whose default session timeout is 20 minutes; we
+# trust a cached session ID for a bit less than that after its last use and
+# otherwise check it again against the server.
+SESSION_TTL = 15 * 60
+
+# Root of the hisweb server (SSO login, EmrQuery and PCS pages). Tools take
+# a --baseurl argument to point elsewhere, e.g. at a local test server.
+BASEURL = "http://hisweb.hosp.ncku/"
+
+# Tools running patients in parallel (e.g. emr_summary.py) share this module
+_lock = threading.Lock()
+# Logins with credentials (one at a time) and the number done so far
+_login_lock = threading.Lock()
+_logins = 0
+
+# EmrQuery session IDs handed out by get_sessionid() (with the arguments
+# they were got with) and those replaced by a new one (see SessionHandler)
+_sessions = dict()
+_renewed = dict()
+_renew_lock = threading.Lock()
+_sessionid_regex = re.compile(r"\(S\(([a-z0-9]+)\)\)")
+
+def get_baseurl(args):
+    baseurl = getattr(args, 'baseurl', None) or BASEURL
+    return baseurl if baseurl.endswith('/') else baseurl + '/'
+
+def _sessionkey(args):
+    # Session IDs from other servers are kept apart from those of hisweb
+    baseurl = get_baseurl(args)
+    return args.chartno if baseurl == BASEURL else baseurl + ' ' + args.chartno
+
+def statekey(url, chartno):
+    """Returns the name the state files of a patient start with.
+
+    Args:
+        url (str): Base URL of the server, or any URL of its EmrQuery or iVue pages (e.g. the root URL of the tree pages).
+        chartno (str): Chart number.
+
+    Returns:
+        str: The chart number, after the host (and path) of the server for servers other than BASEURL, so that
+            state from e.g. a local test server (--baseurl) is kept apart from that of hisweb.
+
+    """
+    baseurl = re.split('EmrQuery/|iVue/', url)[0]
+    baseurl = baseurl if baseurl.endswith('/') else baseurl + '/'
+    if baseurl == BASEURL:
+        return chartno
+    return re.sub(r'[^0-9A-Za-z.]+', '-', baseurl.split('://', 1)[-1]).strip('-') + '_' + chartno
+
+def _cookiejar_path(uid):
+    return STATEDIR / ('session_' + uid + '.cookies')
+
+def _sessionid_path(uid):
+    return STATEDIR / ('session_' + uid + '.json')
+
+def _load_cookiejar(uid):
+    cj = http.cookiejar.LWPCookieJar(str(_cookiejar_path(uid)))
+    try:
+        cj.load(ignore_discard=True)
+    except (OSError, http.cookiejar.LoadError):
+        pass
+    return cj
+
+def _save_cookiejar(cj):
+    STATEDIR.mkdir(exist_ok=True)
+    # The cookie jar is as good as a password, so keep it private
+    # (saved by threads of a batch at the same time, see get_sessionid())
+    tmppath = cj.filename + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+    cj.save(tmppath, ignore_discard=True)
+    os.chmod(tmppath, 0o600)
+    os.replace(tmppath, cj.filename)
+
+def _load_sessionids(uid):
+    try:
+        with open(_sessionid_path(uid), 'r', encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return dict()
+
+def _save_sessionids(uid, sessionids):
+    STATEDIR.mkdir(exist_ok=True)
+    tmppath = str(_sessionid_path(uid)) + '.%d.tmp' % os.getpid()
+    with open(tmppath, 'w', encoding='utf-8') as fh:
+        json.dump(sessionids, fh)
+    os.chmod(tmppath, 0o600)
+    os.replace(tmppath, _sessionid_path(uid))
+
+def login(args, cj=None):
+    with metrics.timed('login'):
+        return _login(args, cj)
+
+def _login(args, cj=None):
     # Cookie storage is required
-    cj = http.cookiejar.CookieJar()
-    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cj))
-    login = opener.open("http://hisweb.hosp.ncku/WebsiteSSO/PCS/").read().decode()
-    login_soup = bs4.BeautifulSoup(login, "html.parser")
+    if cj is None:
+        cj = _load_cookiejar(args.uid)
+        cj.clear()
+    opener = client.build_opener(urllib.request.HTTPCookieProcessor(cj))
+    login = opener.open(get_baseurl(args) + "WebsiteSSO/PCS/").read().decode()
+    login_soup = parse.parse(login, "login")
     VIEWSTATE = login_soup.find("input", attrs={"name":"__VIEWSTATE"})["value"]
     VIEWSTATEGENERATOR = login_soup.find("input", attrs={"name":"__VIEWSTATEGENERATOR"})["value"]
     EVENTVALIDATION = login_soup.find("input", attrs={"name":"__EVENTVALIDATION"})["value"]
@@ -24,7 +131,7 @@ def login(args):
         print("[DEBUG] VIEWSTATE: ", VIEWSTATE, file=sys.stderr)
         print("[DEBUG] VIEWSTATEGENERATOR: ", VIEWSTATEGENERATOR, file=sys.stderr)
         print("[DEBUG] EVENTVALIDATION: ", EVENTVALIDATION, file=sys.stderr)
-    post_url = "http://hisweb.hosp.ncku/WebsiteSSO/PCS/default.aspx"
+    post_url = get_baseurl(args) + "WebsiteSSO/PCS/default.aspx"
     post_fields = {
         "TextBoxId": args.uid,
         "TextBoxPwd": args.passwd,
@@ -35,22 +142,137 @@ def login(args):
     }
     post_request = urllib.request.Request(post_url, urllib.parse.urlencode(post_fields).encode())
     post_reply = opener.open(post_request).read().decode()
+    if isinstance(cj, http.cookiejar.FileCookieJar):
+        _save_cookiejar(cj)
     # post_reply contains the user's list of patients
     return opener, post_reply
 
-def get_sessionid(args):
-    # Get session ID from EMR server using credentials
-    opener, reply = login(args)
+def autologin(opener, args):
+    # Get session ID from EMR server using an opener holding the SSO cookies;
+    # returns None if the SSO session has expired
     ## Apparently requesting "http://hisweb.hosp.ncku/WebsiteSSO/PCS/showchart.aspx?chartno=..." does *not* work (a 500 Internal Error is returned)
-    emr_reply = opener.open("http://hisweb.hosp.ncku/EmrQuery/autologin.aspx?chartno=" + args.chartno + "&systems=0")
+    emr_reply = opener.open(get_baseurl(args) + "EmrQuery/autologin.aspx?chartno=" + args.chartno + "&systems=0")
     if args.debug:
         print("[DEBUG] EMR reply:", emr_reply, file=sys.stderr)
-    session_id = re.search("S\(([a-z0-9]+)\)", emr_reply.geturl()).groups()[0]
+    m = re.search("S\(([a-z0-9]+)\)", emr_reply.geturl())
+    if not m:
+        return None
+    return m.groups()[0]
+
+def get_sessionid(args):
+    # Get session ID from EMR server, logging in with credentials only if the
+    # cached SSO cookies are no longer accepted. _lock is only held to read
+    # and write the cached session IDs, so that the patients of a batch get
+    # their session IDs from the server at the same time.
+    with metrics.timed('get_sessionid'):
+        with _lock:
+            cached = _load_sessionids(args.uid).get(_sessionkey(args))
+        if cached and time.time() - cached['lastused'] < SESSION_TTL:
+            if args.debug:
+                print("[DEBUG] Reusing cached session ID for", args.chartno, file=sys.stderr)
+            session_id = cached['sessionid']
+        else:
+            session_id = _get_new_sessionid(args)
+        with _lock:
+            # Sessions for other patients are left alone; stale ones are rechecked when next used
+            sessionids = _load_sessionids(args.uid)
+            sessionids[_sessionkey(args)] = {'sessionid': session_id, 'lastused': time.time()}
+            _save_sessionids(args.uid, sessionids)
+            _sessions[session_id] = argparse.Namespace(**vars(args))
     return session_id
 
+def _get_new_sessionid(args):
+    # Only one thread logs in with credentials at a time; threads that find
+    # the SSO cookies expired while another one was logging in try again
+    # with the cookies it got instead of logging in themselves
+    global _logins
+    while True:
+        logins = _logins
+        cj = _load_cookiejar(args.uid)
+        session_id = autologin(client.build_opener(urllib.request.HTTPCookieProcessor(cj)), args) if len(cj) else None
+        if session_id is not None:
+            # Keep refreshed cookie expiry times
+            _save_cookiejar(cj)
+            return session_id
+        with _login_lock:
+            if _logins != logins:
+                continue
+            if args.debug:
+                print("[DEBUG] No valid SSO session, logging in", file=sys.stderr)
+            cj.clear()
+            opener, reply = login(args, cj)
+            _logins += 1
+            session_id = autologin(opener, args)
+            if session_id is None:
+                raise RuntimeError("Login failed (no EmrQuery session ID returned)")
+            return session_id
+
+def invalidate(args):
+    # Forget the cached session ID for this patient (e.g. if the server has
+    # dropped it before SESSION_TTL was up)
+    with _lock:
+        sessionids = _load_sessionids(args.uid)
+        if sessionids.pop(_sessionkey(args), None) is not None:
+            _save_sessionids(args.uid, sessionids)
+
+def expired(url, finalurl):
+    """Whether a request for a page of an EmrQuery session (url) ended up on the SSO login page or outside that session (finalurl, after redirects), i.e. the session has expired."""
+    if finalurl == url:
+        return False
+    if "WebsiteSSO/PCS" in finalurl:
+        return True
+    m = _sessionid_regex.search(finalurl)
+    return m is None or m.group(1) != _sessionid_regex.search(url).group(1)
+
+def renew(sessionid):
+    """Invalidates an expired session ID handed out by get_sessionid() and returns a new one for the same patient."""
+    with _renew_lock:
+        # Requests in flight on other threads may find the same session expired
+        if sessionid in _renewed:
+            return _renewed[sessionid]
+        args = _sessions[sessionid]
+        if args.debug:
+            print("[DEBUG] Session ID for", args.chartno, "has expired, getting a new one", file=sys.stderr)
+        invalidate(args)
+        new = get_sessionid(args)
+        for old in [k for k, v in _renewed.items() if v == sessionid] + [sessionid]:
+            _renewed[old] = new
+    return new
+
+class SessionHandler(urllib.request.BaseHandler):
+    """urllib handler replacing expired EmrQuery session IDs (installed in client.urlopen() on import).
+
+    Tools build their page URLs from the session ID once, and a cached ID is
+    trusted without asking the server until SESSION_TTL is up. The server
+    answers a page of an expired session with a redirect to the SSO login
+    page or to a new "(S(...))" session the user isn't logged into; the ID
+    is then invalidated, a new one got and the request retried once with
+    it. Later requests with the old ID are sent with the new one.
+    """
+    # Responses are checked after redirects have been followed
+    handler_order = 1100
+
+    def http_request(self, req):
+        m = _sessionid_regex.search(req.full_url)
+        if m and m.group(1) in _renewed:
+            req.full_url = req.full_url.replace(m.group(0), "(S(" + _renewed[m.group(1)] + "))")
+        return req
+
+    def http_response(self, req, response):
+        m = _sessionid_regex.search(req.full_url)
+        if m is None or m.group(1) not in _sessions or not expired(req.full_url, response.geturl()):
+            return response
+        if getattr(req, 'session_renewed', False):
+            raise RuntimeError("EmrQuery session expired again right after logging in")
+        retry = urllib.request.Request(req.full_url.replace(m.group(0), "(S(" + renew(m.group(1)) + "))"), req.data)
+        retry.session_renewed = True
+        return self.parent.open(retry)
+
+client.add_handler(SessionHandler())
+
 def get_patientlist(args):
     opener, post_reply = login(args)
-    patientlist_soup = bs4.BeautifulSoup(post_reply, "html.parser")
+    patientlist_soup = parse.parse(post_reply, "patientlist")
     patientlist_table = patientlist_soup.find("table", attrs={"id":"GridView1"})
     patientlist_tr = patientlist_table.findAll('tr')
     entries = list()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+# visitlist.py - the visit list (list2.aspx) of a patient, cached per patient
+#
+# emr_encounters.py, emr_diagnosis.py and emr_diff.py all start from the
+# visit list over their date range. The visits parsed from it are kept in
+# the 'state' directory together with the date ranges already fetched, so
+# that a later run only fetches the parts of its range not covered yet and
+# merges them in. Visits of the past don't change, but the last RECENT_DAYS
+# days (a visit today may not be listed yet) are never taken as covered.
+# Nor is the day of an inpatient stay still open (listed with an 'iviewer'
+# link, which becomes a 'viewer_v2' link on discharge), however long ago
+# the admission was. The cache is kept per server (see session.statekey()).
+
+import datetime
+import json
+import os
+import re
+import sys
+
+from lib import client
+from lib import parse
+from lib import session
+
+# Days up to today that are fetched again on every run
+RECENT_DAYS = 2
+
+_medicalsn_regex = re.compile("medicalsn=([A-Z][^&]*)")
+_date_regex = re.compile(r"(\d{4})/(\d{2})/(\d{2})")
+## Name of attending between '\xa0' symbols (non-breaking spaces, "&nbsp;" in the HTML) after the date
+_n_regex = re.compile("[0-9]\xa0(.+)\xa0(.+)$")
+
+def parse_visits(visit_list):
+    """Parses the visit list page (list2.aspx) into a list of visits, in the order of the page.
+
+    Returns:
+        list: Dicts with the medicalsn, type ('O' for outpatient, 'I' for
+            inpatient, 'E' for ED), date (YYYY-MM-DD, None if not given),
+            attending, department and links (all links to pages of the visit,
+            in the order of the page) of each visit.
+
+    """
+    visits = dict()
+    for a in parse.parse(visit_list, "visitlist").find_all("a", href=_medicalsn_regex):
+        medicalsn = _medicalsn_regex.search(a["href"]).group(1)
+        visit = visits.get(medicalsn)
+        if visit is None:
+            visit = visits[medicalsn] = {"medicalsn": medicalsn, "type": medicalsn[0], "date": None, "attending": None,
+                "department": None, "links": []}
+        visit["links"].append(a["href"])
+        # The link to the visit itself reads "<date> <attending> <department>"
+        date = _date_regex.match(a.text.strip())
+        if date and visit["date"] is None:
+            visit["date"] = "-".join(date.groups())
+            m = _n_regex.search(a.text)
+            if m:
+                visit["attending"], visit["department"] = m.groups()
+    return list(visits.values())
+
+def _days(startdate, enddate):
+    return datetime.date.fromisoformat(startdate), datetime.date.fromisoformat(enddate)
+
+def uncovered(ranges, startdate, enddate):
+    """Returns the parts of startdate..enddate (ISO8601, inclusive) not within any of ranges, as a list of (start, end)."""
+    start, end = _days(startdate, enddate)
+    gaps = list()
+    for s, e in sorted(_days(s, e) for s, e in ranges):
+        if e < start:
+            continue
+        if s > end:
+            break
+        if s > start:
+            gaps.append((start, s - datetime.timedelta(days=1)))
+        start = max(start, e + datetime.timedelta(days=1))
+        if start > end:
+            break
+    if start <= end:
+        gaps.append((start, end))
+    return [(s.isoformat(), e.isoformat()) for s, e in gaps]
+
+def merge_ranges(ranges, startdate, enddate):
+    """Adds startdate..enddate to a list of date ranges, merging overlapping and adjacent ones."""
+    merged = list()
+    for s, e in sorted([_days(s, e) for s, e in ranges] + [_days(startdate, enddate)]):
+        if merged and s <= merged[-1][1] + datetime.timedelta(days=1):
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+    return [[s.isoformat(), e.isoformat()] for s, e in merged]
+
+def _merge(visits, fetched):
+    # Visits are kept in the order of the page (newest first), so fetched
+    # visits go before or after the cached ones as a block where possible
+    new = [v["date"] for v in fetched if v["date"]]
+    old = [v["date"] for v in visits if v["date"]]
+    if not old or not new or min(new) >= max(old):
+        return fetched + visits
+    if max(new) <= min(old):
+        return visits + fetched
+    # Visits of the same day keep their order
+    return sorted(fetched + visits, key=lambda v: v["date"] or "", reverse=True)
+
+def cachepath(chartno, baseurl=session.BASEURL):
+    return session.STATEDIR / (session.statekey(baseurl, chartno) + "_visits.json")
+
+def _in_range(visit, startdate, enddate):
+    return visit["date"] is None or startdate <= visit["date"] <= enddate
+
+def get_visits(rooturl, chartno, startdate, enddate, debug=False):
+    """Retrieves the visits of a patient between startdate and enddate, fetching only what isn't cached.
+
+    Args:
+        rooturl (str): Root URL of the EmrQuery tree pages, including the session ID.
+        chartno (str): Chart number, e.g., "12345678".
+        startdate (str): Starting date in ISO8601 format.
+        enddate (str): Ending date in ISO8601 format.
+        debug (bool) [optional]: Print debug info.
+
+    Returns:
+        list: Visits (see parse_visits()), newest first.
+
+    """
+    path = cachepath(chartno, rooturl)
+    try:
+        with open(path, mode="r", encoding="utf-8") as fh:
+            cache = json.load(fh)
+    except (OSError, ValueError):
+        cache = {"ranges": [], "visits": []}
+    visits = cache["visits"]
+    ranges = cache["ranges"]
+    # Last day that stays covered once fetched
+    settled = (datetime.date.today() - datetime.timedelta(days=RECENT_DAYS)).isoformat()
+    gaps = uncovered(ranges, startdate, enddate)
+    # Days of open inpatient stays are fetched again until discharge
+    for day in sorted(set(v["date"] for v in visits if v["date"] and startdate <= v["date"] <= enddate
+            and any("iviewer" in link for link in v["links"]))):
+        if not any(start <= day <= stop for start, stop in gaps):
+            gaps.append((day, day))
+    gaps.sort()
+    for start, stop in gaps:
+        if debug:
+            print("[DEBUG] Fetching visit list from", start, "to", stop, file=sys.stderr)
+        visit_list_url = "list2.aspx?" + "chartno=" + chartno + "&start=" + start + "&stop=" + stop + "&query=0"
+        with client.urlopen(rooturl + visit_list_url) as f:
+            fetched = parse_visits(f.read().decode("utf-8"))
+        # Fetched visits replace the cached ones for the same days
+        ids = set(v["medicalsn"] for v in fetched)
+        visits = _merge([v for v in visits if v["medicalsn"] not in ids and not (v["date"] and start <= v["date"] <= stop)], fetched)
+        if start <= settled:
+            ranges = merge_ranges(ranges, start, min(stop, settled))
+    if debug and len(gaps) == 0:
+        print("[DEBUG] Visit list from", startdate, "to", enddate, "cached", file=sys.stderr)
+    if gaps:
+        session.STATEDIR.mkdir(exist_ok=True)
+        # Written to a temporary file first, as other tools may be reading it
+        tmppath = path.with_name(path.name + ".%d.tmp" % os.getpid())
+        with open(tmppath, mode="w", encoding="utf-8") as fh:
+            json.dump({"ranges": ranges, "visits": visits}, fh, ensure_ascii=False)
+        os.replace(tmppath, path)
+    return [v for v in visits if _in_range(v, startdate, enddate)]
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+# vitalstore.py - columnar store of the vital signs of a patient
+#
+# Vital signs from the TPR chart (emr_vitals.py) and the iVue TPR sheet
+# (ivue_scraper.py) are kept per chart number and encounter in a directory
+# in the 'state' directory, one file per column: times.i64 with the time of
+# each row (int64, seconds since 1970-01-01 in local time), ascending, and
+# <channel>.f32 with the measurements of each channel (float32, NaN where
+# not measured). Each time is stored once, with the newest value given for
+# each channel. Rows newer than the last one stored are appended to the
+# files; anything else is merged in and the files are rewritten. Writes take
+# a lock on the directory (.lock), so that runs adding to the same store at
+# once don't interleave their appends, and the store is read again under
+# the lock before anything is added.
+#
+# The number of rows and the generation of the files are kept in store.json,
+# which is replaced once the files are written: an append cut short leaves
+# rows past that number, which are dropped on load, and a rewrite goes to
+# files of the next generation (e.g. times.2.i64), so that a rewrite cut
+# short leaves the files of the current one as they were. Stores written
+# before store.json was kept are generation 0 (times.i64 etc.).
+#
+# The columns are read whole into arrays (a month of measurements every
+# minute is about 1 MiB), and a time range is found by bisection.
+
+import array
+import bisect
+import contextlib
+import datetime
+import json
+import math
+import os
+import pathlib
+import re
+import sys
+
+from lib import session
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where concurrent writes aren't guarded against
+    fcntl = None
+
+# Channels of the store; ivue_scraper.py modes 'temp', 'hr' and 'rr' go to
+# the channels of the same name
+CHANNELS = ["temp", "hr", "rr", "sbp", "dbp"]
+# Key of the vital signs of the TPR chart of emr_vitals.py, which aren't tied to an encounter
+TPR_ENCOUNTER = "tpr"
+EPOCH = datetime.datetime(1970, 1, 1)
+LOCK_FILENAME = ".lock"
+MANIFEST_FILENAME = "store.json"
+NAN = float("nan")
+
+## Number at the start of a measurement, e.g. "36.5" of "36.5(耳溫)"
+_number_regex = re.compile(r"-?\d+(?:\.\d+)?")
+## Column files of any generation
+_column_regex = re.compile(r"^(times|" + "|".join(CHANNELS) + r")(\.\d+)?\.(i64|f32)$")
+
+def timestamp(t):
+    """Returns the timestamp (int) of a datetime.datetime or an ISO8601 string, both in local time."""
+    if isinstance(t, str):
+        t = datetime.datetime.fromisoformat(t)
+    return (t - EPOCH) // datetime.timedelta(seconds=1)
+
+def to_datetime(ts):
+    """Returns the datetime.datetime of a timestamp (see timestamp())."""
+    return EPOCH + datetime.timedelta(seconds=ts)
+
+def value(x):
+    """Returns a measurement (str or number, None if missing) as a float, NaN if there is no number."""
+    if x is None:
+        return NAN
+    if isinstance(x, (int, float)):
+        return float(x)
+    m = _number_regex.match(x.strip())
+    return float(m.group()) if m else NAN
+
+def storepath(chartno, encounterid=None, baseurl=session.BASEURL):
+    return session.STATEDIR / (session.statekey(baseurl, chartno) + "_vitals_" + (encounterid or TPR_ENCOUNTER))
+
+def _filename(column, generation):
+    return column + (".%d" % generation if generation else "") + (".i64" if column == "times" else ".f32")
+
+def _read(path, typecode):
+    a = array.array(typecode)
+    try:
+        with open(path, mode="rb") as fh:
+            data = fh.read()
+    except OSError:
+        return a
+    # Whole items only, should a write have been cut short
+    a.frombytes(data[:len(data) - len(data) % a.itemsize])
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+def _write(path, a, append=False):
+    # Files are little-endian whatever the machine
+    if sys.byteorder == "big":
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    if append:
+        with open(path, mode="ab") as fh:
+            fh.write(a.tobytes())
+        return
+    tmppath = path.with_name(path.name + ".%d.tmp" % os.getpid())
+    with open(tmppath, mode="wb") as fh:
+        fh.write(a.tobytes())
+    os.replace(tmppath, path)
+
+@contextlib.contextmanager
+def _locked(path, shared=False):
+    # Lock on the store directory (shared for reading), released when the
+    # file is closed; a store not written yet has nothing to lock
+    if shared and not path.is_dir():
+        yield
+        return
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path / LOCK_FILENAME, mode="a") as fh:
+        if fcntl is not None:
+            fcntl.flock(fh, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+class VitalStore:
+    """Vital signs of a patient for an encounter (kept in the 'state' directory, see storepath()).
+
+    Args:
+        chartno (str): Chart number.
+        encounterid (str) [optional]: Encounter ID (None for the TPR chart of emr_vitals.py).
+        path (str or pathlib.Path) [optional]: Directory to use instead.
+        baseurl (str) [optional]: Server the vital signs are from (see session.statekey()).
+
+    Attributes:
+        times (array.array): Timestamps of the rows (see timestamp()), ascending.
+        values (dict): array.array of the measurements of each channel, in the order of times.
+
+    """
+    def __init__(self, chartno, encounterid=None, path=None, baseurl=session.BASEURL):
+        self.path = pathlib.Path(path) if path else storepath(chartno, encounterid, baseurl)
+        with _locked(self.path, shared=True):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path / MANIFEST_FILENAME, mode="r", encoding="utf-8") as fh:
+                manifest = json.load(fh)
+            self._generation, rows = manifest["generation"], manifest["rows"]
+        except (OSError, ValueError, KeyError):
+            self._generation, rows = 0, None
+        self.times = _read(self.path / _filename("times", self._generation), "q")
+        self.values = {channel: _read(self.path / _filename(channel, self._generation), "f") for channel in CHANNELS}
+        if rows is None:
+            rows = len(self.times)
+        # Whether the files need rewriting rather than appending to
+        self._damaged = any(len(column) != rows for column in [self.times] + list(self.values.values()))
+        # Rows past the number written are from an append cut short; the
+        # files are never short of it unless the channel is new (an empty
+        # column) or they were changed behind the store's back, and rows
+        # not in every column go then
+        n = min([len(column) for column in self.values.values() if column] + [len(self.times), rows])
+        if n < rows:
+            print("[Warning] Columns of", self.path, "are shorter than the", rows, "rows written; keeping the first", n,
+                file=sys.stderr)
+        del self.times[n:]
+        for column in self.values.values():
+            column.extend([NAN] * (n - len(column)))
+            del column[n:]
+
+    def __len__(self):
+        return len(self.times)
+
+    def _write(self, append=None):
+        # Appended to the files of the current generation, or written whole
+        # as the next one; either way only taken into the store by store.json
+        generation = self._generation if append else self._generation + 1
+        for column in ["times"] + CHANNELS:
+            data = self.times if column == "times" else self.values[column]
+            _write(self.path / _filename(column, generation), append[column] if append else data, append is not None)
+        tmppath = self.path / (MANIFEST_FILENAME + ".%d.tmp" % os.getpid())
+        with open(tmppath, mode="w", encoding="utf-8") as fh:
+            json.dump({"generation": generation, "rows": len(self.times)}, fh)
+        os.replace(tmppath, self.path / MANIFEST_FILENAME)
+        self._generation = generation
+        self._damaged = False
+        if not append:
+            # Files of earlier generations (and of rewrites cut short) go
+            current = set(_filename(column, generation) for column in ["times"] + CHANNELS)
+            for p in self.path.iterdir():
+                if _column_regex.match(p.name) and p.name not in current:
+                    try:
+                        p.unlink()
+                    except OSError:
+                        pass
+
+    def add(self, rows):
+        """Adds measurements to the store.
+
+        Args:
+            rows (iterable): (time, dict of channel: measurement) for each time, the time being a datetime.datetime
+                or an ISO8601 string, and measurements strings or numbers (see value()); missing ones are skipped.
+
+        Returns:
+            int: Number of rows added or changed.
+
+        """
+        with _locked(self.path):
+            # Rows other runs have added since the store was read are kept
+            self._load()
+            return self._add(rows)
+
+    def _add(self, rows):
+        new = dict()
+        for t, measured in rows:
+            row = new.setdefault(timestamp(t), dict())
+            for channel, x in measured.items():
+                assert channel in CHANNELS, "Unknown channel: " + channel
+                x = value(x)
+                if not math.isnan(x):
+                    row[channel] = x
+        new = {ts: row for ts, row in new.items() if row}
+        if not new:
+            if self._damaged:
+                self._write()
+            return 0
+        added = sorted(new)
+        if not self._damaged and (not self.times or added[0] > self.times[-1]):
+            append = {"times": array.array("q", added)}
+            for channel in CHANNELS:
+                append[channel] = array.array("f", (new[ts].get(channel, NAN) for ts in added))
+                self.values[channel].extend(append[channel])
+            self.times.extend(added)
+            self._write(append)
+            return len(added)
+        changed = 0
+        inserted = list()
+        for ts in added:
+            i = bisect.bisect_left(self.times, ts)
+            if i == len(self.times) or self.times[i] != ts:
+                inserted.append(ts)
+                continue
+            updated = False
+            for channel, x in new[ts].items():
+                old = self.values[channel][i]
+                self.values[channel][i] = x
+                # Compared as stored (float32); NaN never equals anything
+                updated = updated or self.values[channel][i] != old
+            changed += updated
+        if inserted:
+            times = list(self.times) + inserted
+            order = sorted(range(len(times)), key=times.__getitem__)
+            self.times = array.array("q", (times[k] for k in order))
+            for channel in CHANNELS:
+                column = list(self.values[channel]) + [new[ts].get(channel, NAN) for ts in inserted]
+                self.values[channel] = array.array("f", (column[k] for k in order))
+        if changed or inserted or self._damaged:
+            self._write()
+        return changed + len(inserted)
+
+    def _range(self, start, end):
+        lo = 0 if start is None else bisect.bisect_left(self.times, timestamp(start))
+        hi = len(self.times) if end is None else bisect.bisect_right(self.times, timestamp(end))
+        return lo, hi
+
+    def slice(self, start=None, end=None, channels=None):
+        """Returns the rows from start to end.
+
+        Args:
+            start, end (datetime.datetime or str) [optional]: First and last time (inclusive; None for no bound).
+            channels (list) [optional]: Channels to return (all if None).
+
+        Returns:
+            tuple: Timestamps (array.array of int64) and a dict of channel: measurements (array.array of float32).
+
+        """
+        lo, hi = self._range(start, end)
+        return self.times[lo:hi], {channel: self.values[channel][lo:hi] for channel in channels or CHANNELS}
+
+    def resample(self, interval, start=None, end=None, channels=None, origin=None):
+        """Returns the mean of the measurements over fixed intervals, from start to end.
+
+        Args:
+            interval (int or datetime.timedelta): Length of each interval (in seconds if an int).
+            start, end (datetime.datetime or str) [optional]: First and last time (inclusive; the first and last
+                rows if None).
+            channels (list) [optional]: Channels to return (all if None).
+            origin (datetime.datetime or str) [optional]: Start of an interval (by default intervals start at
+                multiples of interval since midnight of 1970-01-01, so hours start on the hour).
+
+        Returns:
+            tuple: Start of each interval (array.array of int64) and a dict of channel: means (array.array of
+                float32, NaN for intervals without measurements).
+
+        """
+        if isinstance(interval, datetime.timedelta):
+            interval = interval // datetime.timedelta(seconds=1)
+        assert interval > 0, "Interval must be positive"
+        lo, hi = self._range(start, end)
+        if lo == hi and (start is None or end is None):
+            return array.array("q"), {channel: array.array("f") for channel in channels or CHANNELS}
+        first = timestamp(start) if start is not None else self.times[lo]
+        last = timestamp(end) if end is not None else self.times[hi - 1]
+        first -= (first - (timestamp(origin) if origin is not None else 0)) % interval
+        n = (last - first) // interval + 1
+        bins = [(ts - first) // interval for ts in self.times[lo:hi]]
+        out = dict()
+        for channel in channels or CHANNELS:
+            sums = [0.0] * n
+            counts = [0] * n
+            for b, x in zip(bins, self.values[channel][lo:hi]):
+                if x == x:
+                    sums[b] += x
+                    counts[b] += 1
+            out[channel] = array.array("f", (s / c if c else NAN for s, c in zip(sums, counts)))
+        return array.array("q", range(first, first + n * interval, interval)), out
+
+    def downsample(self, points, start=None, end=None, channels=None):
+        """Returns the mean of the measurements over at most the given number of equal intervals from start to end (see resample())."""
+        assert points > 0, "Number of points must be positive"
+        lo, hi = self._range(start, end)
+        if lo == hi and (start is None or end is None):
+            return self.resample(1, start, end, channels)
+        first = timestamp(start) if start is not None else self.times[lo]
+        last = timestamp(end) if end is not None else self.times[hi - 1]
+        interval = max(1, -(-(last - first + 1) // points))
+        return self.resample(interval, start, end, channels, origin=to_datetime(first))
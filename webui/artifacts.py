@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+#-*- encoding: utf-8 -*-
+
+# artifacts.py - index of the reports in the cache directory
+#
+# Reports are named <chartno>_<kind>_<startdate>_<enddate>.html by the tools.
+# The index records which tool made each report and when, so that a report
+# requested again shortly after can be served as is instead of running the
+# tool again, and keeps the cache directory bounded by deleting reports
+# that are too old or haven't been opened for the longest time. Files in
+# subdirectories (e.g. the per-patient <chartno>/ directories emr_summary.py
+# writes) are indexed and evicted one by one as <subdir>/<name>, with the
+# chart number taken from the subdirectory if not from the file name.
+
+import datetime
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+
+# Kind of report (as in the file name) made by each tool
+KINDS = {'emr_diff.py': 'diff', 'emr_diagnosis.py': 'diag'}
+# Reports newer than this (in seconds) are reused instead of running the tool again
+TTL = {'emr_diff.py': 30 * 60, 'emr_diagnosis.py': 60 * 60}
+# Bounds on the cache directory; reports used least recently are deleted first
+MAX_BYTES = 500 * 1024 * 1024
+MAX_AGE = 30 * 24 * 60 * 60
+
+INDEX_FILENAME = '.index.sqlite'
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS artifacts (
+    filename TEXT PRIMARY KEY,
+    tool TEXT,
+    chartno TEXT NOT NULL,
+    startdate TEXT,
+    enddate TEXT,
+    created REAL NOT NULL,
+    lastused REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_key ON artifacts (tool, chartno, startdate, enddate, created);
+CREATE INDEX IF NOT EXISTS artifacts_lastused ON artifacts (lastused);
+CREATE INDEX IF NOT EXISTS artifacts_created ON artifacts (created);
+CREATE INDEX IF NOT EXISTS artifacts_chartno ON artifacts (chartno, created);
+"""
+# Reports written outside the web UI (e.g. by the tools run from the command
+# line) are picked up by a scan of the directory once it has changed, or at
+# least this often (in seconds) to catch reports rewritten in place
+RESCAN_INTERVAL = 10 * 60
+# Reports listed per page by query()
+PER_PAGE = 50
+
+_filename_regex = re.compile(r'^(\d{8})_([a-z]+)_(\d{4}-\d{2}-\d{2})_(\d{4}-\d{2}-\d{2})\.html$')
+_chartno_regex = re.compile(r'^\d{8}$')
+_tools = {kind: tool for tool, kind in KINDS.items()}
+
+def filename(tool, chartno, startdate, enddate):
+    """Returns the file name of the report the tool writes for these arguments."""
+    return '%s_%s_%s_%s.html' % (chartno, KINDS[tool], startdate, enddate)
+
+def _row(name, st, tool=None, chartno=None, startdate=None, enddate=None):
+    # Index row for a report; what isn't given is taken from the file name
+    parent, _, base = name.rpartition('/')
+    m = _filename_regex.match(base)
+    if m:
+        chartno = chartno or m.group(1)
+        tool = tool or _tools.get(m.group(2))
+        startdate = startdate or m.group(3)
+        enddate = enddate or m.group(4)
+    if not chartno and _chartno_regex.match(parent.split('/')[0]):
+        chartno = parent.split('/')[0]
+    return (name, tool, chartno or '', startdate, enddate, st.st_mtime, time.time(), st.st_size)
+
+def _walk(path, prefix=''):
+    # (name relative to the cache directory, os.DirEntry) of each file under path
+    with os.scandir(str(path)) as it:
+        for entry in it:
+            # Reports still being written (.part.html) are left out until done
+            if entry.name.startswith('.') or entry.name.endswith('.part.html'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path, prefix + entry.name + '/')
+            elif entry.is_file():
+                yield prefix + entry.name, entry
+
+class ArtifactIndex:
+    """SQLite index of the reports in a cache directory (kept in the directory as INDEX_FILENAME).
+
+    Args:
+        cachedir (str or pathlib.Path): Directory the tools write their reports to.
+
+    """
+    def __init__(self, cachedir):
+        self.cachedir = pathlib.Path(cachedir)
+        self._lock = threading.Lock()
+        self._scanning = threading.Lock()
+        # Modification time of the directory and time of the last scan
+        self._scanned = (None, 0)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(str(self.cachedir / INDEX_FILENAME), timeout=30)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    return conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+
+    def add(self, name, tool=None, chartno=None, startdate=None, enddate=None):
+        """Adds (or updates) a report written to the cache directory; returns False if there is no such file.
+
+        The tool, chart number and dates are taken from the file name if not given.
+        """
+        try:
+            st = os.stat(str(self.cachedir / name))
+        except OSError:
+            return False
+        self._insert([_row(name, st, tool, chartno, startdate, enddate)])
+        return True
+
+    def _insert(self, rows):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO artifacts (filename, tool, chartno, startdate, enddate, created, lastused, size) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            finally:
+                conn.close()
+
+    def fresh(self, tool, chartno, startdate, enddate, ttl=None):
+        """Returns the name of a report made by tool with these arguments within ttl seconds (TTL[tool] if not given), or None."""
+        ttl = TTL.get(tool, 0) if ttl is None else ttl
+        rows = self._execute('SELECT filename FROM artifacts WHERE tool = ? AND chartno = ? AND startdate = ? AND enddate = ? AND created >= ? '
+            'ORDER BY created DESC LIMIT 1', (tool, chartno, startdate, enddate, time.time() - ttl))
+        if not rows or not (self.cachedir / rows[0][0]).is_file():
+            return None
+        self.touch(rows[0][0])
+        return rows[0][0]
+
+    def touch(self, name):
+        """Marks a report as just used (for eviction)."""
+        self._execute('UPDATE artifacts SET lastused = ? WHERE filename = ?', (time.time(), name))
+
+    def scan(self):
+        """Brings the index in line with the cache directory (e.g. reports written by the tools run from the command line)."""
+        dir_mtime = os.stat(str(self.cachedir)).st_mtime
+        indexed = {name: (created, size) for name, created, size in self._execute('SELECT filename, created, size FROM artifacts')}
+        present = set()
+        changed = list()
+        for name, entry in _walk(self.cachedir):
+            present.add(name)
+            st = entry.stat()
+            if indexed.get(name) != (st.st_mtime, st.st_size):
+                changed.append(_row(name, st))
+        self._insert(changed)
+        gone = [(name,) for name in set(indexed) - present]
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany('DELETE FROM artifacts WHERE filename = ?', gone)
+            finally:
+                conn.close()
+        self._scanned = (dir_mtime, time.time())
+
+    def reconcile(self):
+        """Starts a scan() in the background if the cache directory has changed since the last one (or RESCAN_INTERVAL has passed).
+
+        Only the directory itself is checked here, so this takes the same time
+        however many reports there are; the index is up to date once the scan
+        is done. Files added to an existing subdirectory are picked up within
+        RESCAN_INTERVAL.
+        """
+        try:
+            dir_mtime = os.stat(str(self.cachedir)).st_mtime
+        except OSError:
+            return
+        last_mtime, last_scan = self._scanned
+        if dir_mtime == last_mtime and time.time() - last_scan < RESCAN_INTERVAL:
+            return
+        if not self._scanning.acquire(blocking=False):
+            return
+        def scan():
+            try:
+                self.scan()
+                self.evict()
+            finally:
+                self._scanning.release()
+        threading.Thread(target=scan, daemon=True).start()
+
+    def query(self, chartno=None, tool=None, date=None, page=1, per_page=PER_PAGE):
+        """Lists reports, newest first, one page at a time.
+
+        Args:
+            chartno (str) [optional]: Only list reports for this chart number.
+            tool (str) [optional]: Only list reports made by this tool ('' for reports from other tools).
+            date (str) [optional]: Only list reports made on this day (YYYY-MM-DD).
+            page (int): Page number, starting from 1.
+            per_page (int): Number of reports per page.
+
+        Returns:
+            tuple: (list of dicts with the filename, tool, chartno, startdate, enddate and created (datetime.datetime) of each report,
+                total number of matching reports)
+
+        """
+        where = list()
+        params = list()
+        if chartno:
+            where.append('chartno = ?')
+            params.append(chartno)
+        if tool is not None:
+            where.append('tool IS ?')
+            params.append(tool or None)
+        if date:
+            day = datetime.datetime.strptime(date, '%Y-%m-%d').timestamp()
+            where.append('created >= ? AND created < ?')
+            params.extend([day, day + 24 * 60 * 60])
+        clause = (' WHERE ' + ' AND '.join(where)) if where else ''
+        total = self._execute('SELECT COUNT(*) FROM artifacts' + clause, params)[0][0]
+        rows = self._execute('SELECT filename, tool, chartno, startdate, enddate, created FROM artifacts' + clause +
+            ' ORDER BY created DESC LIMIT ? OFFSET ?', params + [per_page, (max(page, 1) - 1) * per_page])
+        return [{'filename': f, 'tool': t, 'chartno': c, 'startdate': s, 'enddate': e, 'created': datetime.datetime.fromtimestamp(cr)}
+            for f, t, c, s, e, cr in rows], total
+
+    def evict(self, max_bytes=MAX_BYTES, max_age=MAX_AGE):
+        """Deletes reports older than max_age seconds, then the least recently used ones until at most max_bytes are left.
+
+        Returns:
+            list: Names of the deleted reports.
+
+        """
+        rows = self._execute('SELECT filename, created, size FROM artifacts ORDER BY lastused ASC')
+        total = sum(size for _, _, size in rows)
+        cutoff = time.time() - max_age
+        evicted = list()
+        for name, created, size in rows:
+            if created >= cutoff and total <= max_bytes:
+                continue
+            try:
+                os.remove(str(self.cachedir / name))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            # Subdirectories left empty go too
+            parent = (self.cachedir / name).parent
+            while parent != self.cachedir:
+                try:
+                    parent.rmdir()
+                except OSError:
+                    break
+                parent = parent.parent
+            self._execute('DELETE FROM artifacts WHERE filename = ?', (name,))
+            total -= size
+            evicted.append(name)
+        return evicted
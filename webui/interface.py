@@ -3,39 +3,100 @@
 
 #import asyncio
 import datetime
+import json
 #import multiprocessing
 import os
 import pathlib
+import re
 import shlex
-import subprocess
 import sys
 
 import flask
 
+import artifacts
+import jobs
+
 PYTHONPATH = sys.executable
+# Tools that can be run from the main page
+TOOLS = ['emr_diff.py', 'emr_diagnosis.py']
+# Date range used by the tools if none is given
+STARTDATE = '2019-01-01'
+TOOLDIR = pathlib.Path(os.path.realpath(__file__)).parent.parent / 'tools'
+# Where the tools write their reports
+CACHEDIR = pathlib.Path(os.path.realpath(__file__)).parent.parent / 'cache'
+CACHEDIR.mkdir(exist_ok=True)
+
+# For the full-text index of the notes fetched by emr_diff.py
+sys.path.insert(0, str(TOOLDIR))
+from lib import noteindex
 
 app = flask.Flask(__name__)
 app.debug = True
 
+# Reports in the cache directory; recent ones are reused, and the directory
+# is kept within artifacts.MAX_BYTES and artifacts.MAX_AGE
+index = artifacts.ArtifactIndex(CACHEDIR)
+index.reconcile()
+
+def job_finished(job):
+    if job.returncode != 0:
+        return
+    tool, chartno, startdate, enddate = job.key
+    name = artifacts.filename(tool, chartno, startdate, enddate)
+    if index.add(name, tool, chartno, startdate, enddate):
+        job.artifact = name
+    index.evict()
+
+# Tools run in the background; /dispatch returns at once and the results page
+# polls the job until it is done
+queue = jobs.JobQueue(on_finish=job_finished)
+
 @app.route('/')
 def main():
-    # Main page submits form to /dispatch
-    filelist = dict()
-    for f in os.listdir(path=str(pathlib.Path(os.path.realpath(__file__)).parent.parent/'cache')):
-        filelist[f] = datetime.datetime.fromtimestamp(os.path.getmtime(str(pathlib.Path(os.path.realpath(__file__)).parent.parent/'cache')+os.sep+f))
-    return flask.render_template('main.html', filelist=filelist)
+    # Main page submits form to /dispatch. Reports are listed from the index
+    # a page at a time, so the page loads as fast however big the cache is.
+    chartno = flask.request.args.get('chartno', '').strip()
+    tool = flask.request.args.get('tool', 'all')
+    date = flask.request.args.get('date', '')
+    page = flask.request.args.get('page', 1, type=int)
+    try:
+        if date:
+            datetime.datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        flask.abort(400)
+    index.reconcile()
+    # 'other' lists reports not made by the tools in TOOLS (e.g. summaries)
+    toolfilter = tool if tool in TOOLS else ('' if tool == 'other' else None)
+    filelist, total = index.query(chartno=chartno, tool=toolfilter, date=date, page=page)
+    pages = max(1, -(-total // artifacts.PER_PAGE))
+    return flask.render_template('main.html', filelist=filelist, total=total, page=page, pages=pages,
+        filters={'chartno': chartno, 'tool': tool, 'date': date})
 
 @app.route('/dispatch', methods=['POST'])
 def dispatch():
     # Run tools with form data
-    tool = shlex.quote(flask.request.form.get('tool'))
+    tool = flask.request.form.get('tool')
+    if tool not in TOOLS:
+        flask.abort(400)
     uid = shlex.quote(flask.request.form.get('uid'))
     passwd = shlex.quote(flask.request.form.get('passwd'))
     chartno = shlex.quote(flask.request.form.get('chartno'))
     startdate = shlex.quote(flask.request.form.get('startdate'))
     enddate = shlex.quote(flask.request.form.get('enddate'))
-    # Change to asynchronous call once results interface completed
-    ## Potential security issue if whitelist approach not used?
+    # Dates are filled in here rather than by the tool, so that the name of
+    # the report (and any recent one to reuse) is known in advance
+    startdate = startdate if len(startdate) > 2 else STARTDATE
+    enddate = enddate if len(enddate) > 2 else datetime.date.today().isoformat()
+    try:
+        assert re.match(r'^\d{8}$', chartno), "Chart number malformed"
+        datetime.datetime.strptime(startdate, '%Y-%m-%d')
+        datetime.datetime.strptime(enddate, '%Y-%m-%d')
+    except (AssertionError, ValueError):
+        flask.abort(400)
+    if not flask.request.form.get('refresh'):
+        name = index.fresh(tool, chartno, startdate, enddate)
+        if name:
+            return flask.redirect(flask.url_for('filelist', filename=name), code=303)
     #output = subprocess.Popen(['python3', tool, '--uid', uid, '--passwd', passwd, '--chartno', chartno, '--startdate', startdate, '--enddate', enddate], cwd='../tools')
     #output = subprocess.run(['python3', tool, '--uid', uid, '--passwd', passwd, '--chartno', chartno, '--startdate', startdate, '--enddate', enddate], cwd='../tools')
     process_args = [PYTHONPATH, str(pathlib.Path(os.path.realpath(__file__)).parent.parent/'tools' / tool)]
@@ -43,37 +104,86 @@ def dispatch():
     # password and chart number here. The only sanity check in place in the
     # whole setup is in the web UI, though shell injection doesn't seem to work
     # (easily) with subprocess_check_output().
-    process_args.extend(['--uid', uid, '--passwd', passwd, '--chartno', chartno])
-    if len(startdate) > 2:
-        process_args.extend(['--startdate', startdate])
-    if len(enddate) > 2:
-        process_args.extend(['--enddate', enddate])
+    process_args.extend(['--uid', uid, '--passwd', passwd, '--chartno', chartno, '--startdate', startdate, '--enddate', enddate])
     #output = subprocess.check_output(['python3', str(pathlib.Path.cwd().parent / 'tools'/ tool), '--uid', uid, '--passwd', passwd, '--chartno', chartno, '--startdate', startdate, '--enddate', enddate, '--dir', '../cache'], cwd='../tools')
-    output = subprocess.check_output(process_args, cwd=pathlib.Path(os.path.realpath(__file__)).parent.parent/'tools')
-
-    # Starting from Python 3.7 there is a simple function for starting a task
-    # asynchronously: asyncio.run(). Unfortunately we're on Python 3.6, so we're
-    # using the old method of using an explicit event loop.    
-    #loop = asyncio.get_event_loop()
-    #proc = asyncio.create_subprocess_shell('python3 ' + tool + ' --uid ' + uid + ' --passwd ' + passwd + ' --chartno ' + chartno + ' --startdate ' + startdate + ' --enddate ' + enddate + ' --dir ' + ' ../webui/cache', stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    # The following returns a Process object immediately, but we still need a
-    # way to have the results page query Flask to see if the task has been
-    # completed (with a task ID?)
-    #loop.run_until_complete(proc)
-
-    # It's probably possible to check whether the running tool has exited by
-    # using the process ID, but it's probably a potential security threat. On
-    # the other hand, if we run the tool synchronously (i.e. the tool blocks),
-    # then we would be limited by the browser timeout, the length of which can
-    # vary (e.g. default 1 minute for IE, 5 minutes for Chromium). It is still
-    # unclear how big an issue timeout would be.
-
-    #output = subprocess.check_output(['python3', tool, '--help'], cwd='../tools')
-    # Redirect to page showing console output, progress bar, and list of links to result pages
-    return flask.render_template('results.html', chartno=chartno, output=output)
+
+    # Running the tool within the request would be cut off by the browser
+    # timeout (e.g. default 1 minute for IE, 5 minutes for Chromium) on long
+    # runs, so it is queued instead. The same report requested again while it
+    # is still being made (e.g. by another user) joins the run in progress.
+    key = (tool, chartno, startdate, enddate)
+    try:
+        job = queue.submit(tool, key, process_args, TOOLDIR)
+    except jobs.QueueFull:
+        flask.abort(503)
+    # Redirect to page showing console output of the job until it is done
+    return flask.redirect(flask.url_for('job', jobid=job.id), code=303)
+
+@app.route('/jobs')
+def joblist():
+    return flask.jsonify([dict(j.to_dict(), output=None) for j in queue.list()])
+
+@app.route('/jobs/<jobid>')
+def job(jobid):
+    job = queue.get(jobid)
+    if job is None:
+        flask.abort(404)
+    output, progress, seen = job.snapshot()
+    return flask.render_template('results.html', job=job, chartno=job.key[1], output=output, progress=progress, seen=seen)
+
+@app.route('/jobs/<jobid>/status')
+def jobstatus(jobid):
+    job = queue.get(jobid)
+    if job is None:
+        flask.abort(404)
+    return flask.jsonify(job.to_dict())
+
+@app.route('/jobs/<jobid>/events')
+def jobevents(jobid):
+    # Server-Sent Events: 'output' (a line of output), 'progress' (progress
+    # report of the tool) and finally 'done' (status and report of the job).
+    # Events are numbered, so a client can pick up where it left off with
+    # Last-Event-ID or ?from= (number of events already seen).
+    job = queue.get(jobid)
+    if job is None:
+        flask.abort(404)
+    start = flask.request.args.get('from', type=int)
+    if start is None:
+        start = flask.request.headers.get('Last-Event-ID', -1, type=int) + 1
+    def stream(start):
+        while True:
+            events, done = job.wait_events(start, timeout=15)
+            for n, (kind, data) in enumerate(events, start):
+                yield 'id: %d\nevent: %s\ndata: %s\n\n' % (n, kind, json.dumps(data, ensure_ascii=False))
+            start += len(events)
+            if done and not events:
+                yield 'event: done\ndata: %s\n\n' % json.dumps({'status': job.status, 'returncode': job.returncode, 'artifact': job.artifact})
+                return
+            if not events:
+                # Keeps proxies from closing an idle connection
+                yield ': keepalive\n\n'
+    return flask.Response(stream(max(start, 0)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/search')
+def search():
+    # Occurrences (oldest first) of a phrase in the notes of a patient indexed
+    # by emr_diff.py, as JSON; ?first=1 only returns the first one
+    chartno = flask.request.args.get('chartno', '').strip()
+    phrase = flask.request.args.get('q', '')
+    if not re.match(r'^\d{8}$', chartno) or not phrase.strip():
+        flask.abort(400)
+    if not noteindex.indexpath(chartno).exists():
+        flask.abort(404)
+    with noteindex.NoteIndex(chartno) as notes:
+        found = notes.search(phrase)
+    total = len(found)
+    if flask.request.args.get('first'):
+        found = found[:1]
+    return flask.jsonify({'chartno': chartno, 'phrase': phrase, 'total': total, 'occurrences': found})
 
 @app.route('/cache/<path:filename>')
 def filelist(filename):
+    index.touch(filename)
     return flask.send_from_directory(str(pathlib.Path(os.path.realpath(__file__)).parent.parent/'cache'), filename)
 
 if __name__ == '__main__':
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+#-*- encoding: utf-8 -*-
+
+# jobs.py - background runs of the command-line tools for the web UI
+#
+# Tools can run for minutes (e.g. emr_diff.py over years of visits), longer
+# than browsers wait for a response, so the web UI hands each run to a
+# JobQueue and lets the browser poll for its status instead. The queue runs
+# a bounded number of tools at a time (and fewer of any one tool), and a
+# request for a run that is already queued or running (same tool, chart
+# number and date range) joins that run instead of starting another one.
+#
+# Output is collected as the tool prints it, as a list of events that can be
+# followed while the job runs (see Job.wait_events()): 'output' for each line
+# and 'progress' for the progress reports of the tools (tools/lib/progress.py).
+
+import collections
+import concurrent.futures
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+# Progress reports are read as tools/lib/progress.py writes them
+sys.path.insert(0, str(pathlib.Path(os.path.realpath(__file__)).parent.parent / 'tools'))
+from lib import progress
+
+# Number of tools running at the same time
+WORKERS = 4
+# Number of runs of any one tool at the same time (e.g. to go easy on hisweb)
+TOOL_LIMIT = 2
+# Number of jobs waiting to run before new ones are turned away
+MAX_PENDING = 32
+# Number of finished jobs whose status and output are kept
+MAX_FINISHED = 200
+
+class QueueFull(Exception):
+    pass
+
+class Job:
+    """A run of a tool.
+
+    Args:
+        tool (str): Tool name, e.g. "emr_diff.py".
+        key (tuple): Runs with the same key give the same result (e.g. tool, chart number and date range).
+        args (list): Command line to run.
+        cwd (str or pathlib.Path): Working directory to run it in.
+
+    """
+    def __init__(self, tool, key, args, cwd):
+        self.id = uuid.uuid4().hex
+        self.tool = tool
+        self.key = key
+        self.args = args
+        self.cwd = cwd
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.returncode = None
+        self.output = ''
+        # Number of requests served by this run (more than 1 if deduplicated)
+        self.requests = 1
+        # Name of the report written to the cache directory (set by the caller once done)
+        self.artifact = None
+        # Latest progress report of the tool
+        self.progress = None
+        # List of (kind, data) in the order they happened
+        self.events = list()
+        self._changed = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ('finished', 'failed')
+
+    def to_dict(self):
+        return {'id': self.id, 'tool': self.tool, 'key': list(self.key), 'status': self.status, 'created': self.created,
+            'started': self.started, 'finished': self.finished, 'returncode': self.returncode, 'requests': self.requests,
+            'artifact': self.artifact, 'progress': self.progress, 'output': self.output}
+
+    def _add_line(self, line):
+        with self._changed:
+            if line.startswith(progress.MARKER):
+                try:
+                    self.progress = json.loads(line[len(progress.MARKER):])
+                    self.events.append(('progress', self.progress))
+                except ValueError:
+                    pass
+                else:
+                    self._changed.notify_all()
+                    return
+            self.output += line
+            self.events.append(('output', line))
+            self._changed.notify_all()
+
+    def _set_status(self, status):
+        with self._changed:
+            self.status = status
+            self.finished = time.time()
+            self._changed.notify_all()
+
+    def snapshot(self):
+        """Returns (output, latest progress report, number of events) as of the same moment."""
+        with self._changed:
+            return self.output, self.progress, len(self.events)
+
+    def wait_events(self, start, timeout=None):
+        """Waits until there are events past the first start ones or the job is done.
+
+        Args:
+            start (int): Number of events already seen.
+            timeout (float) [optional]: Seconds to wait at most.
+
+        Returns:
+            tuple: (list of new (kind, data) events, whether the job is done)
+
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > start or self.done, timeout)
+            return self.events[start:], self.done
+
+class JobQueue:
+    """Runs jobs in the background, at most workers at a time and tool_limit per tool.
+
+    Args:
+        workers (int): Number of jobs running at the same time.
+        tool_limit (int or dict): Number of jobs of a tool running at the same time
+            (a dict maps tool names to limits, with TOOL_LIMIT for tools not listed).
+        max_pending (int): Number of queued jobs before submit() raises QueueFull.
+        max_finished (int): Number of finished jobs kept for get().
+        on_finish (function) [optional]: Called with each job once it is done (before its status is updated).
+
+    """
+    def __init__(self, workers=WORKERS, tool_limit=TOOL_LIMIT, max_pending=MAX_PENDING, max_finished=MAX_FINISHED, on_finish=None):
+        self.workers = workers
+        self.tool_limit = tool_limit
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.on_finish = on_finish
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._jobs = collections.OrderedDict()
+        # Jobs not yet started, in order of submission
+        self._pending = collections.deque()
+        # Running jobs per tool
+        self._running = collections.Counter()
+        # Queued or running jobs by key
+        self._inflight = dict()
+
+    def _limit(self, tool):
+        if isinstance(self.tool_limit, dict):
+            return self.tool_limit.get(tool, TOOL_LIMIT)
+        return self.tool_limit
+
+    def submit(self, tool, key, args, cwd):
+        """Queues a run of a tool, or returns the queued or running job with the same key.
+
+        Returns:
+            Job: The job, whose ID can be given to get().
+
+        Raises:
+            QueueFull: If max_pending jobs are already waiting.
+
+        """
+        with self._lock:
+            job = self._inflight.get(key)
+            if job is not None:
+                job.requests += 1
+                return job
+            if len(self._pending) >= self.max_pending:
+                raise QueueFull("Too many jobs waiting (%d)" % len(self._pending))
+            job = Job(tool, key, args, cwd)
+            self._jobs[job.id] = job
+            self._inflight[key] = job
+            self._pending.append(job)
+            self._schedule()
+        return job
+
+    def get(self, jobid):
+        with self._lock:
+            return self._jobs.get(jobid)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _schedule(self):
+        # Starts the oldest pending jobs allowed to run; called with the lock held
+        running = sum(self._running.values())
+        for job in list(self._pending):
+            if running >= self.workers:
+                break
+            if self._running[job.tool] >= self._limit(job.tool):
+                continue
+            self._pending.remove(job)
+            self._running[job.tool] += 1
+            running += 1
+            job.status = 'running'
+            job.started = time.time()
+            self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        # Any failure ends the job as failed and frees its slot, so that
+        # later jobs for the tool (or the same report) aren't held up
+        status = 'failed'
+        proc = None
+        try:
+            # Unbuffered, so that lines come through as soon as they are printed
+            env = dict(os.environ, PYTHONUNBUFFERED='1')
+            env[progress.ENVVAR] = '1'
+            proc = subprocess.Popen(job.args, cwd=str(job.cwd), stdout=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', env=env)
+            # Output is collected as it comes, so a poll shows how far the tool has got
+            for line in proc.stdout:
+                job._add_line(line)
+            job.returncode = proc.wait()
+            status = 'finished' if job.returncode == 0 else 'failed'
+        except Exception as err:
+            job._add_line("[Error] Couldn't run %s: %s\n" % (job.tool, err))
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+        finally:
+            if self.on_finish:
+                try:
+                    self.on_finish(job)
+                except Exception as err:
+                    job._add_line("[Error] %s\n" % err)
+            with self._lock:
+                job._set_status(status)
+                self._running[job.tool] -= 1
+                if self._inflight.get(job.key) is job:
+                    del self._inflight[job.key]
+                self._expire()
+                self._schedule()
+
+    def _expire(self):
+        # Forgets the oldest finished jobs beyond max_finished; called with the lock held
+        finished = [j for j in self._jobs.values() if j.done]
+        for job in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job.id]